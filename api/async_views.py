@@ -0,0 +1,231 @@
+"""
+Async read endpoints for ASGI servers:
+
+    uvicorn shop.asgi:application --workers 2
+
+They mirror the read actions of the sync viewsets under /async/ and reuse
+their querysets (user scoping, filters, AutoPrefetch plans), pagination,
+serializers, permissions and the catalog cache. Waiting on the database or
+the cache doesn't hold a thread:
+
+- rows come from aiterator() and aget();
+- catalog entries come from cache.aget() and cache.aset();
+- the JWT user comes from User.objects.aget(), and the session user from
+  request.auser().
+
+A worker serves as many concurrent reads as the database allows instead
+of one per thread. Under WSGI they still work, each request in its own
+event loop; writes stay on the sync viewsets.
+"""
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.cache import cache
+from django.db.models import aprefetch_related_objects
+from django.http import Http404, HttpResponse
+from django.views import View
+from rest_framework.exceptions import AuthenticationFailed, NotAuthenticated, PermissionDenied
+from rest_framework.request import Request
+from rest_framework.views import exception_handler
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from api.cache import CATALOG_CACHE_TIMEOUT, aget_catalog_version, catalog_cache_enabled, catalog_version_key
+from api.metrics import record_cache_lookup
+from api.models import User
+from api.renderers import FastJSONRenderer
+from api.views import FileViewSet, OrderViewSet, ProductAPIView
+
+# Rows per query of an aiterator() with prefetches: each chunk prefetches
+# its related rows with one IN query per relation.
+CHUNK_SIZE = 2000
+
+
+async def authenticate(request):
+    """
+    The user of a JWT bearer token, else of the session, else anonymous:
+    what the REST_FRAMEWORK authentication classes do, without blocking.
+    """
+    jwt = JWTAuthentication()
+    header = jwt.get_header(request)
+    raw_token = header and jwt.get_raw_token(header)
+    if raw_token:
+        return await get_token_user(jwt.get_validated_token(raw_token))
+    return await request.auser()
+
+
+async def get_token_user(validated_token):
+    """
+    `JWTAuthentication.get_user` with an async lookup.
+    """
+    try:
+        user_id = validated_token[jwt_settings.USER_ID_CLAIM]
+    except KeyError:
+        raise InvalidToken('Token contained no recognizable user identification')
+    try:
+        user = await User.objects.aget(**{jwt_settings.USER_ID_FIELD: user_id})
+    except User.DoesNotExist:
+        raise AuthenticationFailed('User not found', code='user_not_found')
+    if jwt_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+        raise AuthenticationFailed('User is inactive', code='user_inactive')
+    return user
+
+
+async def fetch(queryset):
+    return [row async for row in queryset.aiterator(chunk_size=CHUNK_SIZE)]
+
+
+class AsyncReadView(View):
+    """
+    Base for the async endpoints. `viewset` and `action` name the sync
+    viewset action that is mirrored; subclasses implement `get_data`.
+    """
+    viewset = None
+    action = None
+    # Catalog data is cached under the catalog version like the sync views
+    catalog_cached = False
+    http_method_names = ['get', 'head', 'options']
+
+    async def get(self, request, *args, **kwargs):
+        drf_request = Request(request)
+        view = None
+        try:
+            drf_request.user = await authenticate(request)
+            view = self.viewset(request=drf_request, args=args, kwargs=kwargs, action=self.action,
+                                format_kwarg=None)
+            try:
+                view.check_permissions(drf_request)
+            except PermissionDenied:
+                if not drf_request.user.is_authenticated:
+                    raise NotAuthenticated()
+                raise
+
+            key = None
+            if self.catalog_cached and catalog_cache_enabled():
+                key = catalog_version_key(await aget_catalog_version(), drf_request)
+                data = await cache.aget(key)
+                record_cache_lookup('catalog', hit=data is not None)
+                if data is not None:
+                    return self.render(data)
+
+            data = await self.get_data(view, drf_request, **kwargs)
+            if key is not None:
+                await cache.aset(key, data, CATALOG_CACHE_TIMEOUT)
+            return self.render(data)
+        except Exception as exc:
+            return self.handle_exception(exc, drf_request, view)
+
+    async def head(self, request, *args, **kwargs):
+        response = await self.get(request, *args, **kwargs)
+        response.content = b''
+        return response
+
+    async def get_data(self, view, request, **kwargs):
+        raise NotImplementedError
+
+    async def prepare(self, objects):
+        """
+        Load what serializing `objects` needs beyond the view's queryset:
+        serializers run in the event loop, where lazy lookups can't query.
+        """
+
+    async def get_object(self, view, request):
+        """
+        `GenericAPIView.get_object` with aget().
+        """
+        queryset = view.filter_queryset(view.get_queryset())
+        lookup_url_kwarg = view.lookup_url_kwarg or view.lookup_field
+        try:
+            obj = await queryset.aget(**{view.lookup_field: view.kwargs[lookup_url_kwarg]})
+        except (queryset.model.DoesNotExist, DjangoValidationError, TypeError, ValueError):
+            raise Http404(f'No {queryset.model._meta.object_name} matches the given query.')
+        view.check_object_permissions(request, obj)
+        return obj
+
+    @staticmethod
+    def render(data, status=200):
+        return HttpResponse(FastJSONRenderer().render(data), status=status, content_type='application/json')
+
+    def handle_exception(self, exc, request, view):
+        response = exception_handler(exc, {'request': request, 'view': view, 'args': (), 'kwargs': {}})
+        if response is None:
+            raise exc
+        rendered = self.render(response.data, status=response.status_code)
+        for header, value in response.items():
+            if header != 'Content-Type':
+                rendered[header] = value
+        if isinstance(exc, (NotAuthenticated, AuthenticationFailed)):
+            rendered.status_code = 401
+            rendered['WWW-Authenticate'] = JWTAuthentication().authenticate_header(request)
+        return rendered
+
+
+class AsyncListView(AsyncReadView):
+    action = 'list'
+
+    async def get_data(self, view, request, **kwargs):
+        queryset = view.filter_queryset(view.get_queryset())
+        if view.paginator is None:
+            objects = await fetch(queryset)
+            await self.prepare(objects)
+            return view.get_serializer(objects, many=True).data
+        page = await view.paginator.apaginate_queryset(queryset, request, view=view)
+        await self.prepare(page)
+        return view.paginator.get_paginated_response(view.get_serializer(page, many=True).data).data
+
+
+class AsyncDetailView(AsyncReadView):
+    action = 'retrieve'
+
+    async def get_data(self, view, request, **kwargs):
+        obj = await self.get_object(view, request)
+        await self.prepare([obj])
+        return view.get_serializer(obj).data
+
+
+class ProductListView(AsyncListView):
+    viewset = ProductAPIView
+    catalog_cached = True
+
+
+class ProductDetailView(AsyncDetailView):
+    viewset = ProductAPIView
+    catalog_cached = True
+
+
+class ProductFileListView(AsyncListView):
+    viewset = FileViewSet
+    catalog_cached = True
+
+
+class ProductFileDetailView(AsyncDetailView):
+    viewset = FileViewSet
+    catalog_cached = True
+
+
+class OrderItemPricesMixin:
+    async def prepare(self, orders):
+        """
+        Items from before the price snapshot render `item_subtotal` from the
+        live product price: fetch those products in one query.
+        """
+        items = [item for order in orders for item in order.items.all() if item.unit_price is None]
+        if items:
+            await aprefetch_related_objects(items, 'product')
+
+
+class OrderListView(OrderItemPricesMixin, AsyncListView):
+    viewset = OrderViewSet
+
+
+class OrderDetailView(OrderItemPricesMixin, AsyncDetailView):
+    viewset = OrderViewSet
+
+
+class UserOrderListView(OrderItemPricesMixin, AsyncReadView):
+    viewset = OrderViewSet
+    action = 'user_orders'
+
+    async def get_data(self, view, request, **kwargs):
+        orders = await fetch(view.get_queryset().filter(user=request.user))
+        await self.prepare(orders)
+        return view.get_serializer(orders, many=True).data
@@ -0,0 +1,211 @@
+"""
+Versioned caching for product catalog responses.
+
+Every cached catalog response is keyed by the current catalog generation.
+Product and Files writes bump the generation (see `api/signals.py`), which
+orphans all earlier entries at once in O(1) instead of scanning the keyspace
+with `delete_pattern`; orphans simply age out through their timeout.
+
+The generation only invalidates the entries of every worker when the cache is
+shared by all of them (Redis, `REDIS_URL`). With a per-process LocMem cache a
+write would bump the generation in one worker while the others kept serving
+their entries and ETags, so `catalog_cache` and `catalog_validators` are
+skipped there, unless `CATALOG_CACHE_LOCAL` says the server is a single
+process.
+
+Below that, the rendered representation of every listed product is cached
+on its own (`FragmentCacheMixin`), so a page of a new filter or ordering, or
+the first one after a write, only renders the products that changed. A
+fragment carries the `updated_at` of its row, so fragments stay correct in a
+per-process cache too.
+"""
+import hashlib
+import time
+from datetime import datetime, timezone
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from rest_framework import status
+from rest_framework.response import Response
+
+from api.metrics import record_cache_lookup
+
+CATALOG_VERSION_KEY = 'catalog:version'
+CATALOG_MODIFIED_KEY = 'catalog:modified'
+CATALOG_CACHE_TIMEOUT = 60 * 15
+FRAGMENT_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def catalog_cache_enabled():
+    """
+    Whether the catalog generation is seen by every worker: the cache is
+    shared, or the server is a single process.
+    """
+    return not isinstance(caches['default'], LocMemCache) or getattr(settings, 'CATALOG_CACHE_LOCAL', False)
+
+
+def get_catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        _init_catalog_version()
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+async def aget_catalog_version():
+    """
+    `get_catalog_version` for async views, through the async cache API.
+    """
+    version = await cache.aget(CATALOG_VERSION_KEY)
+    if version is None:
+        await cache.aadd(CATALOG_VERSION_KEY, int(time.time() * 1000), timeout=None)
+        version = await cache.aget(CATALOG_VERSION_KEY)
+    return version
+
+
+def get_catalog_modified():
+    """
+    Time of the last catalog write, or None if it is not known (yet).
+    """
+    timestamp = cache.get(CATALOG_MODIFIED_KEY)
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+
+
+def bump_catalog_version():
+    cache.set(CATALOG_MODIFIED_KEY, time.time(), timeout=None)
+    try:
+        return cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        # Key missing or evicted. Restarting from a millisecond timestamp
+        # instead of 1 keeps old generations from being reused.
+        _init_catalog_version()
+        return cache.incr(CATALOG_VERSION_KEY)
+
+
+def invalidate_catalog():
+    """
+    Bump the generation now, so the writer's own reads miss, and again once
+    the transaction commits, so entries cached by concurrent readers from
+    pre-commit data are orphaned as well.
+    """
+    bump_catalog_version()
+    transaction.on_commit(bump_catalog_version)
+
+
+def catalog_cache_key(request):
+    """
+    One key per absolute URL, so every filtered, searched, ordered and
+    paginated variant is cached separately.
+    """
+    return catalog_version_key(get_catalog_version(), request)
+
+
+def catalog_version_key(version, request):
+    url_hash = hashlib.md5(request.build_absolute_uri().encode('utf-8')).hexdigest()
+    return f'catalog:{version}:{url_hash}'
+
+
+def catalog_cache(timeout=CATALOG_CACHE_TIMEOUT):
+    """
+    Cache the data of successful responses of a view method under the
+    current catalog generation. Rendering still happens per request so
+    content negotiation keeps working.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            if not catalog_cache_enabled():
+                return method(view, request, *args, **kwargs)
+            key = catalog_cache_key(request)
+            data = cache.get(key)
+            record_cache_lookup('catalog', hit=data is not None)
+            if data is not None:
+                return Response(data)
+
+            response = method(view, request, *args, **kwargs)
+            if response.status_code == status.HTTP_200_OK:
+                cache.set(key, response.data, timeout)
+            return response
+        return wrapper
+    return decorator
+
+
+def fragment_key(model, pk):
+    return f'fragment:{model._meta.label_lower}:{pk}'
+
+
+def get_fragments(model, rows, version, render):
+    """
+    The representations of `rows` (dicts with the primary key), in order,
+    fetched with one `get_many`. A cached one is used while its version,
+    `version(row)`, is the row's; the others are rendered with
+    `render(misses)` and cached.
+    """
+    pk_name = model._meta.pk.name
+    keys = [fragment_key(model, row[pk_name]) for row in rows]
+    cached = cache.get_many(keys)
+    data, misses = [], []
+    for key, row in zip(keys, rows):
+        entry = cached.get(key)
+        hit = entry is not None and entry[0] == version(row)
+        record_cache_lookup('fragment', hit=hit)
+        data.append(entry[1] if hit else None)
+        if not hit:
+            misses.append(row)
+
+    if misses:
+        rendered = render(misses)
+        cache.set_many({fragment_key(model, row[pk_name]): (version(row), representation)
+                        for row, representation in zip(misses, rendered)}, FRAGMENT_CACHE_TIMEOUT)
+        rendered = iter(rendered)
+        data = [representation if representation is not None else next(rendered) for representation in data]
+    return data
+
+
+def invalidate_fragments(model, pks):
+    """
+    Drop the cached representations of these rows now, and again once the
+    transaction commits, like `invalidate_catalog`.
+    """
+    keys = [fragment_key(model, pk) for pk in pks if pk is not None]
+    if keys:
+        cache.delete_many(keys)
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+class FragmentCacheMixin:
+    """
+    Build compiled list pages from per-object fragments: only the rows of a
+    page without a current fragment are rendered, and only their nested
+    relations are queried.
+
+    The version is `fragment_version_field`, which every write has to move
+    (the model's `updated_at`), and the URL root the representation's links
+    are built on.
+    """
+    fragment_version_field = 'updated_at'
+
+    def get_compiled_extra_columns(self, queryset):
+        return super().get_compiled_extra_columns(queryset) | {self.fragment_version_field}
+
+    def compiled_list(self, compiled, queryset):
+        field = self.fragment_version_field
+        root = self.request.build_absolute_uri('/')
+
+        def version(row):
+            return f'{row[field].isoformat()}|{root}'
+
+        rows = compiled.values(queryset, extra=self.get_compiled_extra_columns(queryset))
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(get_fragments(queryset.model, page, version, compiled.render))
+        return Response(get_fragments(queryset.model, list(rows), version, compiled.render))
+
+
+def _init_catalog_version():
+    cache.add(CATALOG_VERSION_KEY, int(time.time() * 1000), timeout=None)
@@ -0,0 +1,95 @@
+"""
+Contention-safe checkout.
+
+Purchasing never reads a row and writes it back. The order's status moves
+with a compare-and-set UPDATE and each product's stock is decremented with a
+conditional `UPDATE ... SET stock = stock - n WHERE stock >= n`, all in one
+short transaction. Concurrent buyers only wait for each other on the few
+product rows they share, and only for as long as those UPDATEs take.
+Cancelling a completed order gives its stock back the same way.
+"""
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from api import stats
+from api.cache import invalidate_catalog
+from api.models import Order, OrderItem, Product
+
+PURCHASABLE_STATUSES = (Order.StatusChoices.PENDING, Order.StatusChoices.CONFIRMED)
+
+
+def purchase(order):
+    """
+    Mark `order` completed and take its items out of stock, or raise
+    ValidationError and change nothing.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        claimed = Order.objects.filter(pk=order.pk, status__in=PURCHASABLE_STATUSES).update(
+            status=Order.StatusChoices.COMPLETED, updated_at=now,
+        )
+        if not claimed:
+            raise ValidationError("This order has already been purchased.")
+
+        quantities = order_quantities(order)
+        for line in quantities:
+            reserved = Product.objects.filter(pk=line['product_id'], stock__gte=line['quantity']).update(
+                stock=F('stock') - line['quantity'], updated_at=now,
+            )
+            if not reserved:
+                # Raising rolls back the status change and earlier decrements.
+                raise ValidationError(f"Product {line['product_id']} does not have enough stock.")
+
+        # Queryset updates skip the Product signals; stock is part of the catalog.
+        stats.record_stock_reservation({line['product_id']: line['quantity'] for line in quantities})
+        invalidate_catalog()
+
+    order.status = Order.StatusChoices.COMPLETED
+    order.updated_at = now
+    return order
+
+
+def cancel(order):
+    """
+    Mark `order` cancelled, putting the stock of a completed order back, or
+    raise ValidationError and change nothing.
+    """
+    if order.status == Order.StatusChoices.CANCELLED:
+        raise ValidationError("This order has already been canceled.")
+    completed = order.status == Order.StatusChoices.COMPLETED
+    now = timezone.now()
+    with transaction.atomic():
+        # The status must still be the one the caller read: a purchase that
+        # completed the order meanwhile has taken stock this wouldn't return.
+        statuses = [Order.StatusChoices.COMPLETED] if completed else PURCHASABLE_STATUSES
+        claimed = Order.objects.filter(pk=order.pk, status__in=statuses).update(
+            status=Order.StatusChoices.CANCELLED, updated_at=now,
+        )
+        if not claimed:
+            raise ValidationError("This order has changed, please try again.")
+
+        if completed:
+            quantities = order_quantities(order)
+            for line in quantities:
+                Product.objects.filter(pk=line['product_id']).update(
+                    stock=F('stock') + line['quantity'], updated_at=now,
+                )
+            stats.record_stock_reservation({line['product_id']: -line['quantity'] for line in quantities})
+            invalidate_catalog()
+
+    order.status = Order.StatusChoices.CANCELLED
+    order.updated_at = now
+    return order
+
+
+def order_quantities(order):
+    # One UPDATE per distinct product, in id order so concurrent checkouts
+    # and cancellations always lock shared rows in the same order.
+    return (
+        OrderItem.objects.filter(order_id=order.pk)
+        .values('product_id')
+        .annotate(quantity=Sum('quantity'))
+        .order_by('product_id')
+    )
@@ -0,0 +1,295 @@
+"""
+Compiled, read-only serialization from `.values()` rows.
+
+A `ModelSerializer` renders a row by instantiating the model, then walking
+every field through `get_attribute()` and `to_representation()`. For list
+endpoints that per-row machinery costs more CPU than the query itself.
+
+`compile_serializer` walks a serializer's fields once per request and
+produces:
+- the `.values()` columns its rows need;
+- one converter per field, precomputed from the DRF field so the output is
+  identical, with fast paths for integers, strings, UUIDs and decimals;
+- a child plan for every nested `many=True` serializer over a reverse
+  foreign key, fetched with one `values()` query per page.
+
+Serializers with a field that can't be compiled (a `SerializerMethodField`,
+an unknown property, `source='*'`, a forward nested serializer) compile to
+None, and `CompiledReadMixin` falls back to the regular serializer.
+"""
+import decimal
+from collections import defaultdict
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.http import Http404
+from rest_framework import fields as drf_fields, relations, serializers
+from rest_framework.permissions import BasePermission
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+from api.models import OrderItem, Product
+
+NESTED_PREFIX = '__nested__'
+PROPERTY_PREFIX = '__property__'
+
+
+def _item_subtotals(rows):
+    """
+    OrderItem.item_subtotal of a batch of rows. Rows from before the
+    snapshot columns fall back to the live price, fetched in one query only
+    if there are any.
+    """
+    missing = {row['product'] for row in rows if row['unit_price'] is None}
+    prices = dict(Product.objects.filter(pk__in=missing).values_list('pk', 'price')) if missing else {}
+    subtotals = []
+    for row in rows:
+        price = row['unit_price'] if row['unit_price'] is not None else prices.get(row['product'])
+        subtotals.append(None if price is None else price * row['quantity'])
+    return subtotals
+
+
+# Model properties rendered by serializers: {(model, name): (columns,
+# function of a list of rows returning their values)}. Properties not
+# listed here aren't compiled.
+PROPERTIES = {
+    (OrderItem, 'item_subtotal'): (('unit_price', 'quantity', 'product'), _item_subtotals),
+}
+
+
+class CompiledSerializer:
+    def __init__(self, model):
+        self.model = model
+        self.columns = {model._meta.pk.name}
+        self.outputs = []  # (key, getter, converter)
+        self.properties = []  # (row key, function of the rows)
+        self.nested = []  # (key, CompiledSerializer, foreign key name)
+
+    def values(self, queryset, extra=()):
+        """
+        `queryset` as dict rows with the columns and annotations this
+        serializer needs, plus `extra` ones (e.g. the pagination ordering).
+        """
+        columns = self.columns | set(extra)
+        annotations = [name for name in columns if name in queryset.query.annotations]
+        columns = sorted(columns.difference(annotations)) + annotations
+        return queryset.prefetch_related(None).select_related(None).values(*columns)
+
+    def render(self, rows):
+        rows = list(rows)
+        for key, function in self.properties:
+            for row, value in zip(rows, function(rows)):
+                row[key] = value
+        for key, child, foreign_key in self.nested:
+            child.attach(rows, key, self.model._meta.pk.name, foreign_key)
+        return [self.render_row(row) for row in rows]
+
+    def render_row(self, row):
+        data = {}
+        for key, getter, convert in self.outputs:
+            value = getter(row)
+            data[key] = None if value is None else convert(value) if convert is not None else value
+        return data
+
+    def attach(self, parents, key, parent_pk, foreign_key):
+        """
+        Render the related rows of every parent row into `parent[key]`, with one query.
+        """
+        grouped = defaultdict(list)
+        ids = [parent[parent_pk] for parent in parents]
+        if ids:
+            queryset = self.model._default_manager.filter(**{f'{foreign_key}__in': ids})
+            queryset = queryset.order_by(*(self.model._meta.ordering or ['pk']))
+            rows = list(self.values(queryset, extra=(foreign_key,)))
+            for row, data in zip(rows, self.render(rows)):
+                grouped[row[foreign_key]].append(data)
+        for parent in parents:
+            parent[NESTED_PREFIX + key] = grouped.get(parent[parent_pk], [])
+
+
+def compile_serializer(serializer):
+    """
+    A CompiledSerializer rendering what `serializer` (a bound instance, so
+    per-request field changes and the context are honoured) renders, or
+    None if one of its fields can't be compiled.
+    """
+    if isinstance(serializer, serializers.ListSerializer):
+        serializer = serializer.child
+    model = getattr(getattr(serializer, 'Meta', None), 'model', None)
+    if model is None:
+        return None
+    compiled = CompiledSerializer(model)
+    for field in serializer._readable_fields:
+        if not _compile_field(compiled, model, field):
+            return None
+    return compiled
+
+
+def _compile_field(compiled, model, field):
+    key = field.field_name
+    if field.source == '*' or len(field.source_attrs) != 1:
+        return False
+    name = field.source_attrs[0]
+
+    if isinstance(field, serializers.ListSerializer):
+        return _compile_nested(compiled, model, key, name, field)
+    if isinstance(field, (serializers.BaseSerializer, drf_fields.SerializerMethodField, relations.ManyRelatedField)):
+        return False
+
+    try:
+        model_field = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        if name == 'pk':
+            model_field = model._meta.pk
+        elif (model, name) in PROPERTIES and type(field) is drf_fields.ReadOnlyField:
+            columns, function = PROPERTIES[(model, name)]
+            compiled.columns.update(columns)
+            compiled.properties.append((PROPERTY_PREFIX + name, function))
+            compiled.outputs.append((key, _getter(PROPERTY_PREFIX + name), None))
+            return True
+        else:
+            return False
+
+    if model_field.is_relation and not (model_field.many_to_one or model_field.one_to_one):
+        return False
+    if model_field.is_relation and not _is_plain_pk_field(field):
+        return False
+    column = model_field.name
+    compiled.columns.add(column)
+    compiled.outputs.append((key, _getter(column), _converter(field, model_field)))
+    return True
+
+
+def _compile_nested(compiled, model, key, name, field):
+    try:
+        model_field = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return False
+    if not model_field.one_to_many:
+        return False
+    child = compile_serializer(field.child)
+    if child is None:
+        return False
+    compiled.nested.append((key, child, model_field.field.name))
+    compiled.outputs.append((key, _getter(NESTED_PREFIX + key), None))
+    return True
+
+
+def _getter(column):
+    return lambda row: row[column]
+
+
+def _is_plain_pk_field(field):
+    return isinstance(field, relations.PrimaryKeyRelatedField) and field.pk_field is None
+
+
+def _converter(field, model_field):
+    """
+    A function of a non-None column value returning what
+    `field.to_representation` returns for it; None for the identity.
+    """
+    if _is_plain_pk_field(field):
+        return None
+    field_type = type(field)
+    if field_type is drf_fields.ReadOnlyField or (field_type is drf_fields.ModelField):
+        return None
+    if field_type is drf_fields.IntegerField:
+        return int
+    if field_type is drf_fields.CharField:
+        return str
+    if field_type is drf_fields.UUIDField and field.uuid_format == 'hex_verbose':
+        return str
+    if field_type is drf_fields.DecimalField:
+        return _decimal_converter(field)
+    if isinstance(field, drf_fields.FileField):
+        return _file_converter(field, model_field)
+    return field.to_representation
+
+
+def _decimal_converter(field):
+    coerce_to_string = getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING)
+    if field.localize or field.normalize_output or field.decimal_places is None:
+        return field.to_representation
+    exponent = decimal.Decimal('.1') ** field.decimal_places
+    context = decimal.getcontext().copy()
+    if field.max_digits is not None:
+        context.prec = field.max_digits
+    rounding = field.rounding
+
+    def convert(value):
+        if not isinstance(value, decimal.Decimal):
+            value = decimal.Decimal(str(value).strip())
+        quantized = value.quantize(exponent, rounding=rounding, context=context)
+        return f'{quantized:f}' if coerce_to_string else quantized
+    return convert
+
+
+def _file_converter(field, model_field):
+    use_url = getattr(field, 'use_url', api_settings.UPLOADED_FILES_USE_URL)
+    request = field.context.get('request')
+    storage = model_field.storage
+
+    def convert(name):
+        if not name:
+            return None
+        if not use_url:
+            return name
+        url = storage.url(name)
+        return request.build_absolute_uri(url) if request is not None else url
+    return convert
+
+
+class CompiledReadMixin:
+    """
+    Serve `list` and `retrieve` (and `compiled_actions`) from `.values()`
+    rows through the compiled serializer whenever it compiles; otherwise
+    the regular serializer renders as before.
+    """
+    compiled_actions = ('list', 'retrieve')
+
+    def get_compiled_serializer(self):
+        if self.action not in self.compiled_actions:
+            return None
+        if any(type(permission).has_object_permission is not BasePermission.has_object_permission
+               for permission in self.get_permissions()):
+            return None  # object permissions need instances
+        return compile_serializer(self.get_serializer())
+
+    def get_compiled_extra_columns(self, queryset):
+        """
+        Ordering columns the paginator reads from the page rows.
+        """
+        extra = {field.lstrip('-') for field in queryset.query.order_by if isinstance(field, str)}
+        ordering = getattr(self.paginator, 'ordering', None)
+        if isinstance(ordering, str):
+            extra.add(ordering.lstrip('-'))
+        tie_breaker = getattr(self.paginator, 'tie_breaker', None)
+        if tie_breaker:
+            extra.add(tie_breaker)
+        return extra
+
+    def compiled_list(self, compiled, queryset):
+        rows = compiled.values(queryset, extra=self.get_compiled_extra_columns(queryset))
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(compiled.render(page))
+        return Response(compiled.render(rows))
+
+    def list(self, request, *args, **kwargs):
+        compiled = self.get_compiled_serializer()
+        if compiled is None:
+            return super().list(request, *args, **kwargs)
+        return self.compiled_list(compiled, self.filter_queryset(self.get_queryset()))
+
+    def retrieve(self, request, *args, **kwargs):
+        compiled = self.get_compiled_serializer()
+        if compiled is None:
+            return super().retrieve(request, *args, **kwargs)
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        queryset = self.filter_queryset(self.get_queryset())
+        try:
+            rows = list(compiled.values(queryset.filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]}))[:2])
+        except (TypeError, ValueError, ValidationError):
+            raise Http404
+        if len(rows) != 1:
+            raise Http404
+        return Response(compiled.render(rows)[0])
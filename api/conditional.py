@@ -0,0 +1,93 @@
+"""
+Conditional GET support (ETag / Last-Modified) for DRF view methods.
+
+Validators are computed from cheap metadata only - the catalog version kept
+in the cache, or a row's `updated_at` - so a `304 Not Modified` is answered
+before the queryset is evaluated or anything is serialized.
+"""
+import hashlib
+from calendar import timegm
+from functools import wraps
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework import status
+
+from api.cache import catalog_cache_enabled, get_catalog_modified, get_catalog_version
+
+
+def conditional(get_validators):
+    """
+    Decorate a view method with conditional GET handling.
+
+    `get_validators(view, request, *args, **kwargs)` returns a pair
+    `(etag_source, last_modified)`; either may be None. It runs after DRF has
+    authenticated the request and checked view permissions, so it may scope
+    its lookups to the user.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            etag_source, last_modified = get_validators(view, request, *args, **kwargs)
+            etag = None
+            if etag_source is not None:
+                # The same data rendered as JSON or as the browsable API is a
+                # different representation, so the media type is part of it.
+                representation = f'{etag_source}|{request.accepted_media_type}|{request.get_full_path()}'
+                etag = quote_etag(hashlib.md5(representation.encode('utf-8')).hexdigest())
+            timestamp = timegm(last_modified.utctimetuple()) if last_modified else None
+
+            response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+            if response is None:
+                response = method(view, request, *args, **kwargs)
+
+            if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+                if etag and not response.has_header('ETag'):
+                    response.headers['ETag'] = etag
+                if timestamp and not response.has_header('Last-Modified'):
+                    response.headers['Last-Modified'] = http_date(timestamp)
+            return response
+        return wrapper
+    return decorator
+
+
+def catalog_validators(view, request, *args, **kwargs):
+    """
+    Any product or file write bumps the catalog version. Without a cache
+    shared by the workers they don't see each other's bumps: no validators.
+    """
+    if not catalog_cache_enabled():
+        return None, None
+    return get_catalog_version(), get_catalog_modified()
+
+
+def row_validators(view, request, *args, **kwargs):
+    """
+    The `updated_at` of the requested row, looked up in the view's (user
+    scoped) queryset through its filter backends, like `get_object`. Rows
+    it doesn't find, unknown or filtered out, get no validators and 404 as
+    usual.
+    """
+    lookup_url_kwarg = view.lookup_url_kwarg or view.lookup_field
+    try:
+        updated_at = view.filter_queryset(view.get_queryset()).filter(
+            **{view.lookup_field: kwargs[lookup_url_kwarg]}
+        ).values_list('updated_at', flat=True).first()
+    except (DjangoValidationError, ValueError):
+        return None, None
+    if updated_at is None:
+        return None, None
+    return updated_at.isoformat(), updated_at
+
+
+def order_list_validators(view, request, *args, **kwargs):
+    """
+    One aggregate over the user's orders: the count catches deletes, the
+    latest `updated_at` catches creates and updates.
+    """
+    summary = view.get_queryset().order_by().aggregate(count=Count('pk'), last_modified=Max('updated_at'))
+    last_modified = summary['last_modified']
+    return f"{summary['count']}|{last_modified and last_modified.isoformat()}", last_modified
+
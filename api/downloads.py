@@ -0,0 +1,205 @@
+"""
+File downloads with conditional requests, byte ranges and offloaded copying.
+
+`serve(request, field_file)` answers:
+
+- 304 / 412 for `If-None-Match` / `If-Modified-Since` / `If-Match`,
+- 206 with one byte range for `Range: bytes=...` (the whole file, 200, when
+  an `If-Range` validator no longer matches; 416 when unsatisfiable),
+- 200 with the whole file otherwise.
+
+Bodies are `FileResponse`s over the open file, so they are streamed in
+blocks and never read into memory as a whole. Under gunicorn the WSGI file
+wrapper hands the file descriptor and the range to `sendfile()`.
+
+With `DOWNLOADS['SENDFILE']` set, the response carries no body at all: the
+front server (Apache/lighttpd `X-Sendfile`, nginx `X-Accel-Redirect`)
+copies the file itself and handles `Range`. nginx needs an internal
+location mapping `ACCEL_REDIRECT_PREFIX` to MEDIA_ROOT:
+
+    location /protected-media/ { internal; alias /srv/shop/media/; }
+
+Settings, all optional:
+
+    DOWNLOADS = {
+        'SENDFILE': None,   # None, 'x-sendfile' or 'x-accel-redirect'
+        'ACCEL_REDIRECT_PREFIX': '/protected-media/',
+        'BLOCK_SIZE': 256 * 1024,
+    }
+"""
+import mimetypes
+import os
+import re
+from calendar import timegm
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe, quote_etag
+from rest_framework.negotiation import BaseContentNegotiation
+
+DEFAULTS = {
+    'SENDFILE': None,
+    'ACCEL_REDIRECT_PREFIX': '/protected-media/',
+    'BLOCK_SIZE': 256 * 1024,
+}
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'DOWNLOADS', {})}
+
+
+class AnyMediaTypeNegotiation(BaseContentNegotiation):
+    """
+    Downloads are files, not API representations: accept any `Accept`
+    header instead of answering 406, and render errors with the first
+    renderer.
+    """
+
+    def select_parser(self, request, parsers):
+        return parsers[0] if parsers else None
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
+
+
+class RangeFile:
+    """
+    `length` bytes of `file` starting at `start`. Keeps `fileno()`, so WSGI
+    servers can still sendfile() the range from the current position.
+    """
+
+    def __init__(self, file, start, length):
+        file.seek(start)
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        size = self.remaining if size is None or size < 0 else min(size, self.remaining)
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def validators(field_file, digest=''):
+    """
+    (ETag, Last-Modified timestamp, size) of a stored file. Content-addressed
+    files use their hash as a strong ETag; others one of size and mtime.
+    """
+    storage = field_file.storage
+    try:
+        stat = os.stat(storage.path(field_file.name))
+        size, modified = stat.st_size, int(stat.st_mtime)
+        fallback = f'{stat.st_size:x}-{stat.st_mtime_ns:x}'
+    except NotImplementedError:
+        size = storage.size(field_file.name)
+        modified = timegm(storage.get_modified_time(field_file.name).utctimetuple())
+        fallback = f'{size:x}-{modified:x}'
+    return quote_etag(digest or fallback), modified, size
+
+
+def parse_range(header, size):
+    """
+    (start, end) of a single `bytes=` range, inclusive; None to ignore the
+    header (missing, malformed or several ranges); ValueError when it can't
+    be satisfied.
+    """
+    match = RANGE_RE.match(header or '')
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if not length or not size:
+            raise ValueError(header)
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError(header)
+    return start, end
+
+
+def serve(request, field_file, digest=''):
+    if not field_file:
+        raise Http404('No file.')
+    try:
+        etag, modified, size = validators(field_file, digest)
+    except FileNotFoundError:
+        raise Http404('The file is missing from storage.')
+    response = get_conditional_response(request, etag=etag, last_modified=modified)
+    if response is None:
+        response = _file_response(request, field_file, etag, modified, size)
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = http_date(modified)
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def _file_response(request, field_file, etag, modified, size):
+    filename = os.path.basename(field_file.name)
+    byte_range = None
+    if request.method == 'GET' and _if_range_matches(request, etag, modified):
+        try:
+            byte_range = parse_range(request.headers.get('Range'), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response.headers['Content-Range'] = f'bytes */{size}'
+            return response
+
+    config = get_config()
+    if config['SENDFILE']:
+        return _sendfile_response(config, field_file, filename)
+
+    file = field_file.storage.open(field_file.name, 'rb')
+    if byte_range is None:
+        response = FileResponse(file, as_attachment=True, filename=filename)
+    else:
+        start, end = byte_range
+        response = FileResponse(RangeFile(file, start, end - start + 1), as_attachment=True, filename=filename,
+                                status=206)
+        response.headers['Content-Length'] = end - start + 1
+        response.headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response.block_size = config['BLOCK_SIZE']
+    return response
+
+
+def _sendfile_response(config, field_file, filename):
+    # Streaming, so no Content-Length: 0 is added for the empty body
+    response = StreamingHttpResponse(iter(()), content_type=mimetypes.guess_type(filename)[0]
+                                     or 'application/octet-stream')
+    response.headers['Content-Disposition'] = content_disposition_header(True, filename)
+    if config['SENDFILE'] == 'x-accel-redirect':
+        response.headers['X-Accel-Redirect'] = config['ACCEL_REDIRECT_PREFIX'] + quote(field_file.name)
+    else:
+        response.headers['X-Sendfile'] = field_file.storage.path(field_file.name)
+    return response
+
+
+def _if_range_matches(request, etag, modified):
+    """
+    A Range applies only while the `If-Range` validator, if any, still
+    matches; an entity tag has to match strongly.
+    """
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == modified
@@ -0,0 +1,43 @@
+from django.http import StreamingHttpResponse
+from rest_framework.decorators import action
+
+from api.renderers import FastJSONRenderer
+
+
+def ndjson_rows(queryset, serializer_class, context=None, chunk_size=2000):
+    """
+    Yield one serialized JSON document per row, newline-terminated.
+
+    `iterator()` pulls rows from a server-side cursor `chunk_size` at a time
+    and runs the queryset's `prefetch_related` lookups once per chunk, so
+    memory stays bounded by the chunk rather than by the table.
+    """
+    renderer = FastJSONRenderer()
+    for instance in queryset.iterator(chunk_size=chunk_size):
+        data = serializer_class(instance, context=context).data
+        yield renderer.render(data) + b'\n'
+
+
+class NDJSONExportMixin:
+    """
+    Adds a `GET .../export/` action streaming the filtered queryset as
+    newline-delimited JSON, bypassing pagination and the in-memory list
+    DRF builds for `many=True` serializers.
+    """
+    export_chunk_size = 2000
+    export_filename = 'export.ndjson'
+
+    def get_export_queryset(self):
+        return self.filter_queryset(self.get_queryset())
+
+    @action(detail=False, methods=['get'], url_path='export')
+    def export(self, request, *args, **kwargs):
+        rows = ndjson_rows(
+            self.get_export_queryset(),
+            self.get_serializer_class(),
+            context=self.get_serializer_context(),
+            chunk_size=self.export_chunk_size,
+        )
+        response = StreamingHttpResponse(rows, content_type='application/x-ndjson')
+        response['Content-Disposition'] = f'attachment; filename="{self.export_filename}"'
+        return response
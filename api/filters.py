@@ -1,6 +1,7 @@
 import django_filters
 from api.models import Product, Order
 from rest_framework import filters
+from api import search
 
 class ProductFilter(django_filters.FilterSet):
     class Meta:
@@ -11,6 +12,34 @@ class ProductFilter(django_filters.FilterSet):
         }
 
 
+class FullTextSearchFilter(filters.SearchFilter):
+    """
+    Drop-in replacement for SearchFilter backed by the product full-text index
+    (see api/search.py). Matches are annotated with `search_rank` and ordered
+    by relevance unless the client asks for another ordering.
+
+    The index always matches `search.INDEXED_FIELDS` together, so it is only
+    used when the view's `search_fields` are exactly those fields without a
+    lookup prefix (`=`, `^`, `$`, `@`). Other views, and engines without an
+    index, get SearchFilter's plain search.
+    """
+    def filter_queryset(self, request, queryset, view):
+        backend = search.get_backend()
+        search_fields = self.get_search_fields(view, request)
+        if backend is None or not self.uses_index(queryset, search_fields):
+            return super().filter_queryset(request, queryset, view)
+
+        tokens = search.tokenize(self.get_search_terms(request))
+        if not tokens:
+            return queryset
+
+        return backend.search(queryset, tokens).order_by('search_rank')
+
+    def uses_index(self, queryset, search_fields):
+        return (queryset.model is Product and search_fields is not None
+                and sorted(search_fields) == sorted(search.INDEXED_FIELDS))
+
+
 class InStockFilterBackend(filters.BaseFilterBackend):
     def filter_queryset(self, request, queryset, view): 
         return queryset.filter(stock__gt=0)
@@ -0,0 +1,203 @@
+"""
+Resized and re-encoded variants of uploaded images.
+
+After a product image or an image file is saved, the originals are rendered
+into the VARIANTS below in a process pool, off the request thread and
+outside the GIL. The rendering function only needs Pillow, so pool workers
+never set Django up. When a render finishes, the variants are written to
+the default storage and their paths recorded on the row (`variants` /
+`image_variants`) with a conditional UPDATE, so a newer upload is never
+overwritten by an older render.
+
+Settings, all optional:
+
+    IMAGE_PIPELINE = {
+        'WORKERS': 2,     # pool processes
+        'EAGER': False,   # render inline, for tests and management commands
+    }
+"""
+import io
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# name: (bounding box, Pillow format, file extension, save options)
+VARIANTS = {
+    'thumbnail': ((200, 200), 'JPEG', 'jpg', {'quality': 80, 'optimize': True}),
+    'medium': ((800, 800), 'JPEG', 'jpg', {'quality': 85, 'optimize': True, 'progressive': True}),
+    'webp': ((800, 800), 'WEBP', 'webp', {'quality': 80, 'method': 4}),
+}
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff'}
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = set()
+
+
+def render_variants(source):
+    """
+    Render every variant of `source` (a path or the image bytes) and return
+    {name: encoded bytes}. Runs in the pool workers.
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    with Image.open(source) as original:
+        original = ImageOps.exif_transpose(original)
+        rendered = {}
+        for name, (size, image_format, _, options) in VARIANTS.items():
+            image = original.copy()
+            image.thumbnail(size, Image.LANCZOS)
+            if image_format == 'JPEG' and image.mode != 'RGB':
+                image = image.convert('RGB')
+            output = io.BytesIO()
+            image.save(output, image_format, **options)
+            rendered[name] = output.getvalue()
+    return rendered
+
+
+def variant_path(source_name, variant):
+    stem, _ = os.path.splitext(source_name)
+    return f'variants/{stem}/{variant}.{VARIANTS[variant][2]}'
+
+
+def is_image(name):
+    return bool(name) and os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+
+def get_config():
+    from django.conf import settings
+    return {'WORKERS': 2, 'EAGER': False, **getattr(settings, 'IMAGE_PIPELINE', {})}
+
+
+def schedule(instance, file_field, variants_field):
+    """
+    Queue the variants of `instance.<file_field>` for rendering, unless they
+    are already recorded for the current file.
+    """
+    field_file = getattr(instance, file_field)
+    variants = getattr(instance, variants_field) or {}
+    if not is_image(field_file.name) or variants.get('source') == field_file.name:
+        return
+
+    job = partial(store_variants, type(instance), instance.pk, file_field, variants_field, field_file.name)
+    try:
+        # Local files are read by the worker itself, remote ones are sent over.
+        source = field_file.path
+    except NotImplementedError:
+        with field_file.open('rb') as opened:
+            source = opened.read()
+
+    if get_config()['EAGER']:
+        try:
+            job(render_variants(source))
+        except Exception:
+            logger.exception('Rendering image variants of %s failed', field_file.name)
+        return
+
+    future = get_executor().submit(render_variants, source)
+    _pending.add(future)
+    future.add_done_callback(partial(_finish, job))
+
+
+def store_variants(model, pk, file_field, variants_field, source_name, rendered):
+    """
+    Write rendered variants and record them on the row, if it still holds
+    the same file. Variants of an earlier file are removed.
+    """
+    from django.core.files.base import ContentFile
+    from django.core.files.storage import default_storage
+
+    paths = {}
+    for name, content in rendered.items():
+        path = variant_path(source_name, name)
+        default_storage.delete(path)
+        paths[name] = default_storage.save(path, ContentFile(content))
+
+    previous = model.objects.filter(pk=pk).values_list(variants_field, flat=True).first()
+    updated = model.objects.filter(pk=pk, **{file_field: source_name}).update(
+        **{variants_field: {'source': source_name, **paths}}
+    )
+    if not updated:
+        # Deleted or replaced while rendering
+        delete_variants(paths)
+        return
+    if previous and previous.get('source') != source_name:
+        delete_variants(previous)
+    _variants_changed(model, pk)
+
+
+def delete_variants(variants):
+    """
+    Remove variant files, unless another row still holds their source: rows
+    with the same content share one stored file (api/uploads.py).
+    """
+    from django.core.files.storage import default_storage
+    from api.models import Files, Product
+
+    source = (variants or {}).get('source')
+    if source and (Files.objects.filter(file=source).exists() or Product.objects.filter(image=source).exists()):
+        return
+    for name, path in (variants or {}).items():
+        if name != 'source':
+            default_storage.delete(path)
+
+
+def wait(timeout=None):
+    """
+    Block until every queued render has been stored (or `timeout` passes).
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while _pending and (deadline is None or time.monotonic() < deadline):
+        time.sleep(0.01)
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                # spawn: forking a threaded server process is not safe
+                _executor = ProcessPoolExecutor(
+                    max_workers=get_config()['WORKERS'], mp_context=multiprocessing.get_context('spawn'),
+                )
+    return _executor
+
+
+def _finish(job, future):
+    from django.db import connection
+
+    try:
+        job(future.result())
+    except Exception:
+        logger.exception('Rendering image variants failed')
+    finally:
+        # Callbacks run on the pool's management thread, outside any request.
+        connection.close()
+        _pending.discard(future)
+
+
+def _variants_changed(model, pk):
+    """
+    Variants are part of the catalog representation: bump the cache version
+    and the `updated_at` validators like the model signals would.
+    """
+    from django.utils import timezone
+    from api.cache import invalidate_catalog
+    from api.models import Files, Product
+
+    now = timezone.now()
+    if model is Files:
+        product_id = Files.objects.filter(pk=pk).values_list('product_id', flat=True).first()
+        if product_id is not None:
+            Product.objects.filter(pk=product_id).update(updated_at=now)
+    else:
+        Product.objects.filter(pk=pk).update(updated_at=now)
+    invalidate_catalog()
@@ -0,0 +1,239 @@
+"""
+Load-test runner for the call flows documented in api.http.
+
+Each virtual user is a thread with its own keep-alive connection and JWT
+pair. It logs in once, refreshes its access token on a 401, and keeps
+picking a scenario by weight until the run is over. Every request is
+recorded under a route template (`GET /products/{id}/`) so the report shows
+throughput, latency percentiles and error rate per endpoint.
+
+Only the standard library is used, so the runner works against any server
+(runserver, gunicorn `shop.wsgi`, uvicorn `shop.asgi`) without extra packages.
+"""
+import http.client
+import json
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+DEFAULT_WEIGHTS = {
+    'browse': 60,
+    'search': 10,
+    'my_orders': 10,
+    'order_cancel': 8,
+    'order_purchase': 7,
+    'token_refresh': 3,
+    'admin_catalog': 2,
+}
+
+
+class Stats:
+    """
+    Latencies and outcomes per endpoint, shared by all virtual users.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def record(self, endpoint, status, elapsed, ok):
+        with self._lock:
+            self.latencies[endpoint].append(elapsed)
+            self.statuses[endpoint][status] += 1
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def report(self, duration):
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            endpoints[endpoint] = {
+                'requests': len(latencies),
+                'throughput': round(len(latencies) / duration, 2),
+                'error_rate': round(self.errors[endpoint] / len(latencies), 4),
+                'p50_ms': percentile(latencies, 50),
+                'p95_ms': percentile(latencies, 95),
+                'p99_ms': percentile(latencies, 99),
+                'statuses': {str(code): count for code, count in sorted(self.statuses[endpoint].items())},
+            }
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        errors = sum(self.errors.values())
+        everything = sorted(latency for latencies in self.latencies.values() for latency in latencies)
+        return {
+            'duration_s': round(duration, 2),
+            'requests': total,
+            'throughput': round(total / duration, 2) if duration else 0,
+            'error_rate': round(errors / total, 4) if total else 0,
+            'p50_ms': percentile(everything, 50),
+            'p95_ms': percentile(everything, 95),
+            'p99_ms': percentile(everything, 99),
+            'endpoints': endpoints,
+        }
+
+
+def percentile(sorted_values, p):
+    """
+    Nearest-rank percentile of an ascending list of seconds, in milliseconds.
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return round(sorted_values[rank - 1] * 1000, 2)
+
+
+class VirtualUser:
+    def __init__(self, base_url, username, password, stats, admin=None, rng=None):
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.host_header = parts.netloc
+        self.username, self.password = username, password
+        self.admin = admin
+        self.stats = stats
+        self.rng = rng or random.Random()
+        self.connection = None
+        self.access = self.refresh = None
+        self.product_ids = []
+
+    def request(self, method, path, endpoint, body=None, token=True, expected=(200, 201, 204), retry=True):
+        """
+        Send one request and record it; returns (status, decoded JSON or None).
+        """
+        headers = {'Host': self.host_header, 'Accept': 'application/json'}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        if token and self.access:
+            headers['Authorization'] = f'Bearer {self.access}'
+
+        started = time.perf_counter()
+        try:
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            self.connection.request(method, path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            payload = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            self.connection = None
+            self.stats.record(endpoint, 'connection-error', time.perf_counter() - started, ok=False)
+            return None, None
+        self.stats.record(endpoint, status, time.perf_counter() - started, ok=status in expected)
+
+        if status == 401 and token and retry and self.refresh_token():
+            return self.request(method, path, endpoint, body and json.loads(body), token, expected, retry=False)
+        try:
+            return status, json.loads(payload) if payload else None
+        except ValueError:
+            return status, None
+
+    def login(self):
+        status, data = self.request('POST', '/api/token/', 'POST /api/token/',
+                                    {'username': self.username, 'password': self.password}, token=False)
+        if status != 200:
+            return False
+        self.access, self.refresh = data['access'], data['refresh']
+        return True
+
+    def refresh_token(self):
+        status, data = self.request('POST', '/api/token/refresh/', 'POST /api/token/refresh/',
+                                    {'refresh': self.refresh}, token=False)
+        if status != 200:
+            return self.login()
+        self.access = data['access']
+        return True
+
+    # Scenarios, following api.http
+
+    def browse(self):
+        status, data = self.request('GET', '/products/', 'GET /products/')
+        if status == 200 and data.get('results'):
+            self.product_ids = [product['id'] for product in data['results']]
+            product_id = self.rng.choice(self.product_ids)
+            self.request('GET', f'/products/{product_id}/', 'GET /products/{id}/')
+            self.request('GET', f'/products/{product_id}/files/', 'GET /products/{id}/files/')
+
+    def search(self):
+        term = self.rng.choice(['lorem', 'ipsum', 'dolor', 'amet', 'magnam', 'quia'])
+        self.request('GET', f'/products/?search={term}', 'GET /products/?search=')
+        self.request('GET', '/products/?ordering=-price', 'GET /products/?ordering=')
+
+    def my_orders(self):
+        self.request('GET', '/orders/user-orders/', 'GET /orders/user-orders/')
+        self.request('GET', '/orders/', 'GET /orders/')
+
+    def order_cancel(self):
+        order_id = self.create_order()
+        if order_id:
+            self.request('GET', f'/orders/{order_id}/', 'GET /orders/{id}/')
+            self.request('POST', f'/orders/{order_id}/cancel/', 'POST /orders/{id}/cancel/')
+
+    def order_purchase(self):
+        order_id = self.create_order()
+        if order_id:
+            self.request('POST', f'/orders/{order_id}/purchase/', 'POST /orders/{id}/purchase/')
+            # Users may hold one order at a time; clean up like api.http does.
+            self.request('DELETE', f'/orders/{order_id}/', 'DELETE /orders/{id}/')
+
+    def token_refresh(self):
+        self.refresh_token()
+
+    def admin_catalog(self):
+        if self.admin is None:
+            return
+        admin = self.admin
+        product = {'name': 'Load test product', 'description': 'Created by loadtest.', 'price': 19.99, 'stock': 100}
+        status, data = admin.request('POST', '/products/', 'POST /products/', product)
+        if status == 201:
+            product_id = data['id']
+            admin.request('PUT', f'/products/{product_id}/', 'PUT /products/{id}/', dict(product, stock=102))
+            admin.request('DELETE', f'/products/{product_id}/', 'DELETE /products/{id}/')
+
+    def create_order(self):
+        if not self.product_ids:
+            self.browse()
+        if not self.product_ids:
+            return None
+        items = [{'product': product_id, 'quantity': 1}
+                 for product_id in self.rng.sample(self.product_ids, min(2, len(self.product_ids)))]
+        status, data = self.request('POST', '/orders/', 'POST /orders/', {'status': 'Pending', 'items': items})
+        return data['order_id'] if status == 201 else None
+
+
+def run(base_url, credentials, concurrency, duration, weights=None, admin_credentials=None, seed=None):
+    """
+    Run `concurrency` virtual users for `duration` seconds and return the
+    report. `credentials` is a list of (username, password), one per virtual
+    user.
+    """
+    weights = weights or DEFAULT_WEIGHTS
+    scenarios, scenario_weights = zip(*weights.items())
+    stats = Stats()
+    generator = random.Random(seed)
+    seeds = [generator.random() for _ in range(concurrency)]
+    deadline = time.monotonic() + duration
+
+    def virtual_user(index):
+        rng = random.Random(seeds[index])
+        username, password = credentials[index]
+        admin = None
+        if admin_credentials:
+            admin = VirtualUser(base_url, *admin_credentials, stats, rng=rng)
+            admin.login()
+        user = VirtualUser(base_url, username, password, stats, admin=admin, rng=rng)
+        if not user.login():
+            return
+        while time.monotonic() < deadline:
+            getattr(user, rng.choices(scenarios, weights=scenario_weights)[0])()
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=virtual_user, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats.report(time.monotonic() - started)
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import DecimalField, ExpressionWrapper, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from api.models import Product, Order, OrderItem
+
+
+class Command(BaseCommand):
+    help = 'Snapshots product name/price onto order items and fills Order.total_price'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Rows updated per transaction')
+        parser.add_argument('--all', action='store_true',
+                            help='Recompute every order total, not only the missing ones')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        # Items: one UPDATE ... SET unit_price = (SELECT price ...) per batch of ids
+        product = Product.objects.filter(pk=OuterRef('product_id'))
+        items = OrderItem.objects.filter(unit_price__isnull=True)
+        updated = self.update_in_batches(items, batch_size, unit_price=Subquery(product.values('price')[:1]),
+                                         product_name=Subquery(product.values('name')[:1]))
+        self.stdout.write(f'Snapshotted {updated} order items.')
+
+        # Orders: total = SUM(unit_price * quantity) over the order's items
+        subtotal = ExpressionWrapper(F('unit_price') * F('quantity'),
+                                     output_field=DecimalField(max_digits=10, decimal_places=2))
+        totals = (OrderItem.objects.filter(order=OuterRef('pk'))
+                  .order_by().values('order').annotate(total=Sum(subtotal)).values('total'))
+        orders = Order.objects.all() if options['all'] else Order.objects.filter(total_price__isnull=True)
+        updated = self.update_in_batches(orders, batch_size, total_price=Coalesce(
+            Subquery(totals), Value(0), output_field=DecimalField(max_digits=10, decimal_places=2)))
+        self.stdout.write(self.style.SUCCESS(f'Filled the total price of {updated} orders.'))
+
+    def update_in_batches(self, queryset, batch_size, **values):
+        """
+        Walk the primary keys in short transactions so a large backfill never
+        holds a long write lock.
+        """
+        updated = 0
+        pks = queryset.order_by('pk').values_list('pk', flat=True)
+        last_pk = None
+        while True:
+            batch = pks.filter(pk__gt=last_pk) if last_pk is not None else pks
+            batch = list(batch[:batch_size])
+            if not batch:
+                return updated
+            with transaction.atomic():
+                updated += queryset.model.objects.filter(pk__in=batch).update(**values)
+            last_pk = batch[-1]
@@ -0,0 +1,50 @@
+import gzip
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+from api import renderers
+from api.models import Order
+from api.serializers import OrderSerializer
+
+
+class Command(BaseCommand):
+    help = ('Compares encode time and payload size of the JSON, orjson and MessagePack renderers on '
+            'OrderSerializer output (run populate_db first)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=1000, help='Orders to serialize')
+        parser.add_argument('--repeat', type=int, default=20, help='Encodes per renderer; the median is reported')
+
+    def handle(self, *args, **options):
+        orders = Order.objects.prefetch_related('items').order_by('pk')[:options['orders']]
+        data = OrderSerializer(orders, many=True).data
+        if not data:
+            raise CommandError('No orders to serialize; run populate_db first.')
+
+        candidates = [('json (stdlib)', JSONRenderer())]
+        if renderers.orjson is not None:
+            candidates.append(('json (orjson)', renderers.FastJSONRenderer()))
+        if renderers.msgpack is not None:
+            candidates.append(('msgpack', renderers.MessagePackRenderer()))
+
+        self.stdout.write(f'{len(data)} orders, median of {options["repeat"]} encodes')
+        row = '{:<14} {:>10} {:>8} {:>11} {:>11}'
+        self.stdout.write(row.format('renderer', 'encode ms', 'speedup', 'bytes', 'gzip bytes'))
+        baseline = None
+        for name, renderer in candidates:
+            elapsed, payload = self.encode(renderer, data, options['repeat'])
+            baseline = baseline or elapsed
+            self.stdout.write(row.format(name, f'{elapsed * 1000:.2f}', f'{baseline / elapsed:.1f}x', len(payload),
+                                         len(gzip.compress(payload))))
+        if len(candidates) < 3:
+            self.stdout.write('Install orjson and msgpack to compare all renderers.')
+
+    def encode(self, renderer, data, repeat):
+        timings = []
+        for _ in range(max(repeat, 1)):
+            started = time.perf_counter()
+            payload = renderer.render(data)
+            timings.append(time.perf_counter() - started)
+        return statistics.median(timings), payload
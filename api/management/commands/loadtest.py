@@ -0,0 +1,81 @@
+import json
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from api import loadtest
+from api.models import Order, User
+
+
+class Command(BaseCommand):
+    help = ('Replays the api.http call flows against a running server with weighted scenarios and '
+            'reports throughput, p50/p95/p99 latency and error rate per endpoint')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help='Base URL of the server under test')
+        parser.add_argument('--concurrency', type=int, default=10, help='Virtual users')
+        parser.add_argument('--duration', type=float, default=30, help='Seconds to run')
+        parser.add_argument('--user-prefix', default='loadtest',
+                            help='Virtual user i logs in as <prefix><i>; missing accounts are created')
+        parser.add_argument('--password', default='password123', help='Password of the virtual users')
+        parser.add_argument('--admin', default='admin:test',
+                            help='username:password for the admin_catalog scenario, empty to skip it')
+        parser.add_argument('--weights', default='',
+                            help='Scenario weights, e.g. browse=80,order_cancel=20 (default: %s)'
+                                 % ','.join(f'{k}={v}' for k, v in loadtest.DEFAULT_WEIGHTS.items()))
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--json', dest='json_path', default=None, help='Also write the report to this file')
+
+    def handle(self, *args, **options):
+        weights = self.parse_weights(options['weights'])
+        usernames = self.virtual_usernames(options['user_prefix'], options['password'], options['concurrency'])
+        credentials = [(username, options['password']) for username in usernames]
+        admin = tuple(options['admin'].split(':', 1)) if options['admin'] else None
+        if admin is None:
+            weights.pop('admin_catalog', None)
+
+        self.stdout.write(f"{options['concurrency']} virtual users against {options['url']} "
+                          f"for {options['duration']:g}s...")
+        report = loadtest.run(options['url'], credentials, options['concurrency'], options['duration'],
+                              weights=weights, admin_credentials=admin, seed=options['seed'])
+        if not report['requests']:
+            raise CommandError('No requests were made; is the server running and can the virtual users log in?')
+
+        self.write_report(report)
+        if options['json_path']:
+            with open(options['json_path'], 'w') as report_file:
+                json.dump(report, report_file, indent=2)
+
+    def parse_weights(self, value):
+        if not value:
+            return dict(loadtest.DEFAULT_WEIGHTS)
+        weights = {}
+        for part in value.split(','):
+            name, _, weight = part.partition('=')
+            if name not in loadtest.DEFAULT_WEIGHTS or not weight.isdigit():
+                raise CommandError(f'Invalid scenario weight "{part}". Scenarios: '
+                                   + ', '.join(loadtest.DEFAULT_WEIGHTS))
+            weights[name] = int(weight)
+        return weights
+
+    def virtual_usernames(self, prefix, password, count):
+        """
+        One account per virtual user, created if missing: users may hold one
+        order at a time, so accounts can't be shared, and orders left over
+        from an earlier run are removed.
+        """
+        usernames = [f'{prefix}{i}' for i in range(count)]
+        existing = set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+        hashed = make_password(password)
+        User.objects.bulk_create([User(username=username, password=hashed)
+                                  for username in usernames if username not in existing])
+        Order.objects.filter(user__username__in=usernames).delete()
+        return usernames
+
+    def write_report(self, report):
+        row = '{:<34} {:>8} {:>8} {:>8} {:>8} {:>8} {:>7}'
+        self.stdout.write(row.format('endpoint', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+        for endpoint, stats in report['endpoints'].items():
+            self.stdout.write(row.format(endpoint, stats['requests'], stats['throughput'], stats['p50_ms'],
+                                         stats['p95_ms'], stats['p99_ms'], f"{stats['error_rate']:.1%}"))
+        self.stdout.write(row.format('total', report['requests'], report['throughput'], report['p50_ms'],
+                                     report['p95_ms'], report['p99_ms'], f"{report['error_rate']:.1%}"))
@@ -1,19 +1,67 @@
+import itertools
+import multiprocessing
+import uuid
 import random
+import time
+from datetime import timedelta
 from decimal import Decimal
 
-from django.core.management.base import BaseCommand
-from django.utils import lorem_ipsum
-from api.models import User, Product, Order, OrderItem
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router, transaction
+from django.utils import lorem_ipsum, timezone
+from api.cache import bump_catalog_version
+from api.models import User, Product, Order, OrderItem, Files
+
+# Popularity skew: the n-th most popular product is ordered ~1/n^s as often
+# as the first one. Buyers are skewed too, but less.
+PRODUCT_ZIPF_EXPONENT = 1.1
+USER_ZIPF_EXPONENT = 0.8
+
+STATUS_WEIGHTS = {
+    Order.StatusChoices.COMPLETED: 60,
+    Order.StatusChoices.PENDING: 15,
+    Order.StatusChoices.CONFIRMED: 15,
+    Order.StatusChoices.CANCELLED: 10,
+}
+QUANTITY_WEIGHTS = {1: 70, 2: 18, 3: 7, 4: 3, 5: 2}
+
 
 class Command(BaseCommand):
-    help = 'Creates application data'
+    help = 'Creates application data; with --users/--products/--orders, a synthetic data set of that size'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=0, help='Synthetic users to create')
+        parser.add_argument('--products', type=int, default=0, help='Synthetic products to create')
+        parser.add_argument('--orders', type=int, default=0, help='Synthetic orders to create')
+        parser.add_argument('--items-per-order', type=int, default=3, help='Average order items per order')
+        parser.add_argument('--files', type=int, default=0, help='File rows per synthetic product')
+        parser.add_argument('--days', type=int, default=365, help='Spread order dates over this many days')
+        parser.add_argument('--seed', type=int, default=None, help='Random seed, for reproducible data sets')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows per bulk INSERT transaction')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Processes generating orders in parallel (useful on PostgreSQL)')
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
 
-    def handle(self, *args, **kwargs):
         # get or create superuser
         user = User.objects.filter(username='admin').first()
         if not user:
             user = User.objects.create_superuser(username='admin', password='test')
 
+        if options['users'] or options['products'] or options['orders']:
+            self.create_synthetic_data(options)
+        else:
+            self.create_demo_data(user)
+
+        # bulk_create skips the post_save signals that maintain the search index, catalog stats and cache
+        call_command('rebuild_search_index', stdout=self.stdout)
+        call_command('reconcile_catalog_stats', stdout=self.stdout)
+        bump_catalog_version()
+
+    def create_demo_data(self, user):
         # create products - name, desc, price, stock, image
         products = [
             Product(name="A Scanner Darkly", description=lorem_ipsum.paragraph(), price=Decimal('12.99'), stock=4),
@@ -26,14 +74,189 @@ class Command(BaseCommand):
 
         # create products & re-fetch from DB
         Product.objects.bulk_create(products)
-        products = Product.objects.all()
-
+        products = list(Product.objects.all())
 
-        # create some dummy orders tied to the superuser
+        # create some dummy orders tied to the superuser, each with 2 order items
+        orders, items = [], []
         for _ in range(3):
-            # create an Order with 2 order items
-            order = Order.objects.create(user=user)
-            for product in random.sample(list(products), 2):
-                OrderItem.objects.create(
-                    order=order, product=product, quantity=random.randint(1,3)
-                )
\ No newline at end of file
+            order = Order(user=user, total_price=0)
+            for product in random.sample(products, 2):
+                item = OrderItem(order=order, product=product, product_name=product.name,
+                                 unit_price=product.price, quantity=random.randint(1, 3))
+                order.total_price += item.item_subtotal
+                items.append(item)
+            orders.append(order)
+        Order.objects.bulk_create(orders)
+        OrderItem.objects.bulk_create(items)
+
+    def create_synthetic_data(self, options):
+        batch_size = options['batch_size']
+        started = time.monotonic()
+
+        created = create_users(options['users'], batch_size)
+        self.stdout.write(f'Created {created} users.')
+        created = create_products(options['products'], options['files'], batch_size)
+        self.stdout.write(f'Created {created} products.')
+
+        if options['orders']:
+            generator = OrderGenerator(options)
+            orders, items = generator.run(options['orders'], options['workers'], options['seed'])
+            self.stdout.write(f'Created {orders} orders with {items} items.')
+
+        self.stdout.write(self.style.SUCCESS(f'Synthetic data created in {time.monotonic() - started:.1f}s.'))
+
+
+def create_users(count, batch_size):
+    # Hashing is deliberately slow; every synthetic user shares one hash.
+    password = make_password('password123')
+    start = next_user_suffix()
+    users = (User(username=f'user{start + i}', email=f'user{start + i}@example.com', password=password)
+             for i in range(count))
+    return bulk_insert(User, users, batch_size)
+
+
+def next_user_suffix():
+    # Past the highest existing user<N>, not the user count: once a user has
+    # been deleted the count would hand out a name that is already taken.
+    usernames = User.objects.filter(username__regex=r'^user[0-9]+$').values_list('username', flat=True)
+    suffixes = [int(username[len('user'):]) for username in usernames]
+    return max(suffixes, default=-1) + 1
+
+
+def create_products(count, files_per_product, batch_size):
+    words = list(lorem_ipsum.WORDS)
+    created = 0
+    for offset in range(0, count, batch_size):
+        products = []
+        for _ in range(min(batch_size, count - offset)):
+            name = ' '.join(random.sample(words, 2)).title()
+            products.append(Product(
+                name=f'{name} {random.randint(100, 999)}',
+                description=lorem_ipsum.words(random.randint(8, 40), common=False),
+                # Most products are cheap, a few are very expensive.
+                price=Decimal(max(0.5, random.lognormvariate(3, 1))).quantize(Decimal('0.01')),
+                stock=int(random.expovariate(1 / 50)),
+            ))
+        with transaction.atomic():
+            Product.objects.bulk_create(products)
+            if files_per_product:
+                Files.objects.bulk_create([
+                    Files(product=product, file=f'uploads/synthetic/{product.pk}-{i}.jpg')
+                    for product in products for i in range(files_per_product)
+                ])
+        created += len(products)
+    return created
+
+
+def bulk_insert(model, objects, batch_size):
+    created = 0
+    while True:
+        batch = list(itertools.islice(objects, batch_size))
+        if not batch:
+            return created
+        with transaction.atomic():
+            model.objects.bulk_create(batch)
+        created += len(batch)
+
+
+def insert_rows(model, field_names, rows):
+    """
+    One executemany() INSERT of value tuples already adapted for the
+    database. Skips the per-instance work of bulk_create, which dominates
+    at millions of rows.
+    """
+    connection = connections[router.db_for_write(model)]
+    quote = connection.ops.quote_name
+    columns = ', '.join(quote(model._meta.get_field(name).column) for name in field_names)
+    placeholders = ', '.join(['%s'] * len(field_names))
+    with connection.cursor() as cursor:
+        cursor.executemany(f'INSERT INTO {quote(model._meta.db_table)} ({columns}) VALUES ({placeholders})', rows)
+
+
+def zipf_cum_weights(n, exponent):
+    weights = itertools.accumulate(1 / rank ** exponent for rank in range(1, n + 1))
+    return list(weights)
+
+
+class OrderGenerator:
+    """
+    Generates orders and their items in batches of `batch_size` orders, so
+    memory stays bounded by one batch. Only product ids, names and prices are
+    kept in memory for the whole run. Rows are written as plain tuples, with
+    the name/price snapshot and order total filled in as the API would.
+    """
+
+    def __init__(self, options):
+        self.batch_size = options['batch_size']
+        self.items_per_order = max(1, options['items_per_order'])
+        self.days = options['days']
+        self.now = timezone.now()
+
+        products = list(Product.objects.values_list('id', 'name', 'price'))
+        user_ids = list(User.objects.values_list('id', flat=True))
+        if not products or not user_ids:
+            raise CommandError('Orders need at least one product and one user.')
+        # Popularity is independent of the id order.
+        random.shuffle(products)
+        random.shuffle(user_ids)
+        self.products = products
+        self.user_ids = user_ids
+        self.product_weights = zipf_cum_weights(len(products), PRODUCT_ZIPF_EXPONENT)
+        self.user_weights = zipf_cum_weights(len(user_ids), USER_ZIPF_EXPONENT)
+
+    def run(self, count, workers, seed):
+        if workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+            return self.generate(count, seed)
+
+        # Children inherit the generator through fork and open their own connections.
+        global _generator
+        _generator = self
+        connections.close_all()
+        shares = [count // workers + (1 if i < count % workers else 0) for i in range(workers)]
+        seeds = [None if seed is None else seed + i + 1 for i in range(workers)]
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            results = pool.starmap(_generate_in_worker, zip(shares, seeds))
+        return tuple(map(sum, zip(*results)))
+
+    def generate(self, count, seed=None):
+        rng = random.Random(seed)
+        connection = connections[router.db_for_write(Order)]
+        prep_pk = Order._meta.pk.get_db_prep_value
+        prep_datetime = Order._meta.get_field('created_at').get_db_prep_value
+        statuses, status_weights = zip(*STATUS_WEIGHTS.items())
+        quantities, quantity_weights = zip(*QUANTITY_WEIGHTS.items())
+        max_lines = 2 * self.items_per_order - 1
+        span = self.days * 24 * 60 * 60
+        created_orders = created_items = 0
+
+        for offset in range(0, count, self.batch_size):
+            size = min(self.batch_size, count - offset)
+            orders, items = [], []
+            buyers = rng.choices(self.user_ids, cum_weights=self.user_weights, k=size)
+            order_statuses = rng.choices(statuses, weights=status_weights, k=size)
+            for user_id, status in zip(buyers, order_statuses):
+                order_pk = prep_pk(uuid.UUID(int=rng.getrandbits(128), version=4), connection)
+                # Squaring skews dates towards the present, like a growing shop.
+                created_at = prep_datetime(self.now - timedelta(seconds=span * rng.random() ** 2), connection)
+                lines = rng.randint(1, max_lines)
+                picked = rng.choices(self.products, cum_weights=self.product_weights, k=lines)
+                line_quantities = rng.choices(quantities, weights=quantity_weights, k=lines)
+                total = Decimal('0')
+                for (product_id, name, price), quantity in zip(picked, line_quantities):
+                    items.append((order_pk, product_id, quantity, name, price))
+                    total += price * quantity
+                orders.append((order_pk, user_id, status, total, created_at, created_at))
+
+            with transaction.atomic(using=connection.alias):
+                insert_rows(Order, ('order_id', 'user', 'status', 'total_price', 'created_at', 'updated_at'), orders)
+                insert_rows(OrderItem, ('order', 'product', 'quantity', 'product_name', 'unit_price'), items)
+            created_orders += len(orders)
+            created_items += len(items)
+        return created_orders, created_items
+
+
+_generator = None
+
+
+def _generate_in_worker(count, seed):
+    return _generator.generate(count, seed)
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from api import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the product full-text search index'
+
+    def handle(self, *args, **kwargs):
+        backend = search.get_backend()
+        if backend is None:
+            self.stdout.write('No full-text search index for this database engine.')
+            return
+        backend.rebuild()
+        self.stdout.write(self.style.SUCCESS('Product search index rebuilt.'))
@@ -0,0 +1,397 @@
+"""
+In-process request, database and cache metrics in the Prometheus text format.
+
+`MetricsMiddleware` labels everything with the resolved route name
+(`products-list`, `order-purchase-order`, ...), so the label set stays
+bounded whatever the URLs look like. Counters and histograms live in a
+per-process registry behind one lock that is held only for a few additions.
+
+Gunicorn runs several worker processes and a scrape only reaches one of them.
+With `METRICS['DIRECTORY']` set, a daemon thread in every worker snapshots
+its registry to `metrics-<pid>-<random id>.json` in that directory every
+`FLUSH_INTERVAL` seconds, and `/metrics` sums the snapshots of all workers,
+including those of exited workers, so counters never go backwards. The
+random id keeps a restarted worker that reuses a pid from overwriting the
+snapshot of the exited one.
+
+Every worker holds an exclusive lock on its `metrics-<id>.lock` while it
+lives. A scrape folds the snapshots whose lock is free, those of exited
+workers, into `metrics-exited.json`, so the directory doesn't grow with
+every restart.
+"""
+import atexit
+import json
+import os
+import secrets
+import tempfile
+import threading
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+try:
+    import fcntl
+except ImportError:  # Windows: exited workers' snapshots are kept as they are
+    fcntl = None
+
+DEFAULTS = {
+    'ENABLED': True,
+    'DIRECTORY': None,
+    'FLUSH_INTERVAL': 5,
+    'TOKEN': None,
+}
+
+# Log-scale latency buckets, two per doubling from 1ms to ~11s: like an HDR
+# histogram, the relative error is the same for fast and slow requests.
+LATENCY_BUCKETS = tuple(round(0.001 * 2 ** (i / 2), 6) for i in range(28))
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144)
+
+UNMATCHED_ROUTE = 'unmatched'
+
+EXITED_SNAPSHOT = 'metrics-exited.json'
+DIRECTORY_LOCK = 'metrics.lock'
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'METRICS', {})}
+
+
+class Registry:
+    """
+    Counters and histograms of this process, keyed by (name, labels).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        key = (name, labels)
+        index = _bucket_index(buckets, value)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': buckets, 'counts': [0] * (len(buckets) + 1),
+                                                    'sum': 0.0, 'count': 0}
+            histogram['counts'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [
+                    [name, list(labels), list(h['buckets']), list(h['counts']), h['sum'], h['count']]
+                    for (name, labels), h in self.histograms.items()
+                ],
+            }
+
+    def clear(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+registry = Registry()
+
+
+def _bucket_index(buckets, value):
+    for index, bound in enumerate(buckets):
+        if value <= bound:
+            return index
+    return len(buckets)
+
+
+def record_cache_lookup(cache_name, hit):
+    """
+    Count a cache lookup; called by the cache helpers in api/cache.py.
+    """
+    registry.inc('cache_requests_total', (('cache', cache_name), ('result', 'hit' if hit else 'miss')))
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.time += time.perf_counter() - started
+
+
+class MetricsMiddleware:
+    """
+    Request count, latency, status, SQL statements and SQL time per route.
+    Goes first in MIDDLEWARE so the latency covers the whole stack. Works
+    in both modes, so async views under ASGI aren't pushed onto a thread.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        config = get_config()
+        if not config['ENABLED']:
+            return self.get_response(request)
+        _start_flusher(config)
+
+        queries = QueryCounter()
+        started = time.perf_counter()
+        with count_queries(queries):
+            response = self.get_response(request)
+        self.record(request, response, time.perf_counter() - started, queries)
+        return response
+
+    async def __acall__(self, request):
+        config = get_config()
+        if not config['ENABLED']:
+            return await self.get_response(request)
+        _start_flusher(config)
+
+        queries = QueryCounter()
+        started = time.perf_counter()
+        with count_queries(queries):
+            response = await self.get_response(request)
+        self.record(request, response, time.perf_counter() - started, queries)
+        return response
+
+    @staticmethod
+    def record(request, response, elapsed, queries):
+        match = getattr(request, 'resolver_match', None)
+        route = (match and match.view_name) or UNMATCHED_ROUTE
+        labels = (('route', route), ('method', request.method))
+        registry.inc('http_requests_total', labels + (('status', str(response.status_code)),))
+        registry.observe('http_request_duration_seconds', labels, elapsed)
+        registry.observe('db_queries_per_request', labels, queries.count, buckets=QUERY_COUNT_BUCKETS)
+        registry.inc('db_query_duration_seconds_total', labels, queries.time)
+        if response.status_code == 429:
+            registry.inc('http_throttled_requests_total', labels)
+
+
+def count_queries(wrapper):
+    """
+    Install `wrapper` on every database connection of this thread (or, in
+    async code, of this context: the async ORM runs its queries on the same
+    connection objects).
+    """
+    stack = ExitStack()
+    for alias in connections:
+        stack.enter_context(connections[alias].execute_wrapper(wrapper))
+    return stack
+
+
+def metrics_view(request):
+    """
+    Prometheus scrape endpoint, summed over all worker processes.
+    """
+    config = get_config()
+    token = config['TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return HttpResponseForbidden()
+
+    snapshots = [registry.snapshot()]
+    if config['DIRECTORY']:
+        flush(config['DIRECTORY'])
+        fold_exited(config['DIRECTORY'])
+        snapshots = read_snapshots(config['DIRECTORY'])
+    return HttpResponse(render(merge(snapshots)), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+_process = {'pid': None, 'id': None, 'lock': None}
+
+
+def process_id():
+    """
+    The pid plus a random id, new in every process (and forked child).
+    """
+    if _process['pid'] != os.getpid():
+        if _process['lock'] is not None:
+            # Inherited from the parent, whose lock it is
+            _process['lock'].close()
+        _process.update(pid=os.getpid(), id=f'{os.getpid()}-{secrets.token_hex(4)}', lock=None)
+    return _process['id']
+
+
+def flush(directory):
+    """
+    Atomically replace this process's snapshot file.
+    """
+    os.makedirs(directory, exist_ok=True)
+    name = f'metrics-{process_id()}'
+    if fcntl is not None and _process['lock'] is None:
+        lock = open(os.path.join(directory, f'{name}.lock'), 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        _process['lock'] = lock
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+    with os.fdopen(fd, 'w') as snapshot_file:
+        json.dump(registry.snapshot(), snapshot_file)
+    os.replace(tmp_path, os.path.join(directory, f'{name}.json'))
+
+
+def fold_exited(directory):
+    """
+    Add the snapshots of exited workers, whose lock is free, to the exited
+    snapshot and remove them.
+    """
+    if fcntl is None:
+        return
+    with open(os.path.join(directory, DIRECTORY_LOCK), 'w') as directory_lock:
+        fcntl.flock(directory_lock, fcntl.LOCK_EX)
+        exited = [name[:-len('.lock')] for name in os.listdir(directory)
+                  if name.startswith('metrics-') and name.endswith('.lock') and _lock_is_free(directory, name)]
+        if not exited:
+            return
+        snapshots = _read(directory, [EXITED_SNAPSHOT] + [f'{name}.json' for name in exited])
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+        with os.fdopen(fd, 'w') as snapshot_file:
+            json.dump(_as_snapshot(merge(snapshots)), snapshot_file)
+        os.replace(tmp_path, os.path.join(directory, EXITED_SNAPSHOT))
+        for name in exited:
+            for suffix in ('.json', '.lock'):
+                try:
+                    os.remove(os.path.join(directory, name + suffix))
+                except FileNotFoundError:
+                    pass
+
+
+def read_snapshots(directory):
+    if fcntl is None:
+        return _read(directory)
+    # Shared with other scrapes, exclusive with fold_exited: a folded
+    # snapshot is counted exactly once.
+    with open(os.path.join(directory, DIRECTORY_LOCK), 'w') as directory_lock:
+        fcntl.flock(directory_lock, fcntl.LOCK_SH)
+        return _read(directory)
+
+
+def _read(directory, filenames=None):
+    if filenames is None:
+        filenames = [filename for filename in sorted(os.listdir(directory))
+                     if filename.startswith('metrics-') and filename.endswith('.json')]
+    snapshots = []
+    for filename in filenames:
+        try:
+            with open(os.path.join(directory, filename)) as snapshot_file:
+                snapshots.append(json.load(snapshot_file))
+        except (OSError, ValueError):
+            continue  # being replaced right now, folded, or a dead worker's partial write
+    return snapshots
+
+
+def _lock_is_free(directory, filename):
+    with open(os.path.join(directory, filename), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+    return True
+
+
+def _as_snapshot(merged):
+    counters, histograms = merged
+    return {
+        'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+        'histograms': [[name, list(labels), list(h['buckets']), list(h['counts']), h['sum'], h['count']]
+                       for (name, labels), h in histograms.items()],
+    }
+
+
+def merge(snapshots):
+    counters, histograms = {}, {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, buckets, counts, total, count in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            merged = histograms.setdefault(key, {'buckets': buckets, 'counts': [0] * len(counts), 'sum': 0.0, 'count': 0})
+            merged['counts'] = [a + b for a, b in zip(merged['counts'], counts)]
+            merged['sum'] += total
+            merged['count'] += count
+    return counters, histograms
+
+
+def render(merged):
+    counters, histograms = merged
+    lines = []
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f'# TYPE {name} counter')
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f'{name}{_labels(labels)} {_number(value)}')
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f'# TYPE {name} histogram')
+        for (metric, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(histogram['buckets'], histogram['counts']):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels(labels + (("le", _number(bound)),))} {cumulative}')
+            lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {histogram["count"]}')
+            lines.append(f'{name}_sum{_labels(labels)} {_number(histogram["sum"])}')
+            lines.append(f'{name}_count{_labels(labels)} {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+_flusher_lock = threading.Lock()
+_flusher_pid = None
+
+
+def _start_flusher(config):
+    """
+    Start this process's snapshot thread once; after a fork the child
+    starts its own.
+    """
+    global _flusher_pid
+    directory = config['DIRECTORY']
+    if not directory or _flusher_pid == os.getpid():
+        return
+    with _flusher_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+
+        def run():
+            while True:
+                time.sleep(config['FLUSH_INTERVAL'])
+                flush(directory)
+
+        threading.Thread(target=run, name='metrics-flusher', daemon=True).start()
+        atexit.register(flush, directory)
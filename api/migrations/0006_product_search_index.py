@@ -0,0 +1,47 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE api_product_fts USING fts5("
+            "name, description, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        # bm25 with the name column weighted 10x the description.
+        schema_editor.execute("INSERT INTO api_product_fts (api_product_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)')")
+        schema_editor.execute(
+            "INSERT INTO api_product_fts (rowid, name, description) "
+            "SELECT id, name, description FROM api_product"
+        )
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            "CREATE TABLE api_product_search ("
+            "product_id bigint PRIMARY KEY REFERENCES api_product (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+            "document tsvector NOT NULL)"
+        )
+        schema_editor.execute("CREATE INDEX api_product_search_document_idx ON api_product_search USING GIN (document)")
+        schema_editor.execute(
+            "INSERT INTO api_product_search (product_id, document) "
+            "SELECT id, setweight(to_tsvector('english', name), 'A') || setweight(to_tsvector('english', description), 'B') "
+            "FROM api_product"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS api_product_fts")
+    elif vendor == 'postgresql':
+        schema_editor.execute("DROP TABLE IF EXISTS api_product_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_product_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
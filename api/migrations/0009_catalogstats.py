@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:20
+
+from django.db import migrations, models
+from django.db.models import Count, F, Max, Min, Q, Sum
+from django.utils import timezone
+
+
+def populate_catalog_stats(apps, schema_editor):
+    Product = apps.get_model('api', 'Product')
+    CatalogStats = apps.get_model('api', 'CatalogStats')
+    summary = Product.objects.aggregate(
+        product_count=Count('pk'),
+        in_stock_count=Count('pk', filter=Q(stock__gt=0)),
+        price_sum=Sum('price'),
+        min_price=Min('price'),
+        max_price=Max('price'),
+        stock_value=Sum(F('price') * F('stock'), output_field=models.DecimalField(max_digits=20, decimal_places=2)),
+    )
+    summary['price_sum'] = summary['price_sum'] or 0
+    summary['stock_value'] = summary['stock_value'] or 0
+    CatalogStats.objects.create(pk=1, reconciled_at=timezone.now(), **summary)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_orderitem_price_snapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product_count', models.IntegerField(default=0)),
+                ('in_stock_count', models.IntegerField(default=0)),
+                ('price_sum', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('min_price', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('max_price', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('stock_value', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('reconciled_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(populate_catalog_stats, migrations.RunPython.noop),
+    ]
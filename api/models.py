@@ -19,6 +19,18 @@ class Product(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2)
     stock = models.PositiveIntegerField()
     image = models.ImageField(upload_to='products/', blank=True, null=True)
+    # Storage paths of the resized image variants, filled in by api/images.py
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        # Composite (field, id) indexes back the keyset pagination seeks for
+        # every orderable column of the product listing.
+        indexes = [
+            models.Index(fields=['name', 'id'], name='product_name_id_idx'),
+            models.Index(fields=['price', 'id'], name='product_price_id_idx'),
+            models.Index(fields=['stock', 'id'], name='product_stock_id_idx'),
+        ]
 
     @property
     def in_stock(self):
@@ -31,6 +43,25 @@ class Files(models.Model):
     product = models.ForeignKey(Product, related_name='files', on_delete=models.CASCADE, null=True, blank=True)
     file = models.FileField(upload_to='uploads/', blank=True, null=True)
     uploaded_at = models.DateTimeField(auto_now_add=True, blank=True, null=True)
+    # Storage paths of the resized variants of image files, see api/images.py
+    variants = models.JSONField(default=dict, blank=True, editable=False)
+    # Content hash; rows with the same hash share one stored file, see api/uploads.py
+    sha256 = models.CharField(max_length=64, blank=True, default='', db_index=True, editable=False)
+
+
+class UploadSession(models.Model):
+    """
+    A chunked upload in progress; the received bytes are in a partial file
+    named after the id.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    product = models.ForeignKey(Product, related_name='upload_sessions', on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    # Declared by the client, checked once the upload is complete
+    sha256 = models.CharField(max_length=64, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
  
     
 class Order(models.Model):
@@ -46,6 +77,7 @@ class Order(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=10, choices=StatusChoices.choices, default=StatusChoices.PENDING)
     total_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True) 
+    updated_at = models.DateTimeField(auto_now=True)
 
     products = models.ManyToManyField(Product, through='OrderItem',related_name='orders')
 
@@ -57,9 +89,56 @@ class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE,related_name='items')
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField()
+    # Snapshot of the product at ordering time, so reading an order needs no
+    # product join and later price changes don't rewrite history.
+    product_name = models.CharField(max_length=255, blank=True, default='')
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+
+    def save(self, *args, **kwargs):
+        if self.unit_price is None:
+            self.unit_price = self.product.price
+        if not self.product_name:
+            self.product_name = self.product.name
+        super().save(*args, **kwargs)
 
     @property
     def item_subtotal(self):
-        return self.product.price * self.quantity
+        # Rows created before the snapshot columns existed fall back to the live price
+        # until `manage.py backfill_order_prices` has run.
+        price = self.unit_price if self.unit_price is not None else self.product.price
+        return price * self.quantity
     
 
+
+
+class CatalogStats(models.Model):
+    """
+    Single-row summary of the product catalog, kept up to date incrementally
+    by the Product signals (see api/stats.py) and periodically reconciled by
+    `manage.py reconcile_catalog_stats`.
+    """
+    # Plain integers: a drifted counter must never make a product write fail.
+    product_count = models.IntegerField(default=0)
+    in_stock_count = models.IntegerField(default=0)
+    price_sum = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    min_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    max_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    stock_value = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    reconciled_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    SINGLETON_PK = 1
+
+    @classmethod
+    def load(cls):
+        stats, _ = cls.objects.get_or_create(pk=cls.SINGLETON_PK)
+        return stats
+
+    @property
+    def avg_price(self):
+        if not self.product_count:
+            return None
+        return round(self.price_sum / self.product_count, 2)
+
+    def __str__(self):
+        return f"Catalog: {self.product_count} products"
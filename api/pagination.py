@@ -0,0 +1,195 @@
+from base64 import b64decode, b64encode
+from urllib import parse
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetCursorPagination(CursorPagination):
+    """
+    Cursor pagination that seeks on the whole ordering tuple.
+
+    DRF's CursorPagination only remembers the first ordering field and falls
+    back to an OFFSET for rows that share its value. Here the cursor stores
+    the value of every ordering field plus a unique tie-breaker, so each page
+    is a single indexed range scan (`WHERE (price, id) > (..)`) no matter how
+    deep the client has paged. Ordering fields must be non-nullable.
+    """
+    ordering = 'id'
+    tie_breaker = 'id'
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+    def get_ordering(self, request, queryset, view):
+        """
+        Use the ordering the filter backends put on the queryset (OrderingFilter,
+        search relevance) or the default one, and append the tie-breaker. The
+        tie-breaker goes the same direction as the last field so a composite
+        index can be walked backwards for descending orderings.
+        """
+        if _is_plain_ordering(queryset.query.order_by):
+            base_ordering = tuple(queryset.query.order_by)
+        else:
+            base_ordering = super().get_ordering(request, queryset, view)
+
+        ordering = []
+        for field in base_ordering:
+            ordering.append(field)
+            if field.lstrip('-') == self.tie_breaker:
+                return tuple(ordering)
+
+        prefix = '-' if ordering and ordering[-1].startswith('-') else ''
+        ordering.append(prefix + self.tie_breaker)
+        return tuple(ordering)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        queryset = self.get_page_queryset(queryset, request, view)
+        if queryset is None:
+            return None
+        return self.set_page(list(queryset))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """
+        `paginate_queryset` for async views, fetching the page with the async ORM.
+        """
+        queryset = self.get_page_queryset(queryset, request, view)
+        if queryset is None:
+            return None
+        return self.set_page([row async for row in queryset.aiterator(chunk_size=self.page_size + 1)])
+
+    def get_page_queryset(self, queryset, request, view=None):
+        """
+        The unevaluated query of the requested page plus one extra row, or
+        None when pagination is off.
+        """
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        self.reverse = self.cursor is not None and self.cursor.reverse
+
+        # Going backwards is a forward seek over the inverted ordering.
+        ordering = self.ordering
+        if self.reverse:
+            ordering = tuple(_invert(field) for field in ordering)
+
+        queryset = queryset.order_by(*ordering)
+        if self.cursor is not None:
+            try:
+                queryset = queryset.filter(self.get_seek_filter(ordering, self.cursor.position))
+            except (DjangoValidationError, TypeError, ValueError):
+                raise NotFound(self.invalid_cursor_message)
+
+        # Fetch one extra row to find out whether there is another page.
+        return queryset[:self.page_size + 1]
+
+    def set_page(self, results):
+        self.page = results[:self.page_size]
+        has_more = len(results) > self.page_size
+
+        if self.reverse:
+            self.page.reverse()
+            self.has_next = True
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = self.cursor is not None
+
+        return self.page
+
+    def get_seek_filter(self, ordering, position):
+        """
+        Build the row-value comparison `(f1, f2, ...) > (v1, v2, ...)` as
+        `f1 > v1 OR (f1 = v1 AND f2 > v2) OR ...`, honouring each field's
+        direction.
+        """
+        condition = Q()
+        equal = Q()
+        for field, value in zip(ordering, position):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition |= equal & Q(**{f'{name}__{lookup}': value})
+            equal &= Q(**{name: value})
+        return condition
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if self.page:
+            position = self._get_position_from_instance(self.page[-1], self.ordering)
+        else:
+            position = self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if self.page:
+            position = self._get_position_from_instance(self.page[0], self.ordering)
+        else:
+            position = self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=position))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+
+        try:
+            querystring = b64decode(encoded.encode('ascii')).decode('utf-8')
+            tokens = parse.parse_qs(querystring, keep_blank_values=True)
+            reverse = bool(int(tokens.get('r', ['0'])[0]))
+            position = tuple(tokens['p'])
+        except (KeyError, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+        # A cursor from a different ?ordering= cannot be applied to this one.
+        if len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+
+        return Cursor(offset=0, reverse=reverse, position=position)
+
+    def encode_cursor(self, cursor):
+        tokens = {'p': cursor.position}
+        if cursor.reverse:
+            tokens['r'] = '1'
+
+        querystring = parse.urlencode(tokens, doseq=True)
+        encoded = b64encode(querystring.encode('utf-8')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def _get_position_from_instance(self, instance, ordering):
+        position = []
+        for field in ordering:
+            name = field.lstrip('-')
+            if isinstance(instance, dict):
+                position.append(str(instance[name]))
+            else:
+                position.append(str(getattr(instance, name)))
+        return tuple(position)
+
+
+class ProductCursorPagination(KeysetCursorPagination):
+    """
+    Keyset pagination for the product catalog, stable under every
+    `ordering_fields` entry of the product views.
+    """
+    page_size = 20
+    max_page_size = 100
+
+
+def _is_plain_ordering(order_by):
+    return bool(order_by) and all(
+        isinstance(field, str) and '__' not in field for field in order_by
+    )
+
+
+def _invert(field):
+    return field[1:] if field.startswith('-') else '-' + field
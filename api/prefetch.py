@@ -0,0 +1,140 @@
+"""
+Serializer-driven query planning.
+
+`plan_queryset` walks a serializer's field tree - nested serializers, dotted
+`source=` paths, reverse and many-to-many relations - and applies the
+`select_related` / `prefetch_related` / `only()` calls it needs, so the
+number of queries a serializer triggers no longer grows with the data and
+nobody has to keep prefetch lists in sync with the serializers by hand.
+"""
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
+
+MAX_DEPTH = 5
+
+
+class QueryPlan:
+    """
+    What one queryset needs. Prefetched relations get a plan of their own,
+    select_related ones share their parent's.
+    """
+
+    def __init__(self, annotations=()):
+        self.annotations = set(annotations)
+        self.select_related = set()
+        self.prefetches = {}
+        self.only = set()
+        # Cleared as soon as the serializer reads something we can't see
+        # through (a property, a method), then every column is loaded.
+        self.can_defer = True
+
+    def apply(self, queryset, defer_fields=True):
+        if self.select_related:
+            queryset = queryset.select_related(*sorted(self.select_related))
+        if self.prefetches:
+            queryset = queryset.prefetch_related(*self.prefetches.values())
+        if defer_fields and self.can_defer and self.only:
+            queryset = queryset.only(*sorted(self.only))
+        return queryset
+
+
+def plan_queryset(queryset, serializer, defer_fields=True):
+    """
+    Return `queryset` with the joins, prefetches and (if `defer_fields`)
+    column restrictions that `serializer` - an instance, so that fields
+    dropped per request are taken into account - needs to render its rows.
+    """
+    if isinstance(serializer, serializers.ListSerializer):
+        serializer = serializer.child
+    plan = QueryPlan(queryset.query.annotations)
+    _walk_serializer(serializer, queryset.model, '', plan, defer_fields, depth=0)
+    return plan.apply(queryset, defer_fields)
+
+
+def _walk_serializer(serializer, model, prefix, plan, defer_fields, depth):
+    plan.only.add(prefix + model._meta.pk.name)
+    for field in serializer.fields.values():
+        if field.write_only:
+            continue
+        if field.source == '*':
+            if isinstance(field, serializers.BaseSerializer) and depth < MAX_DEPTH:
+                _walk_serializer(field, model, prefix, plan, defer_fields, depth + 1)
+            else:
+                plan.can_defer = False
+            continue
+        _walk_source(field, model, field.source_attrs, prefix, plan, defer_fields, depth)
+
+
+def _walk_source(field, model, attrs, prefix, plan, defer_fields, depth):
+    name, rest = attrs[0], attrs[1:]
+    try:
+        model_field = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        if name == 'pk':
+            plan.only.add(prefix + model._meta.pk.name)
+        elif not (name in plan.annotations and not prefix and not rest):
+            plan.can_defer = False
+        return
+
+    path = prefix + name
+    if not model_field.is_relation or name == getattr(model_field, 'attname', None):
+        # A column, including a foreign key read through its `<name>_id`
+        plan.only.add(prefix + model_field.name)
+        return
+
+    if model_field.one_to_many or model_field.many_to_many:
+        if path not in plan.prefetches:
+            plan.prefetches[path] = _plan_prefetch(field, model_field, path, rest, defer_fields, depth)
+        return
+
+    # Forward foreign key / one-to-one
+    plan.only.add(path)
+    child = field.child if isinstance(field, serializers.ListSerializer) else field
+    if isinstance(child, serializers.BaseSerializer) and not rest:
+        if depth < MAX_DEPTH:
+            plan.select_related.add(path)
+            _walk_serializer(child, model_field.related_model, path + '__', plan, defer_fields, depth + 1)
+    elif rest:
+        plan.select_related.add(path)
+        _walk_source(field, model_field.related_model, rest, path + '__', plan, defer_fields, depth)
+    # else: a primary key field, served from the local `<name>_id` column
+
+
+def _plan_prefetch(field, model_field, path, rest, defer_fields, depth):
+    related_model = model_field.related_model
+    queryset = related_model._default_manager.all()
+    child = field.child if isinstance(field, serializers.ListSerializer) else field
+    if isinstance(field, serializers.ManyRelatedField):
+        child = field.child_relation
+
+    plan = QueryPlan()
+    if model_field.one_to_many:
+        # The prefetch matches rows to their parent on this column.
+        plan.only.add(model_field.field.name)
+
+    if isinstance(child, serializers.BaseSerializer) and not rest and depth < MAX_DEPTH:
+        _walk_serializer(child, related_model, '', plan, defer_fields, depth + 1)
+    elif rest:
+        plan.only.add(related_model._meta.pk.name)
+        _walk_source(field, related_model, rest, '', plan, defer_fields, depth + 1)
+    else:
+        # Related field rendered as primary keys
+        plan.only.add(related_model._meta.pk.name)
+
+    return Prefetch(path, queryset=plan.apply(queryset, defer_fields))
+
+
+class AutoPrefetchMixin:
+    """
+    Plans `get_queryset()` for the serializer of the current action. Column
+    restriction (`only()`) is limited to safe methods, so writes always work
+    on fully loaded instances.
+    """
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        request = getattr(self, 'request', None)
+        defer_fields = request is not None and request.method in SAFE_METHODS
+        return plan_queryset(queryset, self.get_serializer(), defer_fields=defer_fields)
@@ -0,0 +1,245 @@
+"""
+Sampled request profiling, cheap enough to leave enabled in production.
+
+A request is captured when it carries the profiling header with the
+configured token, when it wins its path's sampling rate, or - if
+`SLOW_REQUEST_MS` is set - when it turns out to be slow. Requests that can't
+be captured pay for one dictionary lookup and one random number. With the
+slow-request mode every request is a candidate, so candidates only add up
+the count and time of their SQL statements; the statements themselves are
+kept for header-triggered and sampled captures only.
+
+Captures go to an in-process ring buffer (served to staff by
+`ProfileCapturesView`) and, with `DIRECTORY` set, are appended as JSON lines
+to a per-process file by a background thread, never by the request thread.
+Nothing is written to the database we serve from.
+
+Settings, all optional:
+
+    PROFILING = {
+        'ENABLED': True,
+        'SAMPLE_RATE': 0.01,              # default rate for every path
+        'PATH_RATES': {'/orders/': 0.1},  # longest matching prefix wins
+        'HEADER': 'X-Profile',
+        'HEADER_TOKEN': None,             # header trigger is off without a token
+        'SLOW_REQUEST_MS': 500,
+        'BUFFER_SIZE': 500,
+        'DIRECTORY': None,
+        'MAX_QUERIES': 50,                # SQL statements kept per header/sampled capture
+    }
+"""
+import json
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.utils import timezone
+
+from api.metrics import count_queries
+
+DEFAULTS = {
+    'ENABLED': True,
+    'SAMPLE_RATE': 0.0,
+    'PATH_RATES': {},
+    'HEADER': 'X-Profile',
+    'HEADER_TOKEN': None,
+    'SLOW_REQUEST_MS': None,
+    'BUFFER_SIZE': 500,
+    'DIRECTORY': None,
+    'MAX_QUERIES': 50,
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'PROFILING', {})}
+
+
+class QueryRecorder:
+    """
+    `execute_wrapper` counting statements and their time, keeping the text
+    of the first `max_queries` of them (none with 0).
+    """
+
+    def __init__(self, max_queries):
+        self.max_queries = max_queries
+        self.count = 0
+        self.time = 0.0
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.time += elapsed
+            if len(self.queries) < self.max_queries:
+                self.queries.append({'sql': sql, 'ms': round(elapsed * 1000, 3)})
+
+
+class CaptureStore:
+    """
+    Ring buffer of the latest captures, plus an optional JSON lines file fed
+    by a daemon thread.
+    """
+
+    def __init__(self):
+        self._buffer = None
+        self._queue = None
+        self._lock = threading.Lock()
+
+    def add(self, capture, config):
+        if self._buffer is None or self._buffer.maxlen != config['BUFFER_SIZE']:
+            with self._lock:
+                self._buffer = deque(self._buffer or (), maxlen=config['BUFFER_SIZE'])
+        self._buffer.append(capture)
+        if config['DIRECTORY']:
+            self._writer_queue(config['DIRECTORY']).put(capture)
+
+    def recent(self, limit=None):
+        captures = list(self._buffer or ())[::-1]
+        return captures[:limit] if limit else captures
+
+    def clear(self):
+        if self._buffer is not None:
+            self._buffer.clear()
+
+    def _writer_queue(self, directory):
+        if self._queue is None:
+            with self._lock:
+                if self._queue is None:
+                    self._queue = queue.SimpleQueue()
+                    threading.Thread(
+                        target=self._write, args=(self._queue, directory), name='profile-writer', daemon=True,
+                    ).start()
+        return self._queue
+
+    @staticmethod
+    def _write(captures, directory):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'profile-{os.getpid()}.jsonl')
+        while True:
+            capture = captures.get()
+            with open(path, 'a') as profile_file:
+                profile_file.write(json.dumps(capture, default=str) + '\n')
+
+
+captures = CaptureStore()
+
+
+class ProfilingMiddleware:
+    """
+    Capture sampled requests: total, view and render time, SQL count/time
+    and the statements themselves. Serializer `.data` runs inside the view,
+    so it is part of `view_ms`; `render_ms` is the renderer.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        config = get_config()
+        reason = self.start(request, config)
+        if reason is False:
+            return self.get_response(request)
+
+        recorder = QueryRecorder(config['MAX_QUERIES'] if reason else 0)
+        started = time.perf_counter()
+        with count_queries(recorder):
+            response = self.get_response(request)
+        self.finish(request, response, reason, started, recorder, config)
+        return response
+
+    async def __acall__(self, request):
+        config = get_config()
+        reason = self.start(request, config)
+        if reason is False:
+            return await self.get_response(request)
+
+        recorder = QueryRecorder(config['MAX_QUERIES'] if reason else 0)
+        started = time.perf_counter()
+        with count_queries(recorder):
+            response = await self.get_response(request)
+        self.finish(request, response, reason, started, recorder, config)
+        return response
+
+    def start(self, request, config):
+        """
+        The capture reason, None if only a slow request gets captured, or
+        False if the request isn't profiled at all.
+        """
+        if not config['ENABLED']:
+            return False
+        reason = self.get_reason(request, config)
+        if reason is None and config['SLOW_REQUEST_MS'] is None:
+            return False
+        request._profile = {'view_started': None, 'view_finished': None}
+        return reason
+
+    def finish(self, request, response, reason, started, recorder, config):
+        finished = time.perf_counter()
+        duration_ms = (finished - started) * 1000
+        if reason is None and duration_ms >= config['SLOW_REQUEST_MS']:
+            reason = 'slow'
+        if reason is not None:
+            captures.add(self.build_capture(request, response, reason, started, finished, recorder), config)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if hasattr(request, '_profile'):
+            request._profile['view'] = f'{view_func.__module__}.{view_func.__qualname__}'
+            request._profile['view_started'] = time.perf_counter()
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered after this hook, which splits view time from render time.
+        if hasattr(request, '_profile'):
+            request._profile['view_finished'] = time.perf_counter()
+        return response
+
+    def get_reason(self, request, config):
+        token = config['HEADER_TOKEN']
+        if token and request.headers.get(config['HEADER']) == token:
+            return 'header'
+        rate = self.get_rate(request.path, config)
+        if rate and random.random() < rate:
+            return 'sampled'
+        return None
+
+    @staticmethod
+    def get_rate(path, config):
+        prefixes = [prefix for prefix in config['PATH_RATES'] if path.startswith(prefix)]
+        if prefixes:
+            return config['PATH_RATES'][max(prefixes, key=len)]
+        return config['SAMPLE_RATE']
+
+    @staticmethod
+    def build_capture(request, response, reason, started, finished, recorder):
+        profile = request._profile
+        view_started = profile['view_started'] or started
+        view_finished = profile['view_finished'] or finished
+        return {
+            'timestamp': timezone.now().isoformat(),
+            'reason': reason,
+            'method': request.method,
+            'path': request.get_full_path(),
+            'view': profile.get('view'),
+            'status': response.status_code,
+            'duration_ms': round((finished - started) * 1000, 3),
+            'view_ms': round((view_finished - view_started) * 1000, 3),
+            'render_ms': round((finished - view_finished) * 1000, 3),
+            'sql_count': recorder.count,
+            'sql_ms': round(recorder.time * 1000, 3),
+            'queries': recorder.queries,
+        }
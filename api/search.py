@@ -0,0 +1,136 @@
+"""
+Full-text search index for products.
+
+The index lives in a side table keyed by product id and is kept in sync
+from the Product signals in `api/signals.py`. SQLite uses an FTS5 virtual
+table, PostgreSQL a tsvector column with a GIN index; both expose the same
+interface so `FullTextSearchFilter` does not care which one it talks to.
+"""
+import re
+
+from django.db import connection
+from django.db.models import FloatField
+from django.db.models.expressions import RawSQL
+
+from api.models import Product
+
+SQLITE_TABLE = 'api_product_fts'
+POSTGRES_TABLE = 'api_product_search'
+POSTGRES_CONFIG = 'english'
+# The Product fields every backend indexes and matches together
+INDEXED_FIELDS = ('name', 'description')
+
+_TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(terms):
+    """
+    Reduce user input to plain word tokens so it can never be parsed as
+    FTS5 / tsquery syntax.
+    """
+    return _TOKEN_RE.findall(' '.join(terms).lower())
+
+
+class SQLiteSearchBackend:
+    """
+    FTS5 table with its own copy of name/description, rowid = product id.
+    Its `rank` column is bm25 weighted 10:1 in favour of the name (see the
+    migration), lower is more relevant.
+    """
+
+    def index(self, product):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT OR REPLACE INTO {SQLITE_TABLE} (rowid, name, description) VALUES (%s, %s, %s)',
+                [product.pk, product.name, product.description],
+            )
+
+    def remove(self, product_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SQLITE_TABLE} WHERE rowid = %s', [product_id])
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SQLITE_TABLE}')
+            cursor.execute(
+                f'INSERT INTO {SQLITE_TABLE} (rowid, name, description) '
+                f'SELECT id, name, description FROM {Product._meta.db_table}'
+            )
+
+    def search(self, queryset, tokens):
+        # Every token is a quoted prefix query; FTS5 ANDs them together.
+        query = ' '.join(f'"{token}"*' for token in tokens)
+        return queryset.extra(
+            tables=[SQLITE_TABLE],
+            where=[
+                f'{SQLITE_TABLE}.rowid = {Product._meta.db_table}.id',
+                f'{SQLITE_TABLE} MATCH %s',
+            ],
+            params=[query],
+        ).annotate(
+            search_rank=RawSQL(f'{SQLITE_TABLE}.rank', (), output_field=FloatField()),
+        )
+
+
+class PostgresSearchBackend:
+    """
+    tsvector per product, name weighted 'A' and description 'B'. The rank is
+    the negated ts_rank so that, as with FTS5, lower is more relevant.
+    """
+    document_sql = (
+        "setweight(to_tsvector(%s, %s), 'A') || setweight(to_tsvector(%s, %s), 'B')"
+    )
+
+    def index(self, product):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {POSTGRES_TABLE} (product_id, document) VALUES (%s, {self.document_sql}) '
+                f'ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document',
+                [product.pk, POSTGRES_CONFIG, product.name, POSTGRES_CONFIG, product.description],
+            )
+
+    def remove(self, product_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {POSTGRES_TABLE} WHERE product_id = %s', [product_id])
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {POSTGRES_TABLE}')
+            cursor.execute(
+                f"INSERT INTO {POSTGRES_TABLE} (product_id, document) "
+                f"SELECT id, setweight(to_tsvector(%s, name), 'A') || setweight(to_tsvector(%s, description), 'B') "
+                f"FROM {Product._meta.db_table}",
+                [POSTGRES_CONFIG, POSTGRES_CONFIG],
+            )
+
+    def search(self, queryset, tokens):
+        query = ' & '.join(f'{token}:*' for token in tokens)
+        return queryset.extra(
+            tables=[POSTGRES_TABLE],
+            where=[
+                f'{POSTGRES_TABLE}.product_id = {Product._meta.db_table}.id',
+                f'{POSTGRES_TABLE}.document @@ to_tsquery(%s, %s)',
+            ],
+            params=[POSTGRES_CONFIG, query],
+        ).annotate(
+            search_rank=RawSQL(
+                f'-ts_rank({POSTGRES_TABLE}.document, to_tsquery(%s, %s))',
+                (POSTGRES_CONFIG, query),
+                output_field=FloatField(),
+            ),
+        )
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def get_backend():
+    """
+    Return the search backend for the default database, or None when the
+    engine has no full-text index (callers fall back to `icontains`).
+    """
+    backend_class = BACKENDS.get(connection.vendor)
+    return backend_class() if backend_class else None
@@ -1,13 +1,53 @@
 from rest_framework import serializers
-from .models import Product, Order, OrderItem,User, Files
+from .models import Product, Order, OrderItem,User, Files, CatalogStats, UploadSession
+from . import uploads
+from django.core.files.storage import default_storage
 from django.db import transaction
+from collections import defaultdict
+
+def wants_expansion(request, field_name):
+    """
+    True if the request opted into an expensive field with ?expand=a,b.
+    """
+    if request is None:
+        return False
+    return field_name in request.query_params.get('expand', '').split(',')
+
+
+class ImageVariantsField(serializers.ReadOnlyField):
+    """
+    {variant name: URL} of the resized images recorded by api/images.py,
+    empty until they have been rendered.
+    """
+    def to_representation(self, value):
+        request = self.context.get('request')
+        urls = {}
+        for name, path in (value or {}).items():
+            if name == 'source':
+                continue
+            url = default_storage.url(path)
+            urls[name] = request.build_absolute_uri(url) if request is not None else url
+        return urls
+
 
 class UserSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True)
+    # Annotated by the user views in the same query as the users themselves
+    order_count = serializers.IntegerField(read_only=True)
+    lifetime_spend = serializers.DecimalField(max_digits=12, decimal_places=2, read_only=True, coerce_to_string=False)
+    last_order_at = serializers.DateTimeField(read_only=True)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The raw list of order ids is unbounded, only sent with ?expand=orders
+        if not wants_expansion(self.context.get('request'), 'orders'):
+            self.fields.pop('orders')
+
     class Meta:
         model = User
         #exclude = ('password', 'last_login', 'is_active', 'date_joined')  # Exclude sensitive fields
-        fields = ('id', 'username', 'email','password', 'is_staff', 'is_superuser','orders')
+        fields = ('id', 'username', 'email','password', 'is_staff', 'is_superuser',
+                  'order_count', 'lifetime_spend', 'last_order_at', 'orders')
         #fields = '__all__' # if exclude is used, fields cannot be used together with it
         read_only_fields = ('id','is_staff', 'is_superuser','orders')
 
@@ -21,6 +61,8 @@ class UserSerializer(serializers.ModelSerializer):
 
 
 class FilesSerializer(serializers.ModelSerializer):
+    variants = ImageVariantsField()
+
     class Meta:
         model = Files  
         fields = '__all__'  
@@ -29,8 +71,35 @@ class FilesSerializer(serializers.ModelSerializer):
         }
 
 
+class UploadSessionSerializer(serializers.ModelSerializer):
+    offset = serializers.SerializerMethodField()
+    chunk_size = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = ('id', 'filename', 'size', 'sha256', 'offset', 'chunk_size', 'created_at')
+
+    def get_offset(self, obj):
+        return uploads.current_offset(obj)
+
+    def get_chunk_size(self, obj):
+        return uploads.get_config()['CHUNK_SIZE']
+
+    def validate_size(self, value):
+        if value > uploads.get_config()['MAX_SIZE']:
+            raise serializers.ValidationError("The file is larger than the upload limit.")
+        return value
+
+    def validate_sha256(self, value):
+        value = value.lower()
+        if value and (len(value) != 64 or value.strip('0123456789abcdef')):
+            raise serializers.ValidationError("Expected a hex encoded SHA-256 digest.")
+        return value
+
+
 class ProductSerializer(serializers.ModelSerializer):
     files = FilesSerializer(many=True, read_only=True)
+    image_variants = ImageVariantsField()
     class Meta:
         model = Product
         fields = (
@@ -40,6 +109,7 @@ class ProductSerializer(serializers.ModelSerializer):
             'price',
             'stock',
             'files',
+            'image_variants',
         )         
 
     def validate_price(self, value):
@@ -48,8 +118,9 @@ class ProductSerializer(serializers.ModelSerializer):
         return value          
 
 class OrderItemSerializer(serializers.ModelSerializer):
-    product_name = serializers.CharField(source='product.name')
-    product_price = serializers.DecimalField(max_digits=10, decimal_places=2, source='product.price')
+    # Read from the snapshot columns, no product join needed
+    product_name = serializers.CharField()
+    product_price = serializers.DecimalField(max_digits=10, decimal_places=2, source='unit_price')
 
     class Meta:
         model = OrderItem
@@ -62,34 +133,143 @@ class OrderItemSerializer(serializers.ModelSerializer):
 
 class OrderCreateSerializer(serializers.ModelSerializer):
     class OrderItemCreateSerializer(serializers.ModelSerializer):
+        # Plain integer here, the products of all lines are resolved together in validate_items
+        product = serializers.IntegerField(source='product_id', min_value=1)
+
         class Meta:
             model = OrderItem
             fields = ('product', 'quantity')
 
     items = OrderItemCreateSerializer(many=True, required=False)
 
+    def validate_items(self, items):
+        """
+        Fetch every referenced product with a single query instead of one
+        SELECT per line. Batch creation passes the products of the whole
+        batch in the context, fetched up front by `prefetch_products`.
+        """
+        products = self.context.get('products')
+        if products is None:
+            products = Product.objects.only('id', 'name', 'price').in_bulk(
+                {item['product_id'] for item in items}
+            )
+        errors = [
+            {} if item['product_id'] in products
+            else {'product': [f'Invalid pk "{item["product_id"]}" - object does not exist.']}
+            for item in items
+        ]
+        if any(errors):
+            raise serializers.ValidationError(errors)
+
+        for item in items:
+            item['product'] = products[item.pop('product_id')]
+        return items
+
+    @staticmethod
+    def snapshot_items(order_item_data):
+        """
+        Copy each product's current name and price onto the item data and
+        return the order total they add up to.
+        """
+        total = 0
+        for item_data in order_item_data:
+            product = item_data['product']
+            item_data['product_name'] = product.name
+            item_data['unit_price'] = product.price
+            total += product.price * item_data['quantity']
+        return total
+
+    @staticmethod
+    def prefetch_products(payloads):
+        """
+        Products referenced anywhere in a list of raw order payloads, with one
+        query. Malformed entries are skipped here and reported by validation.
+        """
+        ids = set()
+        for payload in payloads:
+            items = payload.get('items') if isinstance(payload, dict) else None
+            for item in items if isinstance(items, list) else []:
+                try:
+                    ids.add(int(item['product']))
+                except (KeyError, TypeError, ValueError):
+                    continue
+        return Product.objects.only('id', 'name', 'price').in_bulk(ids)
+
+    @classmethod
+    def create_many(cls, validated_orders, **extra):
+        """
+        Write many validated orders with two bulk INSERTs, one for the orders
+        and one for all of their items. Order ids are UUIDs generated in
+        Python, so items can point at their order before it is saved.
+        """
+        orders, order_items = [], []
+        for validated_data in validated_orders:
+            validated_data = dict(validated_data, **extra)
+            order_item_data = validated_data.pop('items', [])
+            order = Order(total_price=cls.snapshot_items(order_item_data), **validated_data)
+            orders.append(order)
+            order_items.extend(OrderItem(order=order, **item_data) for item_data in order_item_data)
+
+        with transaction.atomic():
+            Order.objects.bulk_create(orders)
+            OrderItem.objects.bulk_create(order_items)
+        return orders
+
     def create(self, validated_data):
-        order_item_data = validated_data.pop('items')
+        order_item_data = validated_data.pop('items', [])
+        validated_data['total_price'] = self.snapshot_items(order_item_data)
 
         with transaction.atomic():
             order = Order.objects.create(**validated_data)
-            for item_data in order_item_data:
-                OrderItem.objects.create(order=order, **item_data)
+            OrderItem.objects.bulk_create(
+                [OrderItem(order=order, **item_data) for item_data in order_item_data]
+            )
         return order
     
     def update(self, instance, validated_data):
-        order_item_data = validated_data.pop('items')
+        order_item_data = validated_data.pop('items', None)
+        if order_item_data is not None:
+            validated_data['total_price'] = self.snapshot_items(order_item_data)
 
         with transaction.atomic():
             instance = super().update(instance, validated_data)
 
             if order_item_data is not None:
-                instance.items.all().delete()  # Clear existing items
-
-                for item_data in order_item_data:
-                    OrderItem.objects.create(order=instance, **item_data)
+                self.sync_items(instance, order_item_data)
         return instance 
 
+    @staticmethod
+    def sync_items(order, order_item_data):
+        """
+        Diff the submitted lines against the stored ones: lines for a product
+        already on the order are updated in place, the rest are bulk inserted
+        and leftovers deleted. Constant number of queries for any cart size.
+        """
+        existing = defaultdict(list)
+        for item in order.items.all():
+            existing[item.product_id].append(item)
+
+        to_create, to_update = [], []
+        fields = ('quantity', 'product_name', 'unit_price')
+        for item_data in order_item_data:
+            lines = existing.get(item_data['product'].pk)
+            if not lines:
+                to_create.append(OrderItem(order=order, **item_data))
+                continue
+            item = lines.pop(0)
+            if any(getattr(item, field) != item_data[field] for field in fields):
+                for field in fields:
+                    setattr(item, field, item_data[field])
+                to_update.append(item)
+
+        to_delete = [item.pk for lines in existing.values() for item in lines]
+        if to_delete:
+            OrderItem.objects.filter(pk__in=to_delete).delete()
+        if to_update:
+            OrderItem.objects.bulk_update(to_update, fields)
+        if to_create:
+            OrderItem.objects.bulk_create(to_create)
+
     class Meta:
         model = Order
         fields = (
@@ -107,11 +287,8 @@ class OrderCreateSerializer(serializers.ModelSerializer):
 
 class OrderSerializer(serializers.ModelSerializer):
     items = OrderItemSerializer(many=True, read_only=True)
-    total_price = serializers.SerializerMethodField(method_name='total')
-
-    def total(self, obj):
-        order_items = obj.items.all()
-        return sum(order_item.item_subtotal for order_item in order_items) 
+    # Maintained by OrderCreateSerializer; rendered as a number like the old computed total
+    total_price = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True, coerce_to_string=False)
 
     class Meta:
         model = Order
@@ -124,12 +301,27 @@ class OrderSerializer(serializers.ModelSerializer):
             'total_price'
         )                        
 
-class ProductInfoSerializer(serializers.Serializer):
-    # get all products, count of products, max price
- 
-    products = ProductSerializer(many=True)
-    count = serializers.IntegerField()
-    max_price = serializers.FloatField()
+class CatalogStatsSerializer(serializers.ModelSerializer):
+    # get count of products, in stock count, min/max/avg price, total stock value
+    count = serializers.IntegerField(source='product_count')
+    min_price = serializers.DecimalField(max_digits=10, decimal_places=2, coerce_to_string=False)
+    max_price = serializers.DecimalField(max_digits=10, decimal_places=2, coerce_to_string=False)
+    avg_price = serializers.DecimalField(max_digits=10, decimal_places=2, coerce_to_string=False)
+    total_stock_value = serializers.DecimalField(max_digits=20, decimal_places=2, coerce_to_string=False, source='stock_value')
+
+    class Meta:
+        model = CatalogStats
+        fields = (
+            'count',
+            'in_stock_count',
+            'min_price',
+            'max_price',
+            'avg_price',
+            'total_stock_value',
+            'updated_at',
+            'reconciled_at',
+        )
+        read_only_fields = fields
 
 
 class UserRegisterSerializer(serializers.ModelSerializer):
@@ -1,12 +1,107 @@
-from django.db.models.signals import post_save, post_delete
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
-from .models import Product
-from django.core.cache import cache
+from django.utils import timezone
+from .models import Product, Files
+from api import images, search, stats
+from api.cache import invalidate_catalog, invalidate_fragments
 
 @receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=Files)
 def invalidate_product_cache(sender, instance, **kwargs):
     """
-    Invalidate the cache for the product list when a product is created, updated, or deleted.
+    Invalidate the cached product responses when a product or one of its files is created, updated, or deleted.
+    Bumping the catalog version orphans every cached variant at once, no pattern delete needed.
     """
-    print(f"Clearing product cache")
-    #cache.delete_pattern('*product_list*')
\ No newline at end of file
+    invalidate_catalog()
+
+
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=Files)
+def invalidate_product_fragment(sender, instance, **kwargs):
+    """
+    Drop the cached representation of the product that was written, or whose file was; the other products keep theirs.
+    """
+    invalidate_fragments(Product, [instance.pk if sender is Product else instance.product_id])
+
+
+@receiver([post_save, post_delete], sender=Files)
+def touch_product_on_file_change(sender, instance, **kwargs):
+    """
+    A product's representation nests its files, so a file change moves the product's updated_at (its ETag / Last-Modified).
+    """
+    if instance.product_id is not None:
+        Product.objects.filter(pk=instance.product_id).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    """
+    Keep the full-text search index in sync when a product is created or updated.
+    """
+    backend = search.get_backend()
+    if backend is not None:
+        backend.index(instance)
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    """
+    Drop a deleted product from the full-text search index.
+    """
+    backend = search.get_backend()
+    if backend is not None:
+        backend.remove(instance.pk)
+
+
+
+@receiver(pre_save, sender=Product)
+def remember_product_stats_values(sender, instance, **kwargs):
+    """
+    Keep the pre-update price and stock around, the statistics need the old values to apply a delta.
+    """
+    instance._stats_old_values = None
+    if instance.pk is not None:
+        instance._stats_old_values = Product.objects.filter(pk=instance.pk).values('price', 'stock').first()
+
+
+@receiver(post_save, sender=Product)
+def update_catalog_stats(sender, instance, **kwargs):
+    """
+    Apply a product create or update to the catalog statistics.
+    """
+    stats.record_product_change(getattr(instance, '_stats_old_values', None), stats.product_values(instance))
+
+
+@receiver(post_delete, sender=Product)
+def update_catalog_stats_on_delete(sender, instance, **kwargs):
+    """
+    Take a deleted product out of the catalog statistics.
+    """
+    stats.record_product_change(stats.product_values(instance), None)
+
+
+@receiver(post_save, sender=Files)
+def render_file_variants(sender, instance, **kwargs):
+    """
+    Render the thumbnail/medium/WebP variants of an uploaded image once the upload is committed.
+    """
+    transaction.on_commit(lambda: images.schedule(instance, 'file', 'variants'))
+
+
+@receiver(post_save, sender=Product)
+def render_product_image_variants(sender, instance, **kwargs):
+    """
+    Same for the product image; unchanged images are skipped without touching storage.
+    """
+    transaction.on_commit(lambda: images.schedule(instance, 'image', 'image_variants'))
+
+
+@receiver(post_delete, sender=Files)
+@receiver(post_delete, sender=Product)
+def delete_image_variants(sender, instance, **kwargs):
+    """
+    Remove the variant files of a deleted row.
+    """
+    variants = instance.variants if sender is Files else instance.image_variants
+    transaction.on_commit(lambda: images.delete_variants(variants))
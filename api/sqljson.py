@@ -0,0 +1,148 @@
+"""
+Order lists assembled as JSON by the database.
+
+With `SQL_JSON['ENABLED']`, the order list and user-orders endpoints don't
+load orders and items into Python: one query renders every order, its
+items included, into the OrderSerializer representation with the
+database's JSON functions (`json_object`/`json_group_array` on SQLite,
+`json_build_object`/`json_agg` on PostgreSQL). The documents are streamed
+to the client as they are fetched, `CHUNK_SIZE` rows at a time.
+
+The view's queryset is used as is, so the user scoping and OrderFilter
+apply. The regular serializers still answer other media types, other
+databases and non-UTC time zones, whose datetimes the database can't format
+like DRF.
+
+Settings, all optional:
+
+    SQL_JSON = {
+        'ENABLED': False,
+        'CHUNK_SIZE': 2000,
+    }
+
+The SQL mirrors OrderSerializer and OrderItemSerializer. Keep them in sync:
+SqlJSONTestCase compares the two.
+"""
+from django.conf import settings
+from django.db import NotSupportedError, connections
+from django.db.models import Expression, TextField
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from rest_framework.settings import ISO_8601, api_settings
+
+from api.models import OrderItem, Product
+
+DEFAULTS = {
+    'ENABLED': False,
+    'CHUNK_SIZE': 2000,
+}
+
+# Documents per chunk of the response body
+BATCH_SIZE = 100
+
+SQLITE_ORDER = """json_object(
+    'order_id', substr({order}."order_id", 1, 8) || '-' || substr({order}."order_id", 9, 4) || '-'
+        || substr({order}."order_id", 13, 4) || '-' || substr({order}."order_id", 17, 4) || '-'
+        || substr({order}."order_id", 21, 12),
+    'created_at', replace({order}."created_at", ' ', 'T') || 'Z',
+    'user', {order}."user_id",
+    'status', {order}."status",
+    'items', (SELECT json_group_array(json(item)) FROM (
+        SELECT json_object(
+            'product_name', i."product_name",
+            'product_price', CASE WHEN i."unit_price" IS NULL THEN NULL ELSE printf('%%.2f', i."unit_price") END,
+            'quantity', i."quantity",
+            'item_subtotal', round(coalesce(i."unit_price", p."price") * i."quantity", 2)
+        ) AS item
+        FROM {items} i LEFT JOIN {products} p ON i."unit_price" IS NULL AND p."id" = i."product_id"
+        WHERE i."order_id" = {order}."order_id"
+        ORDER BY i."id"
+    )),
+    'total_price', round({order}."total_price", 2)
+)"""
+
+POSTGRESQL_ORDER = """json_build_object(
+    'order_id', {order}."order_id",
+    'created_at', to_char({order}."created_at" AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS')
+        || CASE WHEN date_trunc('second', {order}."created_at") = {order}."created_at" THEN ''
+            ELSE to_char({order}."created_at" AT TIME ZONE 'UTC', '.US') END || 'Z',
+    'user', {order}."user_id",
+    'status', {order}."status",
+    'items', (
+        SELECT coalesce(json_agg(json_build_object(
+            'product_name', i."product_name",
+            'product_price', i."unit_price"::text,
+            'quantity', i."quantity",
+            'item_subtotal', coalesce(i."unit_price", p."price") * i."quantity"
+        ) ORDER BY i."id"), '[]'::json)
+        FROM {items} i LEFT JOIN {products} p ON i."unit_price" IS NULL AND p."id" = i."product_id"
+        WHERE i."order_id" = {order}."order_id"
+    ),
+    'total_price', {order}."total_price"
+)::text"""
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'SQL_JSON', {})}
+
+
+class OrderDocument(Expression):
+    """
+    The OrderSerializer representation of the queryset's order row, as
+    JSON text.
+    """
+    output_field = TextField()
+
+    def as_sql(self, compiler, connection):
+        raise NotSupportedError(f'Order documents are not supported on {connection.vendor}.')
+
+    def as_sqlite(self, compiler, connection):
+        return self.render(SQLITE_ORDER, compiler), []
+
+    def as_postgresql(self, compiler, connection):
+        return self.render(POSTGRESQL_ORDER, compiler), []
+
+    @staticmethod
+    def render(template, compiler):
+        quote = compiler.quote_name_unless_alias
+        return template.format(
+            order=quote(compiler.query.get_initial_alias()),
+            items=quote(OrderItem._meta.db_table),
+            products=quote(Product._meta.db_table),
+        )
+
+
+def supported(request, queryset):
+    if not get_config()['ENABLED'] or connections[queryset.db].vendor not in ('sqlite', 'postgresql'):
+        return False
+    if getattr(request, 'accepted_renderer', None) is None or request.accepted_renderer.format != 'json':
+        return False
+    return (settings.USE_TZ and timezone.get_current_timezone_name() == 'UTC'
+            and api_settings.DATETIME_FORMAT == ISO_8601)
+
+
+def documents(queryset, chunk_size):
+    """
+    The order documents of `queryset`, rendered by the database.
+    """
+    queryset = queryset.prefetch_related(None).select_related(None)
+    return queryset.annotate(_document=OrderDocument()).values_list('_document', flat=True).iterator(
+        chunk_size=chunk_size)
+
+
+def stream(queryset, chunk_size):
+    yield b'['
+    batch = []
+    separator = ''
+    for document in documents(queryset, chunk_size):
+        batch.append(document)
+        if len(batch) == BATCH_SIZE:
+            yield (separator + ','.join(batch)).encode()
+            batch, separator = [], ','
+    if batch:
+        yield (separator + ','.join(batch)).encode()
+    yield b']'
+
+
+def order_list_response(queryset):
+    return StreamingHttpResponse(stream(queryset, get_config()['CHUNK_SIZE']), content_type='application/json')
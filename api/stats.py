@@ -0,0 +1,119 @@
+"""
+Incrementally maintained catalog statistics.
+
+Every product write applies its delta to the single CatalogStats row with
+F() expressions, so reading the stats is one primary-key lookup that never
+touches the product table. Min/max price cannot be maintained by deltas
+when the current extreme goes away; those cases fall back to MIN()/MAX(),
+which the (price, id) index answers without a scan.
+"""
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Max, Min, Q, Sum, Value
+from django.db.models.functions import Coalesce, Greatest, Least
+from django.utils import timezone
+
+from api.models import CatalogStats, Product
+
+PRICE_FIELD = DecimalField(max_digits=10, decimal_places=2)
+
+
+def product_values(product):
+    """
+    The fields the statistics depend on, normalised (prices may have been
+    assigned as int, float or str before the instance was saved).
+    """
+    return {'price': Decimal(str(product.price)), 'stock': product.stock}
+
+
+def record_product_change(old, new):
+    """
+    Apply one product write: `old` / `new` are `product_values` dicts, None
+    for a create / delete.
+    """
+    delta = {'product_count': 0, 'in_stock_count': 0, 'price_sum': 0, 'stock_value': 0}
+    for values, sign in ((old, -1), (new, 1)):
+        if values is None:
+            continue
+        delta['product_count'] += sign
+        delta['in_stock_count'] += sign * (values['stock'] > 0)
+        delta['price_sum'] += sign * values['price']
+        delta['stock_value'] += sign * values['price'] * values['stock']
+    updates = {field: F(field) + value for field, value in delta.items() if value}
+
+    stats = CatalogStats.load()
+    extreme_changed = (
+        old is not None
+        and (new is None or new['price'] != old['price'])
+        and old['price'] in (stats.min_price, stats.max_price)
+    )
+    if extreme_changed:
+        updates.update(Product.objects.aggregate(min_price=Min('price'), max_price=Max('price')))
+    elif new is not None:
+        price = Value(new['price'], output_field=PRICE_FIELD)
+        updates['min_price'] = Least(Coalesce('min_price', price), price)
+        updates['max_price'] = Greatest(Coalesce('max_price', price), price)
+
+    if updates:
+        CatalogStats.objects.filter(pk=stats.pk).update(updated_at=timezone.now(), **updates)
+
+
+def record_stock_reservation(quantities):
+    """
+    Apply the stock changes of a checkout or a cancellation, which are
+    queryset updates and send no signals. `quantities` maps product id to
+    the reserved quantity, negative for stock given back.
+
+    Call it inside the transaction, after the stock updates: the products
+    are read there, but the stats row is only updated once the transaction
+    commits, so buyers never queue on it while holding product row locks.
+    """
+    stock_value = 0
+    in_stock = 0
+    for product in Product.objects.filter(pk__in=quantities).values('pk', 'price', 'stock'):
+        quantity = quantities[product['pk']]
+        stock_value += product['price'] * quantity
+        # Sold out by a reservation, or back in stock after a release.
+        in_stock -= quantity > 0 and product['stock'] == 0
+        in_stock += quantity < 0 and product['stock'] == -quantity
+
+    def apply():
+        CatalogStats.load()
+        CatalogStats.objects.filter(pk=CatalogStats.SINGLETON_PK).update(
+            stock_value=F('stock_value') - stock_value,
+            in_stock_count=F('in_stock_count') + in_stock,
+            updated_at=timezone.now(),
+        )
+    transaction.on_commit(apply)
+
+
+def catalog_aggregates(products):
+    """
+    The statistics computed from scratch over a Product queryset.
+    """
+    stock_value = ExpressionWrapper(F('price') * F('stock'), output_field=DecimalField(max_digits=20, decimal_places=2))
+    summary = products.aggregate(
+        product_count=Count('pk'),
+        in_stock_count=Count('pk', filter=Q(stock__gt=0)),
+        price_sum=Sum('price'),
+        min_price=Min('price'),
+        max_price=Max('price'),
+        stock_value=Sum(stock_value),
+    )
+    summary['price_sum'] = summary['price_sum'] or 0
+    summary['stock_value'] = summary['stock_value'] or 0
+    return summary
+
+
+def reconcile():
+    """
+    Recompute the statistics from the product table and overwrite the row.
+    Returns the stored values before and after, to report drift.
+    """
+    stats = CatalogStats.load()
+    fields = ('product_count', 'in_stock_count', 'price_sum', 'min_price', 'max_price', 'stock_value')
+    before = {field: getattr(stats, field) for field in fields}
+    after = catalog_aggregates(Product.objects.all())
+    CatalogStats.objects.filter(pk=stats.pk).update(reconciled_at=timezone.now(), updated_at=timezone.now(), **after)
+    return before, after
@@ -1,9 +1,49 @@
-from django.test import TestCase
-from api.models import User, Product, Order, OrderItem
+import hashlib
+import io
+import json
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock, skipUnless
+from django.test import LiveServerTestCase, TestCase, TransactionTestCase, override_settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from api import images, loadtest, metrics, renderers, stats, uploads
+from api.renderers import FastJSONRenderer
+from api.serializers import OrderSerializer
+from api.cache import fragment_key
+from api.compiled import CompiledSerializer
+from api.filters import FullTextSearchFilter
+from api.profiling import captures
+from api.views import ProductAPIView
+from api.models import User, Product, Order, OrderItem, Files, CatalogStats, UploadSession
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.serializers import BaseSerializer
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.tokens import RefreshToken
+from PIL import Image
 
 # Create your tests here.
+def app_queries(context):
+    """
+    Queries captured by a CaptureQueriesContext, minus silk's request logging,
+    its EXPLAINs and the savepoints around it.
+    """
+    return [
+        query['sql'] for query in context.captured_queries
+        if 'silk_' not in query['sql']
+        and 'SAVEPOINT' not in query['sql']
+        and not query['sql'].startswith('EXPLAIN')
+    ]
+
 class UserOrderTestCase(TestCase):
     def setUp(self):
         user1 = User.objects.create_user(username='user1', password='password123')
@@ -16,7 +56,7 @@ class UserOrderTestCase(TestCase):
     def test_user_order_endpoint_retrivies_only_authentcated_user_orders(self):
         user = User.objects.get(username='user2')
         self.client.force_login(user)
-        response = self.client.get(reverse('user_orders'))
+        response = self.client.get(reverse('order-user-orders'))
 
         assert response.status_code == status.HTTP_200_OK
         orders = response.json()
@@ -30,5 +70,1368 @@ class UserOrderTestCase(TestCase):
             assert order['user'] == user.id
 
     def test_user_order_list_authenticated(self):
-        response = self.client.get(reverse('user_orders'))
+        response = self.client.get(reverse('order-user-orders'))
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)  
+
+
+class ProductPaginationTestCase(TestCase):
+    def setUp(self):
+        # Duplicate prices force the keyset cursor to fall back on the id tie-breaker.
+        for i in range(12):
+            Product.objects.create(name=f'Product {i}', description='', price=10 + i % 3, stock=1)
+
+    def walk(self, url):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            assert response.status_code == status.HTTP_200_OK
+            data = response.json()
+            ids.extend(product['id'] for product in data['results'])
+            url = data['next']
+        return ids
+
+    def test_cursor_pages_cover_every_product_once_in_order(self):
+        ids = self.walk(reverse('products-list') + '?ordering=-price&page_size=5')
+        expected = list(Product.objects.order_by('-price', '-id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_previous_link_returns_the_previous_page(self):
+        first = self.client.get(reverse('products-list') + '?ordering=price&page_size=5').json()
+        second = self.client.get(first['next']).json()
+        back = self.client.get(second['previous']).json()
+        self.assertEqual(back['results'], first['results'])
+        self.assertIsNone(back['previous'])
+
+    def test_invalid_cursor_is_not_found(self):
+        response = self.client.get(reverse('products-list') + '?cursor=bm9wZQ==')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password123')
+        other = User.objects.create_user(username='other', password='password123')
+        product = Product.objects.create(name='Lamp', description='', price=5, stock=3)
+        Product.objects.create(name='Chair', description='', price=15, stock=1)
+        for owner in (self.user, self.user, other):
+            order = Order.objects.create(user=owner)
+            OrderItem.objects.create(order=order, product=product, quantity=2)
+
+    def read_ndjson(self, response):
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        body = b''.join(response.streaming_content).decode()
+        return [json.loads(line) for line in body.splitlines()]
+
+    def test_product_export_streams_every_product(self):
+        rows = self.read_ndjson(self.client.get(reverse('products-export')))
+        self.assertEqual(sorted(row['name'] for row in rows), ['Chair', 'Lamp'])
+        self.assertEqual(rows[0]['files'], [])
+
+    def test_order_export_is_scoped_to_the_user(self):
+        self.client.force_login(self.user)
+        rows = self.read_ndjson(self.client.get(reverse('order-export')))
+        self.assertEqual(len(rows), 2)
+        self.assertTrue(all(row['user'] == self.user.id for row in rows))
+
+
+class ProductSearchTestCase(TestCase):
+    def setUp(self):
+        self.lamp = Product.objects.create(name='Desk Lamp', description='Bright light', price=20, stock=5)
+        self.shade = Product.objects.create(name='Shade', description='Fits any lamp', price=8, stock=5)
+        Product.objects.create(name='Chair', description='Wooden', price=40, stock=5)
+
+    def search(self, term):
+        response = self.client.get(reverse('products-list'), {'search': term})
+        assert response.status_code == status.HTTP_200_OK
+        return [product['id'] for product in response.json()['results']]
+
+    def test_results_are_ranked_by_relevance(self):
+        # A name match outranks a description match.
+        self.assertEqual(self.search('lamp'), [self.lamp.id, self.shade.id])
+
+    def test_index_follows_product_updates_and_deletes(self):
+        self.assertEqual(self.search('lam'), [self.lamp.id, self.shade.id])
+        self.lamp.name = 'Desk Light'
+        self.lamp.save()
+        self.shade.delete()
+        self.assertEqual(self.search('lamp'), [])
+        self.assertEqual(self.search('light'), [self.lamp.id])
+
+    def test_views_searching_other_fields_use_search_filter(self):
+        # The index matches descriptions too; '=name' must not.
+        view = ProductAPIView(search_fields=['=name'], action_map={'get': 'list'})
+        request = view.initialize_request(APIRequestFactory().get('/', {'search': 'shade'}))
+        queryset = FullTextSearchFilter().filter_queryset(request, Product.objects.all(), view)
+        self.assertEqual(list(queryset), [self.shade])
+        request = view.initialize_request(APIRequestFactory().get('/', {'search': 'lamp'}))
+        queryset = FullTextSearchFilter().filter_queryset(request, Product.objects.all(), view)
+        self.assertEqual(list(queryset), [])
+
+
+@override_settings(CATALOG_CACHE_LOCAL=True)
+class ProductCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(name='Lamp', description='', price=5, stock=3)
+
+    def test_cached_list_is_served_without_queries(self):
+        url = reverse('products-list') + '?ordering=price&search=lamp'
+        first = self.client.get(url).json()
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.client.get(url).json(), first)
+        self.assertEqual(app_queries(ctx), [])
+
+    def test_product_and_file_writes_invalidate_cached_responses(self):
+        url = reverse('products-detail', args=[self.product.id])
+        self.assertEqual(self.client.get(url).json()['files'], [])
+
+        Files.objects.create(product=self.product)
+        self.assertEqual(len(self.client.get(url).json()['files']), 1)
+
+        self.product.price = 7
+        self.product.save()
+        self.assertEqual(self.client.get(url).json()['price'], '7.00')
+
+    @override_settings(CATALOG_CACHE_LOCAL=False)
+    def test_skipped_with_a_per_process_cache(self):
+        url = reverse('products-list')
+        response = self.client.get(url)
+        self.assertNotIn('ETag', response)
+        # A write made by another worker, whose version bump this process wouldn't see
+        Product.objects.filter(pk=self.product.pk).update(price=9, updated_at=timezone.now())
+        self.assertEqual(self.client.get(url).json()['results'][0]['price'], '9.00')
+
+
+@override_settings(CATALOG_CACHE_LOCAL=True)
+class ConditionalGetTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='buyer', password='password123')
+        self.product = Product.objects.create(name='Lamp', description='', price=5, stock=3)
+        self.order = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=self.order, product=self.product, quantity=1)
+
+    def assert_revalidates(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.has_header('Last-Modified'))
+        etag = response['ETag']
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        # auth plus one metadata query, never the rows being listed
+        queries = app_queries(ctx)
+        self.assertLessEqual(len(queries), 3)
+        self.assertFalse([sql for sql in queries if 'api_orderitem' in sql or 'api_files' in sql])
+        return etag
+
+    def test_product_etags_change_with_the_catalog(self):
+        for url in (reverse('products-list'), reverse('products-detail', args=[self.product.id])):
+            etag = self.assert_revalidates(url)
+            Files.objects.create(product=self.product)
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_order_etags_are_scoped_and_change_with_the_order(self):
+        self.client.force_login(self.user)
+        for url in (reverse('order-list'), reverse('order-detail', args=[self.order.pk])):
+            etag = self.assert_revalidates(url)
+            self.order.status = Order.StatusChoices.CONFIRMED
+            self.order.save()
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        other = User.objects.create_user(username='other', password='password123')
+        self.client.force_login(other)
+        response = self.client.get(reverse('order-detail', args=[self.order.pk]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_rows_hidden_by_the_filters_are_not_revalidated(self):
+        hidden = Product.objects.create(name='Chair', description='', price=5, stock=0)
+        url = reverse('products-detail', args=[hidden.id])
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class OrderPricingTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password123')
+        self.lamp = Product.objects.create(name='Lamp', description='', price='12.50', stock=3)
+        self.chair = Product.objects.create(name='Chair', description='', price='40.00', stock=3)
+
+    def test_order_keeps_its_prices_after_a_price_change(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('order-list'), {
+            'status': 'Pending',
+            'items': [{'product': self.lamp.id, 'quantity': 2}, {'product': self.chair.id, 'quantity': 1}],
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(str(Order.objects.get().total_price), '65.00')
+
+        self.lamp.price = 99
+        self.lamp.save()
+        with CaptureQueriesContext(connection) as ctx:
+            order = self.client.get(reverse('order-list')).json()[0]
+        self.assertEqual(order['total_price'], 65.0)
+        self.assertEqual(
+            sorted((item['product_name'], item['product_price']) for item in order['items']),
+            [('Chair', '40.00'), ('Lamp', '12.50')],
+        )
+        self.assertFalse([sql for sql in app_queries(ctx) if 'api_product' in sql])
+
+    def test_backfill_command_snapshots_legacy_rows(self):
+        order = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=order, product=self.lamp, quantity=4)
+        OrderItem.objects.filter(order=order).update(unit_price=None, product_name='')
+
+        call_command('backfill_order_prices', stdout=io.StringIO())
+
+        item = OrderItem.objects.get(order=order)
+        self.assertEqual((item.product_name, str(item.unit_price)), ('Lamp', '12.50'))
+        self.assertEqual(str(Order.objects.get(pk=order.pk).total_price), '50.00')
+
+
+class OrderWriteQueryCountTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password123')
+        self.products = [
+            Product.objects.create(name=f'Product {i}', description='', price=i + 1, stock=10)
+            for i in range(40)
+        ]
+        self.client.force_login(self.user)
+
+    def cart(self, size, quantity=1):
+        return [{'product': product.id, 'quantity': quantity} for product in self.products[:size]]
+
+    def count_queries(self, method, url, items):
+        with CaptureQueriesContext(connection) as ctx:
+            response = method(url, {'status': 'Pending', 'items': items}, content_type='application/json')
+        self.assertIn(response.status_code, (status.HTTP_200_OK, status.HTTP_201_CREATED), response.content)
+        return len(app_queries(ctx))
+
+    def test_create_and_update_use_a_constant_number_of_queries(self):
+        small = self.count_queries(self.client.post, reverse('order-list'), self.cart(2))
+        order = Order.objects.get()
+        url = reverse('order-detail', args=[order.pk])
+        small_update = self.count_queries(self.client.put, url, self.cart(3, quantity=2))
+
+        Order.objects.all().delete()
+        large = self.count_queries(self.client.post, reverse('order-list'), self.cart(40))
+        order = Order.objects.get()
+        url = reverse('order-detail', args=[order.pk])
+        large_update = self.count_queries(self.client.put, url, self.cart(30, quantity=2))
+
+        self.assertEqual(small, large)
+        self.assertEqual(small_update, large_update)
+        self.assertEqual(order.items.count(), 30)
+        self.assertEqual(Order.objects.get().total_price, sum(2 * (i + 1) for i in range(30)))
+
+    def test_unknown_products_are_reported_per_line(self):
+        items = self.cart(1) + [{'product': 9999, 'quantity': 1}]
+        response = self.client.post(reverse('order-list'), {'status': 'Pending', 'items': items},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()['items'][0], {})
+        self.assertIn('product', response.json()['items'][1])
+
+
+class PurchaseOrderTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password123')
+        self.product = Product.objects.create(name='Lamp', description='', price=5, stock=3)
+        self.client.force_login(self.user)
+
+    def order(self, quantity):
+        order = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=order, product=self.product, quantity=quantity)
+        return order
+
+    def purchase(self, order):
+        return self.client.post(reverse('order-purchase-order', args=[order.pk]))
+
+    def test_purchase_decrements_stock_once(self):
+        order = self.order(2)
+        self.assertEqual(self.purchase(order).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.purchase(order).status_code, status.HTTP_400_BAD_REQUEST)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 1)
+
+    def test_insufficient_stock_rolls_back_the_purchase(self):
+        order = self.order(5)
+        self.assertEqual(self.purchase(order).status_code, status.HTTP_400_BAD_REQUEST)
+        order.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual((order.status, self.product.stock), (Order.StatusChoices.PENDING, 3))
+
+    def test_cancelling_a_purchase_gives_the_stock_back(self):
+        order = self.order(3)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.purchase(order).status_code, status.HTTP_200_OK)
+        self.assertEqual((CatalogStats.load().in_stock_count, CatalogStats.load().stock_value), (0, 0))
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('order-cancel-order', args=[order.pk]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 3)
+        stats = CatalogStats.load()
+        self.assertEqual((stats.in_stock_count, stats.stock_value), (1, 15))
+
+
+class ConcurrentPurchaseTestCase(TransactionTestCase):
+    buyers = 12
+
+    def setUp(self):
+        self.product = Product.objects.create(name='Flash sale', description='', price=5, stock=5)
+        self.orders = []
+        for i in range(self.buyers):
+            user = User.objects.create_user(username=f'buyer{i}', password='password123')
+            order = Order.objects.create(user=user)
+            OrderItem.objects.create(order=order, product=self.product, quantity=1)
+            self.orders.append(order)
+
+    def purchase(self, order):
+        try:
+            client = APIClient()
+            client.force_authenticate(order.user)
+            return client.post(reverse('order-purchase-order', args=[order.pk])).status_code
+        finally:
+            connection.close()
+
+    def test_parallel_purchases_never_oversell(self):
+        with ThreadPoolExecutor(max_workers=self.buyers) as pool:
+            codes = list(pool.map(self.purchase, self.orders))
+
+        self.product.refresh_from_db()
+        self.assertEqual(codes.count(status.HTTP_200_OK), 5)
+        self.assertEqual(codes.count(status.HTTP_400_BAD_REQUEST), self.buyers - 5)
+        self.assertEqual(self.product.stock, 0)
+        self.assertEqual(Order.objects.filter(status=Order.StatusChoices.COMPLETED).count(), 5)
+
+
+class BatchOrderTestCase(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username='connector', password='password123')
+        self.products = [
+            Product.objects.create(name=f'Product {i}', description='', price=i + 1, stock=10)
+            for i in range(5)
+        ]
+        self.client.force_login(self.admin)
+
+    def post_batch(self, payloads):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(reverse('order-batch'), payloads, content_type='application/json')
+        return response, len(app_queries(ctx))
+
+    def payload(self, *indexes):
+        return {'status': 'Pending', 'items': [{'product': self.products[i].id, 'quantity': 2} for i in indexes]}
+
+    def test_batch_reports_results_and_errors_per_order(self):
+        response, _ = self.post_batch([
+            self.payload(0, 1),
+            {'status': 'Pending', 'items': [{'product': 9999, 'quantity': 1}]},
+            self.payload(4),
+        ])
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        results = response.json()
+        self.assertEqual([result['index'] for result in results], [0, 1, 2])
+        self.assertIn('items', results[1]['errors'])
+        self.assertEqual([results[0]['total_price'], results[2]['total_price']], [6.0, 10.0])
+        self.assertEqual(OrderItem.objects.count(), 3)
+        self.assertEqual(Order.objects.filter(user=self.admin).count(), 2)
+
+    def test_batch_query_count_does_not_grow_with_the_batch(self):
+        small_response, small = self.post_batch([self.payload(0, 1)] * 2)
+        large_response, large = self.post_batch([self.payload(0, 1, 2, 3)] * 25)
+        self.assertEqual(small_response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(large_response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(small, large)
+        self.assertEqual(Order.objects.count(), 27)
+
+    def test_batch_requires_staff(self):
+        self.client.force_login(User.objects.create_user(username='customer', password='password123'))
+        response, _ = self.post_batch([self.payload(0)])
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class CatalogStatsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.lamp = Product.objects.create(name='Lamp', description='', price='10.00', stock=2)
+        self.chair = Product.objects.create(name='Chair', description='', price='30.00', stock=0)
+        self.desk = Product.objects.create(name='Desk', description='', price='50.00', stock=1)
+
+    def stats(self):
+        return self.client.get(reverse('products-stats')).json()
+
+    def assert_reconciled(self):
+        before, after = stats.reconcile()
+        self.assertEqual(before, after)
+
+    def test_stats_follow_creates_updates_and_deletes(self):
+        data = self.stats()
+        self.assertEqual((data['count'], data['in_stock_count']), (3, 2))
+        self.assertEqual((data['min_price'], data['max_price'], data['avg_price']), (10.0, 50.0, 30.0))
+        self.assertEqual(data['total_stock_value'], 70.0)
+
+        self.desk.delete()
+        self.lamp.price = 5
+        self.lamp.stock = 0
+        self.lamp.save()
+        data = self.stats()
+        self.assertEqual((data['count'], data['in_stock_count']), (2, 0))
+        self.assertEqual((data['min_price'], data['max_price'], data['total_stock_value']), (5.0, 30.0, 0.0))
+        self.assert_reconciled()
+
+    def test_stats_endpoint_does_not_touch_the_product_table(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.stats()
+        self.assertFalse([sql for sql in app_queries(ctx) if 'api_product' in sql])
+
+    def test_checkout_updates_stock_statistics(self):
+        user = User.objects.create_user(username='buyer', password='password123')
+        order = Order.objects.create(user=user)
+        OrderItem.objects.create(order=order, product=self.desk, quantity=1)
+        self.client.force_login(user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('order-purchase-order', args=[order.pk]))
+        data = self.stats()
+        self.assertEqual((data['in_stock_count'], data['total_stock_value']), (1, 20.0))
+        self.assert_reconciled()
+
+    def test_info_lists_products_on_request(self):
+        self.assertNotIn('products', self.client.get(reverse('product_info')).json())
+        data = self.client.get(reverse('product_info'), {'products': 'true', 'page_size': 2}).json()
+        self.assertEqual(data['count'], 3)
+        self.assertEqual(len(data['products']['results']), 2)
+        self.assertIsNotNone(data['products']['next'])
+
+
+class UserOrderStatsTestCase(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username='admin', password='password123')
+        self.buyer = User.objects.create_user(username='buyer', password='password123')
+        Order.objects.create(user=self.buyer, status=Order.StatusChoices.COMPLETED, total_price='20.00')
+        Order.objects.create(user=self.buyer, status=Order.StatusChoices.COMPLETED, total_price='5.50')
+        Order.objects.create(user=self.buyer, status=Order.StatusChoices.PENDING, total_price='99.00')
+        self.client.force_login(self.admin)
+
+    def list_users(self, **params):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('user-list'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return {user['username']: user for user in response.json()['results']}, len(app_queries(ctx))
+
+    def test_users_carry_order_stats_without_an_orders_query_per_user(self):
+        users, queries = self.list_users()
+        self.assertEqual(users['buyer']['order_count'], 3)
+        self.assertEqual(users['buyer']['lifetime_spend'], 25.5)
+        self.assertIsNotNone(users['buyer']['last_order_at'])
+        self.assertEqual((users['admin']['order_count'], users['admin']['lifetime_spend']), (0, 0.0))
+        self.assertNotIn('orders', users['buyer'])
+
+        for i in range(4):
+            Order.objects.create(user=User.objects.create_user(username=f'user{i}', password='password123'))
+        self.assertEqual(self.list_users()[1], queries)
+
+    def test_order_ids_are_an_opt_in_expansion(self):
+        users, _ = self.list_users(expand='orders')
+        self.assertEqual(len(users['buyer']['orders']), 3)
+
+
+class AutoPrefetchTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='buyer', password='password123')
+        self.client.force_login(self.user)
+
+    def add_product_with_files(self, name, files=2):
+        product = Product.objects.create(name=name, price='3.00', stock=10)
+        for i in range(files):
+            Files.objects.create(product=product, file=f'products/{name}-{i}.jpg')
+        return product
+
+    def add_order(self, items=3):
+        order = Order.objects.create(user=self.user)
+        for i in range(items):
+            product = Product.objects.create(name=f'Item {i}', price='2.00', stock=10)
+            OrderItem.objects.create(order=order, product=product, quantity=1)
+        return order
+
+    def count_queries(self, url):
+        cache.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(app_queries(ctx))
+
+    def test_plan_follows_the_serializer_field_tree(self):
+        from api.prefetch import plan_queryset
+        from api.serializers import OrderSerializer, ProductSerializer
+
+        queryset = plan_queryset(Product.objects.all(), ProductSerializer())
+        self.assertEqual([lookup.prefetch_through for lookup in queryset._prefetch_related_lookups], ['files'])
+        self.assertEqual(
+            queryset.query.deferred_loading,
+            ({'id', 'name', 'description', 'price', 'stock', 'image_variants'}, False),
+        )
+
+        queryset = plan_queryset(Order.objects.all(), OrderSerializer())
+        self.assertEqual([lookup.prefetch_through for lookup in queryset._prefetch_related_lookups], ['items'])
+        self.assertIn('total_price', queryset.query.deferred_loading[0])
+        self.assertNotIn('updated_at', queryset.query.deferred_loading[0])
+
+    def test_product_list_query_count_does_not_grow_with_files(self):
+        self.add_product_with_files('Lamp')
+        queries = self.count_queries(reverse('products-list'))
+        for i in range(5):
+            self.add_product_with_files(f'Chair {i}', files=3)
+        self.assertEqual(self.count_queries(reverse('products-list')), queries)
+
+    def test_order_list_query_count_does_not_grow_with_items(self):
+        self.add_order(items=1)
+        queries = self.count_queries(reverse('order-list'))
+        for _ in range(3):
+            self.add_order(items=4)
+        self.assertEqual(self.count_queries(reverse('order-list')), queries)
+        self.assertEqual(len(self.client.get(reverse('order-list')).json()), 4)
+
+
+class EndpointQueryBudgetTestCase(TestCase):
+    """
+    Hits every API endpoint after each round of `populate_db` seeding and
+    checks its query count against a fixed budget that must hold at every
+    scale, so a new N+1 fails here instead of in production. Query counts and
+    timings per endpoint and scale are written to the JSON file named by
+    API_PERF_REPORT, if set, to diff between commits.
+    """
+    SCALES = (1, 3, 6)  # cumulative populate_db runs
+    FILES_PER_PRODUCT = 2
+
+    # Queries per request, authentication and silk excluded
+    BUDGETS = {
+        'products-list': 2,
+        'products-detail': 3,
+        'products-stats': 1,
+        'products-export': 2,
+        'products-create': 5,
+        'product-info': 3,
+        'product-files-list': 1,
+        'product-files-detail': 1,
+        'order-list': 3,
+        'order-detail': 3,
+        'order-user-orders': 3,
+        'order-export': 2,
+        'order-create': 5,
+        'order-batch': 3,
+        'order-purchase': 8,
+        'order-cancel': 6,
+        'user-list': 2,
+        'user-detail': 1,
+        'token-obtain': 1,
+        'token-refresh': 1,
+    }
+
+    report = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        path = os.environ.get('API_PERF_REPORT')
+        if not path:
+            return
+        with open(path, 'w') as report_file:
+            json.dump(cls.report, report_file, indent=2, sort_keys=True)
+
+    def setUp(self):
+        random.seed(0)
+        self.client = APIClient()
+
+    def seed(self):
+        call_command('populate_db', stdout=io.StringIO())
+        products = Product.objects.filter(files__isnull=True)
+        Files.objects.bulk_create([
+            Files(product=product, file=f'products/{product.pk}-{i}.jpg')
+            for product in products for i in range(self.FILES_PER_PRODUCT)
+        ])
+
+    def pending_order(self, user):
+        order = Order.objects.create(user=user)
+        for product in Product.objects.filter(stock__gt=0)[:2]:
+            OrderItem.objects.create(order=order, product=product, quantity=1)
+        return order
+
+    def endpoints(self, scale):
+        """
+        (name, user, method, url, payload, expected status) for every route.
+        """
+        admin = User.objects.get(username='admin')
+        buyer = User.objects.create_user(username=f'buyer{scale}', password='password123')
+        shopper = User.objects.create_user(username=f'shopper{scale}', password='password123')
+        product = Product.objects.filter(files__isnull=False).first()
+        file = product.files.first()
+        order = Order.objects.filter(user=admin).first()
+        to_purchase, to_cancel = self.pending_order(buyer), self.pending_order(buyer)
+        line = {'items': [{'product': product.pk, 'quantity': 1}]}
+        refresh = str(RefreshToken.for_user(admin))
+
+        return [
+            ('products-list', None, 'get', reverse('products-list'), None, 200),
+            ('products-detail', None, 'get', reverse('products-detail', args=[product.pk]), None, 200),
+            ('products-stats', None, 'get', reverse('products-stats'), None, 200),
+            ('products-export', None, 'get', reverse('products-export'), None, 200),
+            ('products-create', admin, 'post', reverse('products-list'),
+             {'name': f'New {scale}', 'description': 'x', 'price': '1.00', 'stock': 1}, 201),
+            ('product-info', None, 'get', reverse('product_info') + '?products=true', None, 200),
+            ('product-files-list', None, 'get', reverse('product-files-list', args=[product.pk]), None, 200),
+            ('product-files-detail', None, 'get',
+             reverse('product-files-detail', args=[product.pk, file.pk]), None, 200),
+            ('order-list', admin, 'get', reverse('order-list'), None, 200),
+            ('order-detail', admin, 'get', reverse('order-detail', args=[order.pk]), None, 200),
+            ('order-user-orders', admin, 'get', reverse('order-user-orders'), None, 200),
+            ('order-export', admin, 'get', reverse('order-export'), None, 200),
+            ('order-create', shopper, 'post', reverse('order-list'), line, 201),
+            ('order-batch', admin, 'post', reverse('order-batch'), [line, line, line], 201),
+            ('order-purchase', buyer, 'post', reverse('order-purchase-order', args=[to_purchase.pk]), None, 200),
+            ('order-cancel', buyer, 'post', reverse('order-cancel-order', args=[to_cancel.pk]), None, 200),
+            ('user-list', admin, 'get', reverse('user-list'), None, 200),
+            ('user-detail', admin, 'get', reverse('user-detail', args=[buyer.pk]), None, 200),
+            ('token-obtain', None, 'post', reverse('token_obtain_pair'),
+             {'username': 'admin', 'password': 'test'}, 200),
+            ('token-refresh', None, 'post', reverse('token_refresh'), {'refresh': refresh}, 200),
+        ]
+
+    def measure(self, user, method, url, payload):
+        """
+        Return (response, app queries, response ms, serialization ms).
+        Streaming bodies are consumed inside the measurement.
+        """
+        self.client.force_authenticate(user)
+        cache.clear()  # measure the database path, not a cache hit
+        serialization = SerializationTimer()
+        with CaptureQueriesContext(connection) as ctx, serialization:
+            started = time.perf_counter()
+            response = getattr(self.client, method)(url, payload, format='json')
+            if response.streaming:
+                b''.join(response.streaming_content)
+            elapsed = time.perf_counter() - started
+        return response, len(app_queries(ctx)), elapsed * 1000, serialization.elapsed * 1000
+
+    def test_query_budgets_hold_at_every_scale(self):
+        counts = {}
+        for scale in range(1, max(self.SCALES) + 1):
+            self.seed()
+            if scale not in self.SCALES:
+                continue
+            for name, user, method, url, payload, expected in self.endpoints(scale):
+                response, queries, response_ms, serialization_ms = self.measure(user, method, url, payload)
+                with self.subTest(endpoint=name, scale=scale):
+                    self.assertEqual(response.status_code, expected)
+                    self.assertLessEqual(queries, self.BUDGETS[name])
+                counts.setdefault(name, set()).add(queries)
+                self.report.setdefault(name, {})[str(scale)] = {
+                    'status': response.status_code,
+                    'queries': queries,
+                    'response_ms': round(response_ms, 3),
+                    'serialization_ms': round(serialization_ms, 3),
+                }
+
+        for name, seen in counts.items():
+            with self.subTest(endpoint=name):
+                self.assertEqual(len(seen), 1, f'{name} query count depends on row count: {sorted(seen)}')
+
+
+class SerializationTimer:
+    """
+    Accumulates the time spent in top-level `serializer.data` calls while
+    active; nested serializers are included in their parent's time.
+    """
+    def __init__(self):
+        self.elapsed = 0.0
+        self._depth = 0
+
+    def __enter__(self):
+        self._original = BaseSerializer.data
+        timer, original = self, self._original
+
+        def data(serializer):
+            timer._depth += 1
+            started = time.perf_counter()
+            try:
+                return original.fget(serializer)
+            finally:
+                timer._depth -= 1
+                if not timer._depth:
+                    timer.elapsed += time.perf_counter() - started
+
+        BaseSerializer.data = property(data)
+        return self
+
+    def __exit__(self, *exc_info):
+        BaseSerializer.data = self._original
+
+
+class ProfilingMiddlewareTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        captures.clear()
+        Product.objects.create(name='Lamp', price='3.00', stock=1)
+
+    def get(self, url, **headers):
+        return self.client.get(url, headers=headers)
+
+    @override_settings(PROFILING={'SAMPLE_RATE': 0.0, 'HEADER_TOKEN': 'secret'})
+    def test_header_with_token_triggers_a_capture(self):
+        self.get(reverse('products-list'), **{'X-Profile': 'wrong'})
+        self.assertEqual(captures.recent(), [])
+
+        cache.clear()
+        self.get(reverse('products-list'), **{'X-Profile': 'secret'})
+        [capture] = captures.recent()
+        self.assertEqual((capture['reason'], capture['status']), ('header', 200))
+        self.assertGreaterEqual(capture['sql_count'], 2)
+        self.assertEqual(len(capture['queries']), capture['sql_count'])
+        self.assertTrue(capture['view'].endswith('ProductAPIView'))
+        self.assertGreaterEqual(capture['duration_ms'], capture['view_ms'])
+
+    @override_settings(PROFILING={'SAMPLE_RATE': 0.0, 'PATH_RATES': {'/products/': 1.0, '/products/stats/': 0.0}})
+    def test_longest_path_prefix_sets_the_rate(self):
+        self.get(reverse('products-stats'))
+        self.get(reverse('products-list'))
+        self.assertEqual([capture['path'] for capture in captures.recent()], ['/products/'])
+
+    @override_settings(PROFILING={'SAMPLE_RATE': 0.0, 'SLOW_REQUEST_MS': 0})
+    def test_slow_requests_are_captured(self):
+        self.get(reverse('products-list'))
+        [capture] = captures.recent()
+        self.assertEqual(capture['reason'], 'slow')
+        # Every request is a candidate: only the count and time of its SQL are recorded
+        self.assertGreaterEqual(capture['sql_count'], 2)
+        self.assertEqual(capture['queries'], [])
+
+    def test_captures_are_written_to_file_off_the_request_thread(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(PROFILING={'SAMPLE_RATE': 1.0, 'DIRECTORY': directory}):
+                self.get(reverse('products-list'))
+            path = os.path.join(directory, f'profile-{os.getpid()}.jsonl')
+            for _ in range(100):
+                if os.path.exists(path) and os.path.getsize(path):
+                    break
+                time.sleep(0.01)
+            with open(path) as profile_file:
+                self.assertEqual(json.loads(profile_file.readline())['path'], '/products/')
+
+    @override_settings(PROFILING={'SAMPLE_RATE': 0.0})
+    def test_captures_are_staff_only(self):
+        self.assertEqual(self.get(reverse('profiling')).status_code, status.HTTP_401_UNAUTHORIZED)
+        self.client.force_login(User.objects.create_superuser(username='admin', password='password123'))
+        self.assertEqual(self.get(reverse('profiling')).json(), [])
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.registry.clear()
+        Product.objects.create(name='Lamp', price='3.00', stock=1)
+
+    def scrape(self, **headers):
+        response = self.client.get(reverse('metrics'), headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.content.decode()
+
+    @override_settings(CATALOG_CACHE_LOCAL=True)
+    def test_requests_are_counted_per_route(self):
+        self.client.get(reverse('products-list'))
+        self.client.get(reverse('products-list'))
+        self.client.get(reverse('products-detail', args=[999]))
+        body = self.scrape()
+
+        self.assertIn('http_requests_total{route="products-list",method="GET",status="200"} 2', body)
+        self.assertIn('http_requests_total{route="products-detail",method="GET",status="404"} 1', body)
+        self.assertIn('http_request_duration_seconds_count{route="products-list",method="GET"} 2', body)
+        self.assertIn('http_request_duration_seconds_bucket{route="products-list",method="GET",le="+Inf"} 2', body)
+        self.assertIn('db_queries_per_request_count{route="products-list",method="GET"} 2', body)
+        self.assertIn('cache_requests_total{cache="catalog",result="hit"} 1', body)
+        self.assertIn('cache_requests_total{cache="catalog",result="miss"} 2', body)
+
+    def test_snapshots_of_all_workers_are_summed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(METRICS={'DIRECTORY': directory, 'FLUSH_INTERVAL': 3600}):
+                self.client.get(reverse('products-list'))
+                # Another worker's snapshot, as written by metrics.flush()
+                other = {
+                    'counters': [['http_requests_total',
+                                  [['route', 'products-list'], ['method', 'GET'], ['status', '200']], 3]],
+                    'histograms': [],
+                }
+                with open(os.path.join(directory, 'metrics-1.json'), 'w') as snapshot_file:
+                    json.dump(other, snapshot_file)
+                body = self.scrape()
+
+        self.assertIn('http_requests_total{route="products-list",method="GET",status="200"} 4', body)
+
+    def test_exited_workers_are_folded_into_one_snapshot(self):
+        counter = ['http_requests_total', [['route', 'products-list'], ['method', 'GET'], ['status', '200']]]
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(METRICS={'DIRECTORY': directory, 'FLUSH_INTERVAL': 3600}):
+                # Two exited workers that had the same pid; nothing holds their locks
+                for worker_id, value in (('7-aaaa', 2), ('7-bbbb', 3)):
+                    with open(os.path.join(directory, f'metrics-{worker_id}.json'), 'w') as snapshot_file:
+                        json.dump({'counters': [counter + [value]], 'histograms': []}, snapshot_file)
+                    open(os.path.join(directory, f'metrics-{worker_id}.lock'), 'w').close()
+                self.client.get(reverse('products-list'))
+                for _ in range(2):
+                    body = self.scrape()
+                    self.assertIn('http_requests_total{route="products-list",method="GET",status="200"} 6', body)
+                files = sorted(name for name in os.listdir(directory) if name.endswith('.json'))
+
+        # Only this worker's live snapshot is left besides the folded one
+        self.assertEqual(files, sorted(['metrics-exited.json', f'metrics-{metrics.process_id()}.json']))
+
+    @override_settings(METRICS={'TOKEN': 'secret'})
+    def test_scrape_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_403_FORBIDDEN)
+        self.scrape(Authorization='Bearer secret')
+
+
+class PopulateDbTestCase(TestCase):
+    def populate(self, **options):
+        call_command('populate_db', stdout=io.StringIO(), **options)
+
+    def test_usernames_continue_after_deleted_users(self):
+        self.populate(users=3, products=0, orders=0)
+        User.objects.get(username='user0').delete()
+        self.populate(users=2, products=0, orders=0)
+        self.assertEqual(sorted(User.objects.filter(username__startswith='user').values_list('username', flat=True)),
+                         ['user1', 'user2', 'user3', 'user4'])
+
+    def test_synthetic_data_set(self):
+        self.populate(users=20, products=30, files=2, orders=200, items_per_order=3, seed=7, batch_size=64)
+
+        self.assertEqual(User.objects.count(), 21)  # plus admin
+        self.assertEqual(Product.objects.count(), 30)
+        self.assertEqual(Files.objects.count(), 60)
+        self.assertEqual(Order.objects.count(), 200)
+        self.assertEqual(OrderItem.objects.filter(unit_price__isnull=True).count(), 0)
+        self.assertEqual(len({order.status for order in Order.objects.all()}), 4)
+        for order in Order.objects.prefetch_related('items')[:20]:
+            self.assertTrue(1 <= len(order.items.all()) <= 5)
+            self.assertEqual(order.total_price, sum(item.item_subtotal for item in order.items.all()))
+        self.assertEqual(CatalogStats.load().product_count, 30)
+
+    def test_seed_makes_runs_reproducible(self):
+        def order_lines():
+            return sorted(OrderItem.objects.values_list('product__name', 'quantity', 'order__status'))
+
+        self.populate(users=5, products=10, orders=30, seed=3)
+        first = order_lines()
+        Order.objects.all().delete()
+        Product.objects.all().delete()
+        self.populate(products=10, orders=30, seed=3)
+        self.assertEqual(order_lines(), first)
+
+
+class LoadTestTestCase(LiveServerTestCase):
+    def test_percentiles_use_nearest_rank(self):
+        latencies = [i / 1000 for i in range(1, 101)]
+        self.assertEqual([loadtest.percentile(latencies, p) for p in (50, 95, 99)], [50.0, 95.0, 99.0])
+        self.assertIsNone(loadtest.percentile([], 50))
+
+    def test_runs_weighted_scenarios_per_virtual_user(self):
+        cache.clear()
+        Product.objects.create(name='Lamp', description='Desk lamp', price='3.00', stock=1000)
+        Product.objects.create(name='Chair', description='Office chair', price='5.00', stock=1000)
+        out = io.StringIO()
+        with tempfile.NamedTemporaryFile(suffix='.json') as report_file:
+            # order_cancel browses first, so every endpoint is hit by the first scenario
+            call_command('loadtest', url=self.live_server_url, concurrency=2, duration=2, admin='',
+                         weights='order_cancel=1', seed=1, json_path=report_file.name, stdout=out)
+            report = json.load(report_file)
+
+        self.assertIn('p99 ms', out.getvalue())
+        self.assertEqual(report['error_rate'], 0)
+        self.assertEqual(report['endpoints']['POST /api/token/']['requests'], 2)
+        for endpoint in ('GET /products/', 'POST /orders/', 'POST /orders/{id}/cancel/'):
+            self.assertGreater(report['endpoints'][endpoint]['requests'], 0)
+
+
+def image_upload(name='photo.png', size=(1200, 900)):
+    content = io.BytesIO()
+    Image.new('RGB', size, 'teal').save(content, 'PNG')
+    return SimpleUploadedFile(name, content.getvalue(), content_type='image/png')
+
+
+class ImageVariantsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root.name, IMAGE_PIPELINE={'EAGER': True})
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.product = Product.objects.create(name='Lamp', price='3.00', stock=1)
+        self.client.force_login(User.objects.create_superuser(username='admin', password='password123'))
+
+    def media_path(self, url):
+        return os.path.join(self.media_root.name, url.split('/media/', 1)[1])
+
+    def test_upload_gets_resized_variants(self):
+        files_url = reverse('product-files-list', args=[self.product.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(files_url, {'file': image_upload()})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(response.json()['variants'], {})  # rendered after the response
+
+        variants = self.client.get(files_url).json()[0]['variants']
+        self.assertEqual(set(variants), {'thumbnail', 'medium', 'webp'})
+        with Image.open(self.media_path(variants['thumbnail'])) as thumbnail:
+            self.assertEqual((thumbnail.format, thumbnail.size), ('JPEG', (200, 150)))
+        with Image.open(self.media_path(variants['webp'])) as webp:
+            self.assertEqual((webp.format, webp.size), ('WEBP', (800, 600)))
+        product = self.client.get(reverse('products-detail', args=[self.product.pk])).json()
+        self.assertEqual(product['files'][0]['variants'], variants)
+
+        file_id = Files.objects.get().pk
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(reverse('product-files-detail', args=[self.product.pk, file_id]))
+        self.assertFalse(any(os.path.exists(self.media_path(url)) for url in variants.values()))
+
+    def test_product_image_variants(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.image = image_upload('lamp.png', size=(300, 300))
+            self.product.save()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.image_variants['source'], self.product.image.name)
+
+        response = self.client.get(reverse('products-detail', args=[self.product.pk]))
+        self.assertTrue(response.json()['image_variants']['medium'].startswith('http://testserver/media/variants/'))
+
+        # Saving again without a new image renders nothing
+        with mock.patch('api.images.render_variants') as render:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.product.save()
+        render.assert_not_called()
+
+    def test_non_images_are_ignored(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Files.objects.create(product=self.product, file=SimpleUploadedFile('manual.pdf', b'%PDF-1.4'))
+        self.assertEqual(Files.objects.get().variants, {})
+
+
+class ImagePipelinePoolTestCase(TransactionTestCase):
+    def test_variants_are_rendered_in_the_process_pool(self):
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            product = Product.objects.create(name='Lamp', price='3.00', stock=1)
+            upload = Files.objects.create(product=product, file=image_upload())
+            images.wait(timeout=60)
+            upload.refresh_from_db()
+            self.assertEqual(set(upload.variants), {'source', 'thumbnail', 'medium', 'webp'})
+
+
+class ChunkedUploadTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        settings_override = override_settings(
+            MEDIA_ROOT=self.media_root.name,
+            CHUNKED_UPLOADS={'DIRECTORY': os.path.join(self.media_root.name, 'partial'), 'CHUNK_SIZE': 4},
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.product = Product.objects.create(name='Lamp', price='3.00', stock=1)
+        self.client.force_login(User.objects.create_superuser(username='admin', password='password123'))
+        self.content = b'0123456789' * 3
+        self.digest = hashlib.sha256(self.content).hexdigest()
+
+    def start(self, product=None, **data):
+        url = reverse('product-files-start-upload', args=[(product or self.product).pk])
+        return self.client.post(url, {'filename': 'manual.pdf', 'size': len(self.content), **data},
+                                content_type='application/json')
+
+    def send(self, location, offset, chunk):
+        return self.client.patch(location, chunk, content_type='application/offset+octet-stream',
+                                 HTTP_UPLOAD_OFFSET=str(offset))
+
+    def test_resumable_upload_is_stored_under_its_hash(self):
+        response = self.start()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((response.json()['offset'], response.json()['chunk_size']), (0, 4))
+        location = response['Location']
+
+        response = self.send(location, 0, self.content[:12])
+        self.assertEqual((response.status_code, response['Upload-Offset']), (status.HTTP_204_NO_CONTENT, '12'))
+        # A chunk resent after a lost response is refused with the offset to resume from
+        response = self.send(location, 0, self.content[:12])
+        self.assertEqual((response.status_code, response.json()['offset']), (status.HTTP_409_CONFLICT, 12))
+        self.assertEqual(self.client.get(location).json()['offset'], 12)
+
+        # Another worker process rebuilds the hash state from the partial file
+        uploads._hashers.clear()
+        response = self.send(location, 12, self.content[12:])
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json()['sha256'], self.digest)
+
+        upload = Files.objects.get(product=self.product)
+        self.assertEqual(upload.file.name, f'uploads/sha256/{self.digest[:2]}/{self.digest}.pdf')
+        with upload.file.open('rb') as stored:
+            self.assertEqual(stored.read(), self.content)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(os.listdir(os.path.join(self.media_root.name, 'partial')), [])
+
+    def test_known_content_is_not_uploaded_again(self):
+        location = self.start()['Location']
+        self.send(location, 0, self.content)
+        other = Product.objects.create(name='Chair', price='5.00', stock=1)
+
+        response = self.start(product=other, sha256=self.digest)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json()['product'], other.pk)
+        self.assertFalse(UploadSession.objects.exists())
+
+        # Regular multipart uploads are deduplicated too
+        response = self.client.post(reverse('product-files-list', args=[other.pk]),
+                                    {'file': SimpleUploadedFile('copy.pdf', self.content)})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Files.objects.values('file').distinct().count(), 1)
+        self.assertEqual(len(os.listdir(os.path.join(self.media_root.name, 'uploads', 'sha256', self.digest[:2]))), 1)
+
+    def test_rejects_oversized_chunks_and_wrong_content(self):
+        location = self.start()['Location']
+        response = self.send(location, 0, self.content + b'!')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+        location = self.start(sha256='0' * 64)['Location']
+        response = self.send(location, 0, self.content)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Files.objects.exists())
+
+        self.client.logout()
+        session = UploadSession.objects.create(product=self.product, filename='a.pdf', size=1)
+        response = self.client.get(reverse('product-files-upload', args=[self.product.pk, session.pk]))
+        self.assertIn(response.status_code, (status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN))
+
+
+class FileDownloadTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.content = bytes(range(256)) * 40
+        name, digest = uploads.store_file(SimpleUploadedFile('manual.pdf', self.content))
+        self.product = Product.objects.create(name='Lamp', price='3.00', stock=1)
+        self.file = Files.objects.create(product=self.product, file=name, sha256=digest)
+        self.url = reverse('product-files-download', args=[self.product.pk, self.file.pk])
+
+    def test_full_and_conditional_download(self):
+        response = self.client.get(self.url, HTTP_ACCEPT='application/pdf')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        self.assertEqual(response['ETag'], f'"{self.file.sha256}"')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertTrue(response['Content-Disposition'].startswith('attachment'))
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=f'"{self.file.sha256}"')
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_byte_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(response.streaming_content), self.content[100:200])
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(self.content)}')
+        self.assertEqual(response['Content-Length'], '100')
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-10')
+        self.assertEqual(b''.join(response.streaming_content), self.content[-10:])
+
+        # Resuming against a changed file gets the whole new file
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.content)}-')
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.content)}')
+
+    def test_sendfile_modes_leave_the_copy_to_the_front_server(self):
+        with override_settings(DOWNLOADS={'SENDFILE': 'x-accel-redirect'}):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{self.file.file.name}')
+        self.assertEqual(b''.join(response.streaming_content), b'')
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+
+        with override_settings(DOWNLOADS={'SENDFILE': 'x-sendfile'}):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Sendfile'], os.path.join(self.media_root.name, self.file.file.name))
+
+    def test_product_image_and_variants(self):
+        self.assertEqual(self.client.get(reverse('products-image', args=[self.product.pk])).status_code,
+                         status.HTTP_404_NOT_FOUND)
+        response = self.client.get(self.url, {'variant': 'thumbnail'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        with override_settings(IMAGE_PIPELINE={'EAGER': True}), self.captureOnCommitCallbacks(execute=True):
+            self.product.image = image_upload('lamp.png', size=(400, 300))
+            self.product.save()
+        response = self.client.get(reverse('products-image', args=[self.product.pk]), {'variant': 'thumbnail'})
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        with Image.open(io.BytesIO(b''.join(response.streaming_content))) as thumbnail:
+            self.assertEqual(thumbnail.size, (200, 150))
+
+
+class AsyncReadEndpointsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='buyer', password='password123')
+        self.other = User.objects.create_user(username='other', password='password123')
+        self.product = Product.objects.create(name='Lamp', description='Desk lamp', price='3.00', stock=5)
+        Product.objects.create(name='Chair', description='Office chair', price='5.00', stock=2)
+        Files.objects.create(product=self.product, file='uploads/manual.pdf')
+        self.order = Order.objects.create(user=self.user, total_price=0)
+        OrderItem.objects.create(order=self.order, product=self.product, product_name='Lamp', unit_price='3.00',
+                                 quantity=2)
+        Order.objects.create(user=self.other, total_price=0)
+        token = RefreshToken.for_user(self.user).access_token
+        self.auth = {'HTTP_AUTHORIZATION': f'Bearer {token}'}
+
+    def assertSameAsSync(self, name, args=(), query=None, **headers):
+        sync = self.client.get(reverse(name, args=args), query, **headers)
+        cache.clear()
+        response = self.client.get(reverse(f'async-{name}', args=args), query, **headers)
+        self.assertEqual(response.status_code, sync.status_code)
+        self.assertEqual(response.json(), json.loads(sync.content.replace(b'/products/', b'/async/products/')))
+        return response
+
+    def test_matches_the_sync_endpoints(self):
+        self.assertSameAsSync('products-list', query={'ordering': '-price', 'page_size': 1})
+        self.assertSameAsSync('products-detail', args=[self.product.pk])
+        self.assertSameAsSync('product-files-list', args=[self.product.pk])
+        self.assertSameAsSync('product-files-detail', args=[self.product.pk, self.product.files.get().pk])
+        response = self.assertSameAsSync('order-list', **self.auth)
+        self.assertEqual([order['order_id'] for order in response.json()], [str(self.order.pk)])
+        self.assertSameAsSync('order-list', query={'status__iexact': 'completed'}, **self.auth)
+        self.assertSameAsSync('order-detail', args=[self.order.pk], **self.auth)
+        self.assertSameAsSync('order-user-orders', **self.auth)
+
+    def test_items_from_before_the_price_snapshot(self):
+        OrderItem.objects.filter(order=self.order).update(unit_price=None)
+        response = self.assertSameAsSync('order-list', **self.auth)
+        self.assertEqual(response.json()[0]['items'][0]['item_subtotal'], 6.0)
+        self.assertSameAsSync('order-detail', args=[self.order.pk], **self.auth)
+        self.assertSameAsSync('order-user-orders', **self.auth)
+
+    def test_auth_and_scoping(self):
+        self.assertEqual(self.client.get(reverse('async-order-list')).status_code, status.HTTP_401_UNAUTHORIZED)
+        response = self.client.get(reverse('async-order-list'), HTTP_AUTHORIZATION='Bearer nonsense')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        other_order = Order.objects.get(user=self.other)
+        response = self.client.get(reverse('async-order-detail', args=[other_order.pk]), **self.auth)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        self.client.force_login(self.other)
+        response = self.client.get(reverse('async-order-user-orders'))
+        self.assertEqual([order['order_id'] for order in response.json()], [str(other_order.pk)])
+
+    async def test_served_by_the_asgi_handler(self):
+        response = await self.async_client.get(reverse('async-products-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.json()['results']), 2)
+        response = await self.async_client.get(reverse('async-order-user-orders'), headers={
+            'Authorization': self.auth['HTTP_AUTHORIZATION']})
+        self.assertEqual(response.json()[0]['items'][0]['quantity'], 2)
+
+
+class CompiledSerializerTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password123')
+        self.lamp = Product.objects.create(name='Lamp', description='Desk lamp', price='12.50', stock=3,
+                                           image='products/lamp.png',
+                                           image_variants={'thumbnail': 'products/variants/lamp-thumbnail.webp'})
+        self.chair = Product.objects.create(name='Chair', description='', price='40.00', stock=0)
+        Files.objects.create(product=self.lamp, file='uploads/manual.pdf', variants={'medium': 'uploads/m.webp'})
+        self.order = Order.objects.create(user=self.user, total_price='65.00')
+        OrderItem.objects.create(order=self.order, product=self.lamp, product_name='Lamp', unit_price='12.50',
+                                 quantity=2)
+        OrderItem.objects.create(order=self.order, product=self.chair, quantity=1)
+        # A legacy row from before the price snapshot
+        OrderItem.objects.filter(product=self.chair).update(unit_price=None, product_name='')
+        self.client.force_login(self.user)
+
+    def assertSameAsSerializer(self, name, args=()):
+        response = self.client.get(reverse(name, args=args))
+        with mock.patch('api.compiled.compile_serializer', return_value=None):
+            expected = self.client.get(reverse(name, args=args))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), expected.json())
+        return response.json()
+
+    def test_matches_the_serializers(self):
+        cache.clear()
+        self.assertSameAsSerializer('products-list')
+        cache.clear()
+        self.assertSameAsSerializer('products-detail', args=[self.lamp.pk])
+        cache.clear()
+        self.assertSameAsSerializer('product-files-list', args=[self.lamp.pk])
+        orders = self.assertSameAsSerializer('order-list')
+        self.assertEqual(sorted(item['item_subtotal'] for item in orders[0]['items']), [25.0, 40.0])
+        self.assertSameAsSerializer('order-detail', args=[self.order.pk])
+        self.assertSameAsSerializer('order-user-orders')
+
+    def test_list_renders_from_values_rows(self):
+        cache.clear()
+        with mock.patch('rest_framework.serializers.ModelSerializer.to_representation') as to_representation:
+            orders = self.client.get(reverse('order-list')).json()
+            products = self.client.get(reverse('products-list')).json()
+        to_representation.assert_not_called()
+        self.assertEqual(len(orders[0]['items']), 2)
+        self.assertEqual([product['name'] for product in products['results']], ['Lamp'])
+
+
+class RendererTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password123')
+        self.lamp = Product.objects.create(name='Lamp ', description='', price='12.50', stock=3)
+        order = Order.objects.create(user=self.user, total_price='25.00')
+        OrderItem.objects.create(order=order, product=self.lamp, product_name='Lamp ', unit_price='12.50',
+                                 quantity=2)
+        self.data = OrderSerializer(Order.objects.all(), many=True).data
+        # Users hold one order at a time
+        self.buyer = User.objects.create_user(username='other', password='password123')
+
+    def test_fast_json_matches_drf(self):
+        self.assertEqual(FastJSONRenderer().render(self.data), JSONRenderer().render(self.data))
+        self.assertEqual(FastJSONRenderer().render({'big': 2 ** 70}), b'{"big":1180591620717411303424}')
+        self.assertIn(b'\n', FastJSONRenderer().render(self.data, 'application/json; indent=2'))
+
+        self.client.force_login(self.buyer)
+        response = self.client.post(reverse('order-list'), b'{"status": "Pending", "items": [{"product": %d, '
+                                    b'"quantity": 1}]}' % self.lamp.pk, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.post(reverse('order-list'), b'{"status":', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertTrue(response.json()['detail'].startswith('JSON parse error'))
+
+    @skipUnless(renderers.msgpack, 'msgpack is not installed')
+    def test_msgpack_round_trip(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('order-list'), HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(renderers.msgpack.unpackb(response.content), json.loads(JSONRenderer().render(self.data)))
+        body = renderers.msgpack.packb({'status': 'Pending', 'items': [{'product': self.lamp.pk, 'quantity': 1}]})
+        self.client.force_login(self.buyer)
+        response = self.client.post(reverse('order-list'), body, content_type='application/msgpack')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_benchmark_command(self):
+        out = io.StringIO()
+        call_command('benchmark_renderers', repeat=2, stdout=out)
+        self.assertIn('json (stdlib)', out.getvalue())
+        self.assertIn('1 orders', out.getvalue())
+
+
+class SqlJSONTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='password123')
+        self.other = User.objects.create_user(username='other', password='password123')
+        self.admin = User.objects.create_user(username='admin', password='password123', is_staff=True)
+        lamp = Product.objects.create(name='Lamp', description='', price='12.50', stock=3)
+        chair = Product.objects.create(name='Chair "Ø"', description='', price='0.10', stock=3)
+        order = Order.objects.create(user=self.user, total_price='25.30')
+        OrderItem.objects.create(order=order, product=lamp, product_name='Lamp', unit_price='12.50', quantity=2)
+        OrderItem.objects.create(order=order, product=chair, quantity=3)
+        # A legacy row from before the price snapshot
+        OrderItem.objects.filter(product=chair).update(unit_price=None)
+        Order.objects.create(user=self.user, status=Order.StatusChoices.COMPLETED)
+        Order.objects.create(user=self.other, total_price='0.00')
+        enabled = override_settings(SQL_JSON={'ENABLED': True})
+        enabled.enable()
+        self.addCleanup(enabled.disable)
+
+    def assertSameAsSerializer(self, name, query=None):
+        response = self.client.get(reverse(name), query)
+        self.assertTrue(response.streaming)
+        documents = json.loads(b''.join(response.streaming_content))
+        with override_settings(SQL_JSON={'ENABLED': False}):
+            expected = self.client.get(reverse(name), query)
+        self.assertFalse(expected.streaming)
+        self.assertEqual(sorted(documents, key=lambda order: order['order_id']),
+                         sorted(expected.json(), key=lambda order: order['order_id']))
+        return documents
+
+    def test_matches_the_serializers(self):
+        self.client.force_login(self.user)
+        documents = self.assertSameAsSerializer('order-list')
+        self.assertEqual({len(order['items']) for order in documents}, {0, 2})
+        self.assertEqual(len(self.assertSameAsSerializer('order-list', {'status__iexact': 'completed'})), 1)
+        self.assertEqual(len(self.assertSameAsSerializer('order-user-orders')), 2)
+
+        self.client.force_login(self.admin)
+        self.assertEqual(len(self.assertSameAsSerializer('order-list')), 3)
+        self.assertEqual(self.assertSameAsSerializer('order-user-orders'), [])
+
+    def test_fractional_seconds_match_the_serializers(self):
+        # isoformat() writes all six digits, and none on a whole second.
+        created = timezone.now().replace(microsecond=0)
+        for order, microsecond in zip(Order.objects.order_by('pk'), (120000, 0, 123456)):
+            Order.objects.filter(pk=order.pk).update(created_at=created.replace(microsecond=microsecond))
+        self.client.force_login(self.admin)
+        documents = self.assertSameAsSerializer('order-list')
+        self.assertIn(created.strftime('%S.120000Z'), {order['created_at'][-10:] for order in documents})
+
+    def test_one_query_and_json_only(self):
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as ctx:
+            b''.join(self.client.get(reverse('order-list')).streaming_content)
+        self.assertEqual(len([sql for sql in app_queries(ctx) if 'api_orderitem' in sql]), 1)
+        response = self.client.get(reverse('order-list'), HTTP_ACCEPT='text/html')
+        self.assertFalse(response.streaming)
+
+
+class FragmentCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.lamp = Product.objects.create(name='Lamp', description='', price='3.00', stock=5)
+        self.chair = Product.objects.create(name='Chair', description='', price='5.00', stock=2)
+        Files.objects.create(product=self.lamp, file='uploads/manual.pdf')
+
+    def rendered_rows(self, query=None):
+        """
+        The listed product names, and the rows the compiled serializer rendered.
+        """
+        rendered = []
+        original = CompiledSerializer.render
+
+        def render(compiled, rows):
+            if compiled.model is Product:
+                rendered.extend(row['name'] for row in rows)
+            return original(compiled, rows)
+
+        with mock.patch.object(CompiledSerializer, 'render', render):
+            response = self.client.get(reverse('products-list'), query)
+        return [product['name'] for product in response.json()['results']], sorted(rendered)
+
+    def test_only_changed_products_are_rendered(self):
+        self.assertEqual(self.rendered_rows(), (['Lamp', 'Chair'], ['Chair', 'Lamp']))
+        # Another ordering is a new page, made of the cached fragments
+        self.assertEqual(self.rendered_rows({'ordering': '-price'}), (['Chair', 'Lamp'], []))
+
+        self.chair.price = '7.00'
+        self.chair.save()
+        names, rendered = self.rendered_rows({'ordering': 'name'})
+        self.assertEqual((names, rendered), (['Chair', 'Lamp'], ['Chair']))
+        self.assertEqual(self.client.get(reverse('products-list')).json()['results'][1]['price'], '7.00')
+
+    def test_file_writes_invalidate_their_product(self):
+        self.rendered_rows()
+        self.assertIsNotNone(cache.get(fragment_key(Product, self.lamp.pk)))
+        Files.objects.create(product=self.lamp, file='uploads/guide.pdf')
+        self.assertIsNone(cache.get(fragment_key(Product, self.lamp.pk)))
+        self.assertIsNotNone(cache.get(fragment_key(Product, self.chair.pk)))
+        names, rendered = self.rendered_rows({'ordering': 'price'})
+        self.assertEqual(rendered, ['Lamp'])
+        response = self.client.get(reverse('products-list'), {'ordering': 'price'})
+        self.assertEqual(len(response.json()['results'][0]['files']), 2)
@@ -0,0 +1,256 @@
+"""
+Chunked, resumable and content-addressed file uploads.
+
+A client opens an upload session for a file of known size, then sends the
+bytes in any number of PATCH requests, each starting at the session's current
+offset (`Upload-Offset`). Chunks are streamed from the request straight into a
+partial file and into an incremental SHA-256, so neither the request body nor
+the file is ever held in memory. After a dropped connection the client asks
+for the offset the server has and continues from there.
+
+Finished files are stored under their content hash
+(`uploads/sha256/ab/abcdef....ext`): identical content uploaded for several
+products is stored once. A client that already knows the hash can declare it
+when opening the session and skips the transfer entirely if the content is
+already stored.
+
+Settings, all optional:
+
+    CHUNKED_UPLOADS = {
+        'DIRECTORY': None,            # partial files; default: <tmp>/shop-uploads
+        'CHUNK_SIZE': 8 * 1024 ** 2,  # suggested to clients
+        'MAX_SIZE': 2 * 1024 ** 3,
+        'EXPIRY_HOURS': 24,           # idle sessions are removed after this
+    }
+
+The partial file is the source of truth for the offset, and writers hold an
+exclusive lock on it, so every worker process may serve any chunk of any
+session as long as DIRECTORY is shared.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process development servers only
+    fcntl = None
+
+DEFAULTS = {
+    'DIRECTORY': None,
+    'CHUNK_SIZE': 8 * 1024 ** 2,
+    'MAX_SIZE': 2 * 1024 ** 3,
+    'EXPIRY_HOURS': 24,
+}
+
+CONTENT_PREFIX = 'uploads/sha256'
+READ_SIZE = 64 * 1024
+
+# Hash state of the sessions this process has received chunks for,
+# {session id: (offset, hasher)}. Another process, or a restart, rebuilds it
+# from the partial file once.
+_hashers = {}
+_hashers_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    """
+    Raised for a chunk the session can't accept; `offset` is the current one.
+    """
+
+    def __init__(self, message, offset=None):
+        super().__init__(message)
+        self.offset = offset
+
+
+def get_config():
+    config = {**DEFAULTS, **getattr(settings, 'CHUNKED_UPLOADS', {})}
+    if not config['DIRECTORY']:
+        config['DIRECTORY'] = os.path.join(tempfile.gettempdir(), 'shop-uploads')
+    return config
+
+
+def partial_path(session):
+    return os.path.join(get_config()['DIRECTORY'], f'{session.pk}.part')
+
+
+def content_name(digest, filename):
+    extension = os.path.splitext(filename)[1].lower()
+    return f'{CONTENT_PREFIX}/{digest[:2]}/{digest}{extension}'
+
+
+def current_offset(session):
+    try:
+        return os.path.getsize(partial_path(session))
+    except FileNotFoundError:
+        return 0
+
+
+def find_content(digest):
+    """
+    The stored file of an earlier upload with this hash, or None.
+    """
+    from api.models import Files
+
+    return Files.objects.filter(sha256=digest).exclude(file='').only('file', 'variants').first()
+
+
+def stored_fields(name, digest):
+    """
+    Files field values for stored content; variants rendered for an earlier
+    upload of the same content are reused.
+    """
+    existing = find_content(digest)
+    variants = existing.variants if existing is not None and existing.file.name == name else {}
+    return {'file': name, 'sha256': digest, 'variants': variants}
+
+
+def append_chunk(session, offset, stream, length=None):
+    """
+    Append the request body `stream` to the session's partial file at
+    `offset`. Returns the new offset. Bytes received before a dropped
+    connection are kept, so the client can resume after them.
+    """
+    if length is not None and offset + length > session.size:
+        raise UploadError('The chunk runs past the declared upload size.', current_offset(session))
+
+    path = partial_path(session)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as partial:
+        if fcntl is not None:
+            fcntl.flock(partial, fcntl.LOCK_EX)
+        try:
+            written = os.fstat(partial.fileno()).st_size
+            if written != offset:
+                raise UploadError('Upload-Offset does not match the received bytes.', written)
+            hasher = _hasher(session, path, written)
+            try:
+                while written < session.size:
+                    data = stream.read(min(READ_SIZE, session.size - written))
+                    if not data:
+                        break
+                    partial.write(data)
+                    hasher.update(data)
+                    written += len(data)
+            finally:
+                partial.flush()
+                with _hashers_lock:
+                    _hashers[session.pk] = (written, hasher)
+            if stream.read(1):
+                raise UploadError('The chunk runs past the declared upload size.', written)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(partial, fcntl.LOCK_UN)
+    return written
+
+
+def complete(session):
+    """
+    Move the finished partial file to its content address, or drop it if the
+    content is stored already. Returns (storage name, sha256 hex digest).
+    """
+    path = partial_path(session)
+    offset, hasher = _hashers.get(session.pk) or (None, None)
+    if offset != session.size:
+        hasher = _hash_file(path, session.size)
+    digest = hasher.hexdigest()
+    if session.sha256 and session.sha256 != digest:
+        discard(session)
+        raise UploadError('The uploaded content does not match the declared sha256.', 0)
+
+    existing = find_content(digest)
+    if existing is not None:
+        discard(session)
+        return existing.file.name, digest
+
+    name = content_name(digest, session.filename)
+    try:
+        target = default_storage.path(name)
+    except NotImplementedError:
+        target = None
+    if target is not None:
+        # A rename on the same filesystem, atomic if the same content races in.
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.move(path, target)
+    else:
+        with open(path, 'rb') as partial:
+            if not default_storage.exists(name):
+                name = default_storage.save(name, File(partial))
+        os.remove(path)
+    _forget(session)
+    return name, digest
+
+
+def store_file(uploaded_file):
+    """
+    Store a regular (multipart) upload under its content hash, reusing stored
+    content. Returns (storage name, sha256 hex digest).
+    """
+    hasher = hashlib.sha256()
+    for chunk in uploaded_file.chunks():
+        hasher.update(chunk)
+    digest = hasher.hexdigest()
+    existing = find_content(digest)
+    if existing is not None:
+        return existing.file.name, digest
+    name = content_name(digest, uploaded_file.name)
+    if not default_storage.exists(name):
+        uploaded_file.seek(0)
+        name = default_storage.save(name, uploaded_file)
+    return name, digest
+
+
+def discard(session):
+    try:
+        os.remove(partial_path(session))
+    except FileNotFoundError:
+        pass
+    _forget(session)
+
+
+def remove_expired():
+    """
+    Delete sessions that haven't received a chunk for EXPIRY_HOURS.
+    """
+    from api.models import UploadSession
+
+    cutoff = timezone.now() - timedelta(hours=get_config()['EXPIRY_HOURS'])
+    expired = list(UploadSession.objects.filter(updated_at__lt=cutoff))
+    for session in expired:
+        discard(session)
+    UploadSession.objects.filter(pk__in=[session.pk for session in expired]).delete()
+    return len(expired)
+
+
+def _hasher(session, path, offset):
+    with _hashers_lock:
+        known_offset, hasher = _hashers.get(session.pk) or (None, None)
+    if known_offset == offset:
+        return hasher
+    return _hash_file(path, offset)
+
+
+def _hash_file(path, length):
+    hasher = hashlib.sha256()
+    remaining = length
+    with open(path, 'rb') as partial:
+        while remaining:
+            data = partial.read(min(READ_SIZE * 16, remaining))
+            if not data:
+                break
+            hasher.update(data)
+            remaining -= len(data)
+    return hasher
+
+
+def _forget(session):
+    with _hashers_lock:
+        _hashers.pop(session.pk, None)
@@ -1,5 +1,5 @@
 from django.urls import path, include
-from . import views
+from . import async_views, views
 from rest_framework.routers import DefaultRouter
 from rest_framework_nested.routers import NestedDefaultRouter
 
@@ -17,10 +17,22 @@ product_files_router.register(r'files', views.FileViewSet, basename='product-fil
 
 urlpatterns = [
     #path('products/', views.ProductListCreateAPIView.as_view(), name='product_list'),
-    #path('products/info/', views.ProductInfoAPIView.as_view(), name='product_info'),
+    path('products/info/', views.ProductInfoAPIView.as_view(), name='product_info'),
+    path('profiling/', views.ProfileCapturesView.as_view(), name='profiling'),
     #path('products/<int:pk>/', views.ProductDetailAPIView.as_view(), name='product_detail'),
     #path('users/', views.UserListView.as_view(), name='user_list'),
 
+    # Async read endpoints for ASGI servers, see api/async_views.py
+    path('async/products/', async_views.ProductListView.as_view(), name='async-products-list'),
+    path('async/products/<int:pk>/', async_views.ProductDetailView.as_view(), name='async-products-detail'),
+    path('async/products/<int:product_pk>/files/', async_views.ProductFileListView.as_view(),
+         name='async-product-files-list'),
+    path('async/products/<int:product_pk>/files/<int:pk>/', async_views.ProductFileDetailView.as_view(),
+         name='async-product-files-detail'),
+    path('async/orders/', async_views.OrderListView.as_view(), name='async-order-list'),
+    path('async/orders/user-orders/', async_views.UserOrderListView.as_view(), name='async-order-user-orders'),
+    path('async/orders/<uuid:pk>/', async_views.OrderDetailView.as_view(), name='async-order-detail'),
+
     path('', include(router.urls)),
     path('', include(product_files_router.urls)),
 ]
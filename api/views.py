@@ -1,29 +1,51 @@
+import io
 from django.shortcuts import get_object_or_404
 from api.serializers import (
     ProductSerializer, 
     OrderSerializer, 
     OrderItemSerializer, 
-    ProductInfoSerializer,
+    CatalogStatsSerializer,
     OrderCreateSerializer,
     UserSerializer,
     FilesSerializer,
-    UserRegisterSerializer
+    UserRegisterSerializer,
+    UploadSessionSerializer,
     )
 from api.models import (
     Product,
     Order, 
     OrderItem, 
     User,
-    Files
+    Files,
+    CatalogStats,
+    UploadSession,
     )
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
-from django.db.models import Max
+from decimal import Decimal
+from django.db.models import Max, Count, Sum, Value, DecimalField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from rest_framework import generics
 from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from rest_framework.views import APIView
-from .filters import ProductFilter, InStockFilterBackend, OrderFilter
+from .filters import ProductFilter, InStockFilterBackend, OrderFilter, FullTextSearchFilter
+from .pagination import ProductCursorPagination
+from .exports import NDJSONExportMixin
+from .prefetch import AutoPrefetchMixin, plan_queryset
+from .compiled import CompiledReadMixin
+from .renderers import FastJSONParser
+from .profiling import captures
+from .cache import FragmentCacheMixin, catalog_cache
+from .checkout import cancel, purchase
+from . import downloads, sqljson, uploads
+from .conditional import (
+    conditional,
+    catalog_validators,
+    row_validators,
+    order_list_validators,
+    )
 from rest_framework import filters 
+from rest_framework import status
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.pagination import PageNumberPagination
 from rest_framework import viewsets
@@ -32,7 +54,11 @@ from django.utils.decorators import method_decorator
 from django.views.decorators.cache import cache_page
 from django.views.decorators.vary import vary_on_cookie, vary_on_headers
 from rest_framework.parsers import MultiPartParser, FormParser
-from rest_framework.exceptions import ValidationError
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.reverse import reverse
+from django.db import transaction
+from django.db.models.fields.files import FieldFile
+from django.utils import timezone
 
 """
 @api_view(['GET'])
@@ -42,7 +68,22 @@ def product_list(request):
     return Response(serializer.data)
 
 """
-class ProductAPIView(viewsets.ModelViewSet):
+
+
+def variant_file(field_file, variants, request):
+    """
+    `field_file`, or the stored variant named by ?variant=.
+    """
+    name = request.query_params.get('variant')
+    if not name:
+        return field_file
+    if name == 'source' or name not in (variants or {}):
+        raise NotFound('No such variant.')
+    return FieldFile(field_file.instance, field_file.field, variants[name])
+
+
+class ProductAPIView(AutoPrefetchMixin, NDJSONExportMixin, FragmentCacheMixin, CompiledReadMixin,
+                     viewsets.ModelViewSet):
     """
     A viewset for viewing and editing product instances.
     """
@@ -52,14 +93,41 @@ class ProductAPIView(viewsets.ModelViewSet):
     filterset_class = ProductFilter
     filter_backends = [
         DjangoFilterBackend, 
-        filters.SearchFilter,
+        FullTextSearchFilter,
         filters.OrderingFilter,
         InStockFilterBackend
     ]
     search_fields = ['name', 'description']  # if there is "=" symbol before search fields, only exact match will be used
     ordering_fields = ['name', 'price', 'stock']
     
-    pagination_class = None  # Disable pagination for this viewset
+    pagination_class = ProductCursorPagination  # keyset pagination, stable under ordering_fields
+    export_filename = 'products.ndjson'
+
+    @conditional(catalog_validators)
+    @catalog_cache()
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @conditional(row_validators)
+    @catalog_cache()
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    @action(detail=False, methods=['get'], url_path='stats')
+    @conditional(catalog_validators)
+    @catalog_cache()
+    def stats(self, request):
+        # One primary-key lookup on the maintained summary row, the product table is not touched
+        return Response(CatalogStatsSerializer(CatalogStats.load()).data)
+
+    @action(detail=True, methods=['get', 'head'], url_path='image',
+            content_negotiation_class=downloads.AnyMediaTypeNegotiation)
+    def image(self, request, pk=None):
+        """
+        The product image, or one of its variants with ?variant=thumbnail.
+        """
+        product = get_object_or_404(Product.objects.only('image', 'image_variants'), pk=pk)
+        return downloads.serve(request, variant_file(product.image, product.image_variants, request))
 
     def get_permissions(self):
         self.permission_classes = [AllowAny]
@@ -67,21 +135,21 @@ class ProductAPIView(viewsets.ModelViewSet):
             self.permission_classes = [IsAdminUser]
         return super().get_permissions()
 
-class ProductListCreateAPIView(generics.ListCreateAPIView):
+class ProductListCreateAPIView(AutoPrefetchMixin, generics.ListCreateAPIView):
     #throttle_scope = 'products'
     queryset = Product.objects.all()
     serializer_class = ProductSerializer    
     filterset_class = ProductFilter
     filter_backends = [
         DjangoFilterBackend, 
-        filters.SearchFilter,
+        FullTextSearchFilter,
         filters.OrderingFilter,
         InStockFilterBackend
     ]
     search_fields = ['name', 'description'] # if there is "=" symbol before search fields, only exact match will be used
     ordering_fields = ['name', 'price','stock']
 
-    pagination_class = None
+    pagination_class = ProductCursorPagination
     """
     pagination_class.page_size = 5 
     pagination_class.page_query_param = 'pagenum'  # allow you to use ?pagenum=1, ?pagenum=2, etc.
@@ -93,14 +161,12 @@ class ProductListCreateAPIView(generics.ListCreateAPIView):
         if self.request.method == 'POST':
             self.permission_classes = [IsAdminUser]
         return super().get_permissions() 
-    """
-    @method_decorator(cache_page(60 * 15, key_prefix='product_list'))
+
+    @catalog_cache()
     def list(self, request, *args, **kwargs):
-        
-        # Cache the product list for 15 minutes.
-        
+        # Cached per catalog version, see api/cache.py
         return super().list(request, *args, **kwargs)
-    
+    """
     def get_queryset(self):
         
         #O verride the default queryset to apply the filter.
@@ -117,9 +183,14 @@ def product_detail(request,pk):
     return Response(serializer.data)
 """
 
-class ProductDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
+class ProductDetailAPIView(AutoPrefetchMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
+
+    @catalog_cache()
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
     def get_permissions(self):
         self.permission_classes = [AllowAny]
         if self.request.method in ['POST', 'PUT', 'PATCH', 'DELETE']:
@@ -138,25 +209,28 @@ class OrderListAPIView(generics.ListAPIView):
     queryset = Order.objects.prefetch_related('items__product').all()
     serializer_class = OrderSerializer
 """
-class OrderViewSet(viewsets.ModelViewSet):
+class OrderViewSet(AutoPrefetchMixin, NDJSONExportMixin, CompiledReadMixin, viewsets.ModelViewSet):
     #throttle_scope = 'orders'
-    queryset = Order.objects.prefetch_related('items__product').all()
+    queryset = Order.objects.all()  # items are prefetched by AutoPrefetchMixin, they carry name/price snapshots
     serializer_class = OrderSerializer
     permission_classes = [IsAuthenticated]
     pagination_class = None  # Disable pagination for this viewset
     filter_backends = [DjangoFilterBackend]
     filterset_class = OrderFilter
+    export_filename = 'orders.ndjson'
+    batch_max_size = 500
+    compiled_actions = ('list', 'retrieve', 'user_orders')
 
     def perform_create(self, serializer):
         user = self.request.user
 
-        if Order.objects.filter(user=user).count() > 0:
+        if Order.objects.filter(user=user).exists():
             raise ValidationError("You can only create one order at a time.")
         serializer.save(user=self.request.user) 
         #return super().perform_create(serializer)
 
     def get_serializer_class(self):
-        if self.action == 'create':
+        if self.action in ['create', 'batch']:
             return OrderCreateSerializer
         elif self.action in ['retrieve', 'list']:
             return OrderSerializer
@@ -171,6 +245,17 @@ class OrderViewSet(viewsets.ModelViewSet):
         if not self.request.user.is_staff:
             qs = qs.filter(user=self.request.user)
         return qs
+
+    @conditional(order_list_validators)
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        if sqljson.supported(request, queryset):
+            return sqljson.order_list_response(queryset)
+        return super().list(request, *args, **kwargs)
+
+    @conditional(row_validators)
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
     
     @action(detail=True, methods=['post'], url_path='purchase')
     def purchase_order(self, request, pk=None):
@@ -180,16 +265,57 @@ class OrderViewSet(viewsets.ModelViewSet):
         if order.user != request.user and not request.user.is_staff:
             return Response({'detail': 'Permission denied.'}, status=status.HTTP_403_FORBIDDEN)
 
-        # Zaten tamamlanmış mı?
-        if order.status == Order.StatusChoices.COMPLETED:
-            raise ValidationError("This order has already been purchased.")
-
-        # Siparişi satın alınmış olarak işaretle
-        order.status = Order.StatusChoices.COMPLETED
-        order.save()
+        # Durum geçişi ve stok düşümü tek kısa transaction içinde, koşullu UPDATE'lerle
+        purchase(order)
 
         return Response({'detail': 'Order purchased successfully.'})
     
+    @action(detail=False, methods=['post'], url_path='batch', permission_classes=[IsAdminUser])
+    def batch(self, request):
+        """
+        Create a list of orders for integrations (POS, marketplaces). All
+        orders are validated together with one product query and the valid
+        ones are written with bulk inserts; the response has one result or
+        error entry per submitted order, in order.
+        """
+        payloads = request.data
+        if not isinstance(payloads, list) or not payloads:
+            raise ValidationError("Expected a non-empty list of orders.")
+        if len(payloads) > self.batch_max_size:
+            raise ValidationError(f"A batch can contain at most {self.batch_max_size} orders.")
+
+        serializer_class = self.get_serializer_class()
+        context = self.get_serializer_context()
+        context['products'] = serializer_class.prefetch_products(payloads)
+        serializers_ = [serializer_class(data=payload, context=context) for payload in payloads]
+        valid = [serializer.is_valid() for serializer in serializers_]
+
+        created = iter(serializer_class.create_many(
+            [serializer.validated_data for serializer, ok in zip(serializers_, valid) if ok],
+            user=request.user,
+        ))
+
+        results = []
+        for index, (serializer, ok) in enumerate(zip(serializers_, valid)):
+            if not ok:
+                results.append({'index': index, 'errors': serializer.errors})
+                continue
+            order = next(created)
+            results.append({
+                'index': index,
+                'order_id': order.order_id,
+                'status': order.status,
+                'total_price': order.total_price,
+            })
+
+        if all(valid):
+            response_status = status.HTTP_201_CREATED
+        elif any(valid):
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response(results, status=response_status)
+
     @action(detail=True, methods=['post'], url_path='cancel')
     def cancel_order(self, request, pk=None):
         order = self.get_object()
@@ -198,14 +324,10 @@ class OrderViewSet(viewsets.ModelViewSet):
         if order.user != request.user and not request.user.is_staff:
             return Response({'detail': 'Permission denied.'}, status=status.HTTP_403_FORBIDDEN)
 
-        # Zaten tamamlanmış mı?
-        if order.status == Order.StatusChoices.CANCELLED:
-            raise ValidationError("This order has already been canceled.")
-
-        # Siparişi satın alınmış olarak işaretle
-        order.status = Order.StatusChoices.CANCELLED
-        order.save()
-        order.delete()  # Optional: Delete the order if you want to remove it from the database
+        # Siparişi iptal et; tamamlanmışsa stoğu geri ver
+        with transaction.atomic():
+            cancel(order)
+            order.delete()  # Optional: Delete the order if you want to remove it from the database
 
         return Response({'detail': 'Order cancelled successfully.'})
 
@@ -214,9 +336,15 @@ class OrderViewSet(viewsets.ModelViewSet):
             methods=['get'], 
             url_path='user-orders',
             )
+    @conditional(order_list_validators)
     def user_orders(self, request):
         user = request.user
         orders = self.get_queryset().filter(user=user)
+        if sqljson.supported(request, orders):
+            return sqljson.order_list_response(orders)
+        compiled = self.get_compiled_serializer()
+        if compiled is not None:
+            return Response(compiled.render(compiled.values(orders)))
         serializer = self.get_serializer(orders, many=True)
         return Response(serializer.data)
     """
@@ -256,46 +384,174 @@ def product_info(request):
     return Response(serializer.data)
 """
 class ProductInfoAPIView(APIView):
+    """
+    Catalog statistics, plus a page of products with ?products=true.
+    """
+    pagination_class = ProductCursorPagination
 
+    @catalog_cache()
     def get(self, request):
-        products = Product.objects.all()
-        serializer = ProductInfoSerializer({
-            'products': products,
-            'count': len(products),
-            'max_price': products.aggregate(max_price=Max('price'))['max_price']
-        })
-        return Response(serializer.data)
+        data = CatalogStatsSerializer(CatalogStats.load()).data
+        if request.query_params.get('products') in ('1', 'true'):
+            paginator = self.pagination_class()
+            products = plan_queryset(Product.objects.all(), ProductSerializer(context={'request': request}))
+            page = paginator.paginate_queryset(products, request, view=self)
+            data['products'] = paginator.get_paginated_response(ProductSerializer(page, many=True).data).data
+        return Response(data)
     
 
-class UserListView(generics.ListAPIView):
+class ProfileCapturesView(APIView):
+    """
+    Latest sampled request profiles of this process, newest first (?limit=).
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        try:
+            limit = int(request.query_params.get('limit', 100))
+        except ValueError:
+            raise ValidationError({'limit': 'Must be an integer.'})
+        return Response(captures.recent(limit))
+
+
+class UserOrderStatsMixin:
+    """
+    Annotates each user with order count, lifetime spend (completed orders)
+    and last order time as correlated subqueries, so a page of users is one
+    query whatever the number of orders. The order id list is only
+    rendered, and so only prefetched by AutoPrefetchMixin, for ?expand=orders.
+    """
+    def get_queryset(self):
+        orders = Order.objects.filter(user=OuterRef('pk')).order_by().values('user')
+        return super().get_queryset().annotate(
+            order_count=Coalesce(Subquery(orders.annotate(n=Count('pk')).values('n')), 0),
+            lifetime_spend=Coalesce(
+                Subquery(orders.filter(status=Order.StatusChoices.COMPLETED)
+                         .annotate(total=Sum('total_price')).values('total')),
+                Value(Decimal('0')), output_field=DecimalField(max_digits=12, decimal_places=2),
+            ),
+            last_order_at=Subquery(orders.annotate(last=Max('created_at')).values('last')),
+        ).order_by('id')
+
+
+class UserListView(AutoPrefetchMixin, UserOrderStatsMixin, generics.ListAPIView):
     queryset = User.objects.all()
     serializer_class = UserSerializer
-    pagination_class = None
     #permission_classes = [IsAdminUser]
 
-class FileViewSet(viewsets.ModelViewSet):
+class FileViewSet(AutoPrefetchMixin, CompiledReadMixin, viewsets.ModelViewSet):
+    queryset = Files.objects.all()
     serializer_class = FilesSerializer
     parser_classes = [MultiPartParser, FormParser]
     pagination_class = None
 
     def get_queryset(self):
-        return Files.objects.filter(product_id=self.kwargs['product_pk'])
+        return super().get_queryset().filter(product_id=self.kwargs['product_pk'])
+
+    @conditional(catalog_validators)
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @conditional(catalog_validators)
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
 
     def perform_create(self, serializer):
         product_id = self.kwargs['product_pk']
         if product_id is None:
             raise ValidationError("Missing product ID in URL.")
         product = get_object_or_404(Product, pk=product_id)
-        serializer.save(product=product)
+        upload = serializer.validated_data.pop('file', None)
+        if upload:
+            # Stored under its content hash like chunked uploads, once per content
+            serializer.save(product=product, **uploads.stored_fields(*uploads.store_file(upload)))
+        else:
+            serializer.save(product=product)
+
+    @action(detail=True, methods=['get', 'head'], url_path='download',
+            content_negotiation_class=downloads.AnyMediaTypeNegotiation)
+    def download(self, request, product_pk=None, pk=None):
+        """
+        The file with Range/If-Range and ETag support, or one of its image
+        variants with ?variant=thumbnail.
+        """
+        file = self.get_object()
+        digest = '' if request.query_params.get('variant') else file.sha256
+        return downloads.serve(request, variant_file(file.file, file.variants, request), digest=digest)
+
+    @action(detail=False, methods=['post'], url_path='uploads', parser_classes=[FastJSONParser, FormParser])
+    def start_upload(self, request, product_pk=None):
+        """
+        Open a chunked upload of `size` bytes. With a `sha256` of content that
+        is stored already, the file is attached right away (201 with the file)
+        and nothing has to be sent.
+        """
+        product = get_object_or_404(Product, pk=product_pk)
+        serializer = UploadSessionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        digest = serializer.validated_data.get('sha256')
+        if digest and uploads.find_content(digest) is not None:
+            file = Files.objects.create(product=product, **uploads.stored_fields(
+                uploads.find_content(digest).file.name, digest))
+            return Response(FilesSerializer(file, context=self.get_serializer_context()).data,
+                            status=status.HTTP_201_CREATED)
+
+        uploads.remove_expired()
+        session = serializer.save(product=product)
+        location = reverse('product-files-upload', args=[product.pk, session.pk], request=request)
+        return Response(serializer.data, status=status.HTTP_201_CREATED,
+                        headers={'Location': location, 'Upload-Offset': '0'})
+
+    @action(detail=False, methods=['get', 'head', 'patch', 'delete'],
+            url_path=r'uploads/(?P<upload_id>[0-9a-f-]{36})')
+    def upload(self, request, product_pk=None, upload_id=None):
+        """
+        GET/HEAD: the offset to resume from. PATCH: append the raw request
+        body at `Upload-Offset`; the request completing the file answers 201
+        with the file. DELETE: abort.
+        """
+        session = get_object_or_404(UploadSession, pk=upload_id, product_id=product_pk)
+        if request.method == 'DELETE':
+            uploads.discard(session)
+            session.delete()
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        if request.method != 'PATCH':
+            data = UploadSessionSerializer(session).data
+            return Response(data, headers={'Upload-Offset': str(data['offset'])})
+
+        try:
+            offset = int(request.headers['Upload-Offset'])
+            length = int(request.headers.get('Content-Length') or 0)
+        except (KeyError, ValueError):
+            raise ValidationError({'Upload-Offset': 'Send the byte offset this chunk starts at.'})
+        try:
+            offset = uploads.append_chunk(session, offset, request.stream or io.BytesIO(), length)
+        except uploads.UploadError as error:
+            return Response({'detail': str(error), 'offset': error.offset}, status=status.HTTP_409_CONFLICT,
+                            headers={'Upload-Offset': str(error.offset)})
+        if offset < session.size:
+            UploadSession.objects.filter(pk=session.pk).update(updated_at=timezone.now())
+            return Response(status=status.HTTP_204_NO_CONTENT, headers={'Upload-Offset': str(offset)})
+
+        try:
+            name, digest = uploads.complete(session)
+        except uploads.UploadError as error:
+            session.delete()
+            raise ValidationError({'sha256': str(error)})
+        with transaction.atomic():
+            file = Files.objects.create(product_id=session.product_id, **uploads.stored_fields(name, digest))
+            session.delete()
+        return Response(FilesSerializer(file, context=self.get_serializer_context()).data,
+                        status=status.HTTP_201_CREATED, headers={'Upload-Offset': str(offset)})
 
     def get_permissions(self):
         self.permission_classes = [AllowAny]
-        if self.request.method in ['POST', 'PUT', 'PATCH', 'DELETE']:
+        if self.request.method in ['POST', 'PUT', 'PATCH', 'DELETE'] or self.action == 'upload':
             self.permission_classes = [IsAdminUser]
         return super().get_permissions()
     
 
-class UserViewSet(viewsets.ModelViewSet):
+class UserViewSet(AutoPrefetchMixin, UserOrderStatsMixin, viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
 
@@ -1,7 +1,9 @@
 from pathlib import Path
 from datetime import timedelta
+from importlib.util import find_spec
 
 import os
+import tempfile
 
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -19,6 +21,10 @@ DEBUG = True
 
 ALLOWED_HOSTS = ['.onrender.com']
 
+# silk logs every request and query into the serving database; only for local
+# debugging. Production uses the sampled api.profiling middleware instead.
+SILK_ENABLED = os.environ.get('SILK_ENABLED') == '1'
+
 
 # Application definition
 
@@ -32,12 +38,12 @@ INSTALLED_APPS = [
     'django_extensions',
     'api',
     'rest_framework',
-    'silk',
     'drf_spectacular',
     'django_filters',
 ]
 
 MIDDLEWARE = [
+    'api.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -45,9 +51,31 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'silk.middleware.SilkyMiddleware',
+    'api.profiling.ProfilingMiddleware',
 ]
 
+if SILK_ENABLED:
+    INSTALLED_APPS.append('silk')
+    MIDDLEWARE.append('silk.middleware.SilkyMiddleware')
+
+PROFILING = {
+    'SAMPLE_RATE': float(os.environ.get('PROFILING_SAMPLE_RATE', '0.01')),
+    'PATH_RATES': {},
+    'HEADER': 'X-Profile',
+    'HEADER_TOKEN': os.environ.get('PROFILING_TOKEN'),
+    'SLOW_REQUEST_MS': 500,
+    'BUFFER_SIZE': 500,
+    'DIRECTORY': os.environ.get('PROFILING_DIRECTORY'),
+}
+
+# Each gunicorn worker snapshots its metrics into DIRECTORY and /metrics sums
+# them; without it /metrics only shows the worker that answers the scrape.
+METRICS = {
+    'DIRECTORY': os.environ.get('METRICS_DIRECTORY'),
+    'FLUSH_INTERVAL': 5,
+    'TOKEN': os.environ.get('METRICS_TOKEN'),
+}
+
 ROOT_URLCONF = 'shop.urls'
 
 TEMPLATES = [
@@ -76,6 +104,13 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # A file-backed test database gets real SQLite locking; the default
+        # shared-cache in-memory one fails concurrent writers immediately.
+        # It lives outside the source tree, so interrupted runs and --keepdb
+        # leave nothing behind.
+        'TEST': {
+            'NAME': os.environ.get('TEST_DB_NAME', os.path.join(tempfile.gettempdir(), 'shop_test_db.sqlite3')),
+        },
     }
 }
 
@@ -122,7 +157,20 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 AUTH_USER_MODEL = 'api.User'
 
+# MessagePack for internal service clients, when msgpack is installed
+MSGPACK_CLASSES = ['api.renderers.MessagePackRenderer'] if find_spec('msgpack') else []
+
 REST_FRAMEWORK = {
+    # orjson when installed, else the stdlib json module
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ] + MSGPACK_CLASSES,
+    'DEFAULT_PARSER_CLASSES': [
+        'api.renderers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ] + [name.replace('Renderer', 'Parser') for name in MSGPACK_CLASSES],
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework_simplejwt.authentication.JWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',
@@ -196,17 +244,42 @@ SPECTACULAR_SETTINGS = {
     # OTHER SETTINGS
 }
 
-"""
-CACHES = {
-    "default": {
-        "BACKEND": "django_redis.cache.RedisCache",
-        "LOCATION": "redis://127.0.0.1:6379/1",
-        "OPTIONS": {
-            "CLIENT_CLASS": "django_redis.client.DefaultClient",
+# The catalog response cache and its ETags must be shared by every worker, see api/cache.py.
+# Without REDIS_URL the per-process LocMem cache is used, and catalog caching is skipped
+# unless CATALOG_CACHE_LOCAL=1 says the server runs a single process (e.g. runserver).
+REDIS_URL = os.environ.get('REDIS_URL')
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django_redis.cache.RedisCache",
+            "LOCATION": REDIS_URL,
+            "OPTIONS": {
+                "CLIENT_CLASS": "django_redis.client.DefaultClient",
+            }
         }
     }
-}
-"""
+CATALOG_CACHE_LOCAL = os.environ.get('CATALOG_CACHE_LOCAL') == '1'
 
 MEDIA_URL = '/media/'
-MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
\ No newline at end of file
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# Thumbnail/medium/WebP variants of uploaded images are rendered in a process pool, see api/images.py
+IMAGE_PIPELINE = {
+    'WORKERS': int(os.environ.get('IMAGE_PIPELINE_WORKERS', '2')),
+}
+
+# Partial files of chunked uploads; must be shared by all workers, see api/uploads.py
+CHUNKED_UPLOADS = {
+    'DIRECTORY': os.environ.get('CHUNKED_UPLOADS_DIRECTORY', os.path.join(BASE_DIR, '.uploads')),
+    'CHUNK_SIZE': 8 * 1024 ** 2,
+}
+
+# File downloads; behind nginx set 'x-accel-redirect' to let it copy the files, see api/downloads.py
+DOWNLOADS = {
+    'SENDFILE': os.environ.get('DOWNLOADS_SENDFILE') or None,
+}
+
+# Order lists rendered as JSON by the database, see api/sqljson.py
+SQL_JSON = {
+    'ENABLED': os.environ.get('SQL_JSON_ENABLED') == '1',
+}